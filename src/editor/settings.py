@@ -56,6 +56,28 @@ DATABASES = {
 
 DATABASE_ROUTERS = ['names.models.NamesRouter']
 
+# SQLite PRAGMAs applied on connect (see names.database)
+DB_PROFILE = config.get('database', 'profile', fallback='interactive')
+
+# Job queue and other bookkeeping (see names.statedb)
+STATE_DB = config.get(
+    'database', 'state_db', fallback='/opt/namesdb-editor/db/editorstate.db'
+)
+# Point-in-time copies used by `namesdb post --snapshot` (see names.snapshot)
+SNAPSHOT_DIR = config.get(
+    'database', 'snapshot_dir', fallback='/opt/namesdb-editor/db/snapshots'
+)
+# Queue admin edits for publishing by the worker (see names.publisher)
+PUBLISH_ON_SAVE = config.getboolean('database', 'publish_on_save', fallback=False)
+PUBLISH_DELAY = config.getint('database', 'publish_delay', fallback=5)
+# Rows saved per transaction by namesdb load/loadirei (see names.writer)
+LOAD_BATCH_SIZE = config.getint('database', 'load_batch_size', fallback=1000)
+
+# names tables are maintained by hand (see docstrings in names.models),
+# so build test databases from the models rather than the migrations.
+if 'test' in sys.argv:
+    MIGRATION_MODULES = {'names': None}
+
 DOCSTORE_ENABLED = config.getboolean('database','docstore_enabled')
 DOCSTORE_HOST = config.get('database', 'docstore_host')
 DOCSTORE_SSL_CERTFILE = config.get('database', 'docstore_ssl_certfile')
@@ -64,10 +86,25 @@ DOCSTORE_PASSWORD = config.get('database', 'docstore_password')
 
 RESULTS_PER_PAGE = 100
 
+# File-based so that cached filtered counts and choices are shared by all
+# gunicorn workers.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': config.get(
+            'cache', 'location', fallback='/var/tmp/namesdbeditor-cache'
+        ),
+    }
+}
+ADMIN_COUNT_TIMEOUT = config.getint('cache', 'admin_count_timeout', fallback=300)
+
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/3.1/howto/static-files/
 STATIC_ROOT = config.get('media', 'static_root')
 STATIC_URL = config.get('media', 'static_url')
+EXPORT_ROOT = Path(config.get(
+    'media', 'export_root', fallback='/opt/namesdb-editor/exports'
+))
 
 NOIDMINTER_HOST = config.get('noidminter', 'idservice_host')
 # See ddr-idservice/idservice/noidminter/pynoid.py
@@ -164,6 +201,28 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# Append names database statements to this file (see names.sqllog)
+SQL_LOG = config.get('debug', 'sql_log', fallback='')
+if SQL_LOG:
+    MIDDLEWARE.append('names.middleware.SQLLogMiddleware')
+
+# Timings and counts of each namesdb run (see names.metrics).
+# Blank to skip.  METRICS_LOG and METRICS_SPANS are appended JSON lines;
+# METRICS_TEXTFILE_DIR is a node_exporter textfile collector directory.
+METRICS_LOG = config.get('debug', 'metrics_log', fallback='')
+METRICS_SPANS = config.get('debug', 'metrics_spans', fallback='')
+METRICS_TEXTFILE_DIR = config.get('debug', 'metrics_textfile_dir', fallback='')
+
+# Output of `namesdb --profile` and ProfileMiddleware (see names.profiling)
+PROFILE_DIR = config.get(
+    'debug', 'profile_dir', fallback='/var/log/ddr/namesdbeditor-profiles'
+)
+# Record SQL count and time of each request, and save a sampled profile of
+# requests that take at least this many milliseconds.  0 is off.
+PROFILE_SLOW_MS = config.getint('debug', 'profile_slow_ms', fallback=0)
+if PROFILE_SLOW_MS:
+    MIDDLEWARE.append('names.middleware.ProfileMiddleware')
+
 ROOT_URLCONF = 'editor.urls'
 
 # Password validation
@@ -0,0 +1,4 @@
+# Elasticsearch indexes are named INDEX_PREFIX + model e.g. "namesperson".
+# Kept here so that code that only needs the names (`namesdb url`) doesn't
+# import the models.
+INDEX_PREFIX = 'names'
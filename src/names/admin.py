@@ -1,10 +1,15 @@
 from django import forms
 from django.contrib import admin
 from django.contrib.contenttypes.admin import GenericTabularInline
+from django.db.models import Q
 from django.urls import reverse
 
-from .admin_actions import export_as_csv_action
+from .admin_actions import export_as_csv_action, enqueue_job_action
 from . import converters
+from . import fts
+from . import lookups
+from .paginators import CachedCountPaginator
+from .paginators import CachedAllValuesFieldListFilter as CachedValues
 from .models import Facility, Location, FarRecord, FarPage, WraRecord
 from .models import Person, PersonLocation
 from .models import IreiRecord
@@ -15,9 +20,50 @@ admin.site.site_header = "Densho Names Registry Editor"
 admin.site.site_title = "Densho Names Registry Editor"
 #admin.site.index_title = "index title"
 
+# Queued admin actions (see names.jobs)
+PUBLISH_ACTION = enqueue_job_action('publish', 'Publish selected to Elasticsearch')
+EXPORT_ACTION = enqueue_job_action('export', 'Export selected to CSV (background)')
+FAMILY_ACTION = enqueue_job_action('reindex_family', 'Republish families of selected')
+
+
+class CachedCountMixin():
+    """Serve changelist counts from cache (see names.paginators)"""
+    paginator = CachedCountPaginator
+    # Skip the second, unfiltered COUNT(*) on every changelist page
+    show_full_result_count = False
+
+
+class FTSSearchMixin():
+    """Search using the table's FTS5 index instead of icontains on search_fields
+
+    Supports field-prefixed terms ("family_name:yasui") and exact matches
+    on the (indexed) fields in search_id_fields.  Falls back to the default
+    search_fields behavior if the table has no FTS index (see `namesdb fts`).
+    """
+    search_id_fields = ()
+    search_help_text = 'Search names or IDs. Limit to a field with FIELD:TEXT e.g. family_name:yasui'
+
+    def get_search_results(self, request, queryset, search_term):
+        columns = fts.fts_columns(self.model._meta.db_table)
+        if not (search_term.strip() and columns):
+            return super().get_search_results(request, queryset, search_term)
+        expression,exact = fts.parse_search(
+            search_term, columns, self.search_id_fields
+        )
+        q = Q()
+        if expression:
+            q = fts.match_q(self.model, expression)
+            # a bare ID pasted into the search box
+            if len(fts.split_terms(search_term)) == 1:
+                for fieldname in self.search_id_fields:
+                    q |= Q(**{fieldname: search_term.strip()})
+        if exact:
+            q &= Q(**exact)
+        return queryset.filter(q), False
+
 
 @admin.register(Revision)
-class RevisionAdmin(admin.ModelAdmin):
+class RevisionAdmin(CachedCountMixin, admin.ModelAdmin):
     list_display = (
         'content_type',
         'object_id',
@@ -29,7 +75,7 @@ class RevisionAdmin(admin.ModelAdmin):
     list_display_links = ('content_object',)
     list_filter = (
         'content_type',
-        'username',
+        ('username', CachedValues),
     )
     search_fields = (
         #'content_type',
@@ -51,6 +97,12 @@ class RevisionAdmin(admin.ModelAdmin):
         )}),
     )
 
+    def get_queryset(self, request):
+        # content_object is a generic FK: fetch per content type, not per row
+        return super().get_queryset(request).select_related(
+            'content_type'
+        ).prefetch_related('content_object')
+
 
 class RevisionInline(GenericTabularInline):
     model = Revision
@@ -67,15 +119,18 @@ class RevisionInline(GenericTabularInline):
     def has_change_permission(self, request, obj): return False
     def has_delete_permission(self, request, obj): return False
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('content_type')
+
 
 @admin.register(Facility)
-class FacilityAdmin(admin.ModelAdmin):
+class FacilityAdmin(CachedCountMixin, admin.ModelAdmin):
     actions = [export_as_csv_action()]
     list_display = (
         'facility_id', 'facility_type', 'title',
     )
     list_display_links = ('facility_id',)
-    list_filter = ('facility_type',)
+    list_filter = (('facility_type', CachedValues),)
     search_fields = (
         'facility_id', 'facility_type', 'title',
     )
@@ -92,7 +147,7 @@ class FacilityAdmin(admin.ModelAdmin):
 
 
 @admin.register(Location)
-class LocationAdmin(admin.ModelAdmin):
+class LocationAdmin(CachedCountMixin, admin.ModelAdmin):
     actions = [export_as_csv_action()]
     list_display = (
         'id',
@@ -102,6 +157,7 @@ class LocationAdmin(admin.ModelAdmin):
         'facility',
     )
     list_display_links = ('id', 'address',)
+    list_select_related = ('facility',)
     list_filter = ()
     search_fields = (
         'lat',
@@ -145,14 +201,18 @@ class FarRecordAdminForm(forms.ModelForm):
 
 
 @admin.register(FarRecord)
-class FarRecordAdmin(admin.ModelAdmin):
-    actions = [export_as_csv_action()]
+class FarRecordAdmin(FTSSearchMixin, CachedCountMixin, admin.ModelAdmin):
+    actions = [PUBLISH_ACTION, EXPORT_ACTION, FAMILY_ACTION]
     list_display = (
         'far_record_id', 'facility', 'far_page', 'family_number', 'last_name', 'first_name',
         'year_of_birth',
     )
     list_display_links = ('far_record_id',)
-    list_filter = ('facility', 'sex', 'citizenship')
+    list_filter = (
+        ('facility', CachedValues),
+        ('sex', CachedValues),
+        ('citizenship', CachedValues),
+    )
     search_fields = (
         'far_record_id', 'facility', 'far_page', 'original_order', 'family_number', 'far_line_id',
         'last_name', 'first_name', 'other_names',
@@ -165,6 +225,7 @@ class FarRecordAdmin(admin.ModelAdmin):
         'camp_address_original', 'camp_address_block', 'camp_address_barracks',
         'camp_address_room', 'reference', 'original_notes',
     )
+    search_id_fields = ('far_record_id', 'family_number', 'person_id',)
     autocomplete_fields = ['person',]
     readonly_fields = ('timestamp','far_record_id','facility','far_page', 'original_order','far_line_id',)
     inlines = (RevisionInline,)
@@ -197,18 +258,27 @@ class FarRecordAdmin(admin.ModelAdmin):
         )}),
     )
 
+    def get_queryset(self, request):
+        # FarRecordAdminForm displays the Person
+        return super().get_queryset(request).select_related('person')
+
     def get_form(self, request, obj=None, **kwargs):
         # Add link to far_page field.
         # Can't do this in FarRecordAdminForm.__init__ bc field is readonly
-        far_page = FarPage.objects.get(facility=obj.facility, page=obj.far_page)
-        url = reverse(
-            f'admin:{far_page._meta.app_label}_{far_page._meta.model_name}_change',
-            args=[far_page.file_id]
-        )
-        help_texts = {
-            'far_page': f'<a href="{url}">Page in FAR ledger</a>, recorded in original ledger'
-        }
-        kwargs.update({'help_texts': help_texts})
+        # get_form runs more than once per view so only look up FarPage once
+        if obj and not hasattr(obj, '_far_page_file_id'):
+            obj._far_page_file_id = lookups.far_page_file_id(
+                obj.facility, obj.far_page
+            )
+        if obj and obj._far_page_file_id:
+            url = reverse(
+                f'admin:{FarPage._meta.app_label}_{FarPage._meta.model_name}_change',
+                args=[obj._far_page_file_id]
+            )
+            help_texts = {
+                'far_page': f'<a href="{url}">Page in FAR ledger</a>, recorded in original ledger'
+            }
+            kwargs.update({'help_texts': help_texts})
         return super().get_form(request, obj, **kwargs)
 
     def save_model(self, request, obj, form, change):
@@ -224,7 +294,7 @@ class FarPageAdminForm(forms.ModelForm):
 
 
 @admin.register(FarPage)
-class FarPageAdmin(admin.ModelAdmin):
+class FarPageAdmin(CachedCountMixin, admin.ModelAdmin):
     actions = [export_as_csv_action()]
     list_display = (
         'facility', 'page', 'file_id', 'file_label',
@@ -267,14 +337,18 @@ class WraRecordAdminForm(forms.ModelForm):
 
 
 @admin.register(WraRecord)
-class WraRecordAdmin(admin.ModelAdmin):
-    actions = [export_as_csv_action()]
+class WraRecordAdmin(FTSSearchMixin, CachedCountMixin, admin.ModelAdmin):
+    actions = [PUBLISH_ACTION, EXPORT_ACTION, FAMILY_ACTION]
     list_display = (
         'wra_record_id', 'facility', 'familyno',
         'lastname', 'firstname', 'middleinitial', 'birthyear',
     )
     list_display_links = ('wra_record_id',)
-    list_filter = ('facility', 'assemblycenter', 'birthcountry',)
+    list_filter = (
+        ('facility', CachedValues),
+        ('assemblycenter', CachedValues),
+        ('birthcountry', CachedValues),
+    )
     search_fields = (
         'wra_record_id', 'facility',
         'lastname', 'firstname', 'middleinitial',
@@ -286,6 +360,9 @@ class WraRecordAdmin(admin.ModelAdmin):
         'citizenshipstatus', 'highestgrade', 'language', 'religion',
         'occupqual1', 'occupqual2', 'occupqual3', 'occuppotn1', 'occuppotn2',
     )
+    search_id_fields = (
+        'wra_record_id', 'wra_filenumber', 'familyno', 'individualno', 'person_id',
+    )
     autocomplete_fields = ['person',]
     readonly_fields = ('timestamp','wra_record_id', 'wra_filenumber','facility',)
     inlines = (RevisionInline,)
@@ -321,6 +398,9 @@ class WraRecordAdmin(admin.ModelAdmin):
         )}),
     )
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('person')
+
     def save_model(self, request, obj, form, change):
         # request.user and notes are used by Revision
         obj.user = request.user
@@ -340,8 +420,8 @@ class IreiRecordAdminForm(forms.ModelForm):
                 self.fields['person'].help_text = f'&#8618; <a href="{url}">{name}</a>'
 
 @admin.register(IreiRecord)
-class IreiRecordAdmin(admin.ModelAdmin):
-    actions = [export_as_csv_action()]
+class IreiRecordAdmin(FTSSearchMixin, CachedCountMixin, admin.ModelAdmin):
+    actions = [PUBLISH_ACTION, EXPORT_ACTION]
     list_display = (
         'person', 'irei_id',
         'name',
@@ -362,6 +442,7 @@ class IreiRecordAdmin(admin.ModelAdmin):
         'birthday',
         'camps',
     )
+    search_id_fields = ('irei_id', 'person_id',)
     # Without autocomplete on `person`, Django admin will try to load
     # *all* Person records into a dropdown menu, severely affecting performance!
     autocomplete_fields = ['person',]
@@ -386,6 +467,9 @@ class IreiRecordAdmin(admin.ModelAdmin):
         )}),
     )
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('person')
+
     def save_model(self, request, obj, form, change):
         # request.user and notes are used by Revision
         obj.user = request.user
@@ -409,6 +493,11 @@ class PersonLocationInline(admin.TabularInline):
     def has_change_permission(self, request, obj): return False
     def has_delete_permission(self, request, obj): return False
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related(
+            'person', 'location', 'facility'
+        )
+
 
 class PersonLocationAdminForm(forms.ModelForm):
     """Adds link to Person in Person field help_text"""
@@ -422,7 +511,7 @@ class PersonLocationAdminForm(forms.ModelForm):
                 self.fields['person'].help_text = f'&#8618; <a href="{url}">{name}</a>'
 
 @admin.register(PersonLocation)
-class PersonLocationAdmin(admin.ModelAdmin):
+class PersonLocationAdmin(CachedCountMixin, admin.ModelAdmin):
     list_display = (
         'person', 'location',
         'facility', 'facility_address',
@@ -447,6 +536,11 @@ class PersonLocationAdmin(admin.ModelAdmin):
         )}),
     )
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related(
+            'person', 'location', 'facility'
+        )
+
 
 class FarRecordInline(admin.TabularInline):
     model = FarRecord
@@ -516,16 +610,18 @@ class PersonAdminForm(forms.ModelForm):
 
 
 @admin.register(Person)
-class PersonAdmin(admin.ModelAdmin):
-    actions = [export_as_csv_action()]
+class PersonAdmin(FTSSearchMixin, CachedCountMixin, admin.ModelAdmin):
+    actions = [PUBLISH_ACTION, EXPORT_ACTION, FAMILY_ACTION]
     list_display = (
         'nr_id', 'family_name', 'given_name', 'preferred_name', 'gender',
         'birth_date', 'wra_family_no',
     )
     list_display_links = ('nr_id', 'family_name', 'given_name',)
     list_filter = (
-        'gender', 'citizenship',
-        'preexclusion_residence_state', 'postexclusion_residence_state',
+        ('gender', CachedValues),
+        ('citizenship', CachedValues),
+        ('preexclusion_residence_state', CachedValues),
+        ('postexclusion_residence_state', CachedValues),
     )
     date_hierarchy = 'birth_date'
     search_fields = (
@@ -548,6 +644,7 @@ class PersonAdmin(admin.ModelAdmin):
             'exclusion_order_title', 'exclusion_order_id',
             'bio_notes', 'admin_notes', 'lcnaf_url', 'snac_url', 'wikidata_url',
     )
+    search_id_fields = ('nr_id', 'wra_family_no', 'wra_individual_no',)
     inlines = [
         PersonLocationInline,
         FarRecordInline, WraRecordInline, RevisionInline,
@@ -6,6 +6,10 @@ import csv
 from io import StringIO
 
 from django.http import StreamingHttpResponse
+from django.urls import reverse
+from django.utils.html import format_html
+
+from . import jobs
 
 
 def keyset_pagination_iterator(input_queryset, batch_size=500):
@@ -49,3 +53,22 @@ def export_as_csv_action(description="Export selected rows to CSV"):
         return response
     export_as_csv.short_description = description
     return export_as_csv
+
+
+def enqueue_job_action(action, description):
+    """Admin action that queues a names.jobs job for the selected records
+    """
+    def enqueue_job(modeladmin, request, queryset):
+        ids = list(queryset.values_list('pk', flat=True))
+        job_id = jobs.enqueue(
+            action, modeladmin.model._meta.model_name, ids,
+            request.user.username
+        )
+        modeladmin.message_user(request, format_html(
+            'Queued <a href="{}">job {}</a>: {} ({} records)',
+            reverse('names:job', args=[job_id]), job_id, description, len(ids)
+        ))
+    # admin uses the function name to tell actions apart
+    enqueue_job.__name__ = f'enqueue_{action}'
+    enqueue_job.short_description = description
+    return enqueue_job
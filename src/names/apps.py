@@ -1,5 +1,32 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_migrate, post_save, pre_save
 
 
 class NamesConfig(AppConfig):
     name = 'names'
+
+    def ready(self):
+        from . import database
+        from . import family
+        from . import lookups
+        from . import paginators
+        from . import publisher
+        connection_created.connect(database.on_connect)
+        for model in self.get_models():
+            post_save.connect(paginators.count_saved, sender=model)
+            post_delete.connect(paginators.count_deleted, sender=model)
+        for model in publisher.PUBLISHED_MODELS:
+            post_save.connect(publisher.queue_saved, sender=model)
+            post_delete.connect(publisher.queue_deleted, sender=model)
+        for model in publisher.PERSON_RECORD_MODELS:
+            pre_save.connect(publisher.remember_person, sender=model)
+        for model in [self.get_model('Facility'), self.get_model('FarPage')]:
+            post_save.connect(lookups.invalidate, sender=model)
+            post_delete.connect(lookups.invalidate, sender=model)
+        post_migrate.connect(family.create_table, sender=self)
+        for model in self.get_models():
+            if model.__name__.lower() in family.FAMILIES:
+                pre_save.connect(family.remember_key, sender=model)
+                post_save.connect(family.refresh_saved, sender=model)
+                post_delete.connect(family.refresh_deleted, sender=model)
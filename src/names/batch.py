@@ -8,6 +8,7 @@ from elastictools import docstore, search
 from .converters import text_to_rolepeople, rolepeople_to_text
 from . import docstore
 from . import fileio
+from . import metrics
 from . import models
 from namesdb_public import models as models_public
 
@@ -34,7 +35,7 @@ def search_multi(csvfile, method, show_headers):
             'matching','sample'
         ]
         yield fileio.write_csv_str(headers)
-    for row in fileio.read_csv(csvfile):
+    for row in metrics.iterate('searchmulti.read', fileio.read_csv(csvfile)):
         items = []
         oid,fieldname,names = row
         # skip headers (TODO better to *read* headers)
@@ -43,7 +44,8 @@ def search_multi(csvfile, method, show_headers):
         if names == '':
             continue
         # text_to_rolepeople?
-        data = text_to_rolepeople(names, PERSONS_DEFAULT_DICT)
+        with metrics.timer('searchmulti.parse'):
+            data = text_to_rolepeople(names, PERSONS_DEFAULT_DICT)
         # if we have an nr_id, just get the Person
         for item in data:
             item['oid'] = oid
@@ -62,19 +64,22 @@ def search_multi(csvfile, method, show_headers):
             namepart = item['namepart']
             if 'nr_id' in item.keys():
                 # exact match
-                if method == 'elastic':
-                    record = es_class.get(nr_id, request=None)
-                elif method == 'sql':
-                    record = get_sql(item['nr_id'])
+                with metrics.timer('searchmulti.get') as stage:
+                    if method == 'elastic':
+                        record = es_class.get(nr_id, request=None)
+                    elif method == 'sql':
+                        record = get_sql(item['nr_id'])
+                    stage.rows += 1
                 n,preferred_name,nr_id,score = (
                     0,record['preferred_name'],item['nr_id'],100.0
                 )
                 yield format_result(oid, item, n, preferred_name, nr_id, score)
             else:
                 # fulltext search
-                for n,preferred_name,nr_id,score in search(
-                        prep_names(item['namepart'])
-                ):
+                with metrics.timer(f'searchmulti.search.{method}') as stage:
+                    results = list(search(prep_names(item['namepart'])))
+                    stage.rows += len(results)
+                for n,preferred_name,nr_id,score in results:
                     item['nr_id'] = nr_id
                     yield format_result(
                         oid, item, n, preferred_name, nr_id, score
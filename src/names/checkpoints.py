@@ -0,0 +1,115 @@
+"""Checkpoints for long namesdb runs (load, loadirei, post)
+
+Each run records its parameters, how far it has committed (a row offset
+for loads, the last primary key for posts), and the IDs or offsets that
+failed, in the state database (see names.statedb).  A run that stops
+part way can be continued with --resume JOBID, and --retry-failed JOBID
+processes only the rows that failed.  A run that reaches the end is done,
+or ended if some rows failed; it is done once a retry of its failures
+succeeds.  Retrying the failures of an unfinished run leaves it running so
+it can still be resumed.
+
+    namesdb load person people.csv gjost
+    ...
+    Checkpoint 12 (continue with --resume 12)
+"""
+
+from contextlib import closing
+import json
+
+from . import statedb
+
+RUNNING = 'running'
+ENDED = 'ended'  # reached the end, some rows failed
+DONE = 'done'
+
+
+class CheckpointError(Exception):
+    pass
+
+
+def start(command, params):
+    """Record the start of a run
+
+    @param params: dict JSON-serializable parameters needed to resume
+    @returns: int checkpoint ID
+    """
+    with closing(statedb.connect()) as conn, conn:
+        cursor = conn.execute(
+            'INSERT INTO checkpoints (command, params) VALUES (?, ?)',
+            (command, json.dumps(params))
+        )
+        return cursor.lastrowid
+
+def get(checkpoint_id, command=None):
+    """@returns: dict with id, command, params, position, failed, status"""
+    with closing(statedb.connect()) as conn, conn:
+        row = conn.execute(
+            'SELECT * FROM checkpoints WHERE id=?', (checkpoint_id,)
+        ).fetchone()
+    if not row:
+        raise CheckpointError(f'No checkpoint {checkpoint_id}')
+    if command and row['command'] != command:
+        raise CheckpointError(
+            f'Checkpoint {checkpoint_id} is for "{row["command"]}", not "{command}"'
+        )
+    return {
+        'id': row['id'],
+        'command': row['command'],
+        'params': json.loads(row['params']),
+        'position': row['position'],
+        'failed': json.loads(row['failed']),
+        'status': row['status'],
+    }
+
+def advance(checkpoint_id, position, failed=None):
+    """Record a committed position and any new failures"""
+    failed = failed or []
+    with closing(statedb.connect()) as conn, conn:
+        row = conn.execute(
+            'SELECT failed FROM checkpoints WHERE id=?', (checkpoint_id,)
+        ).fetchone()
+        all_failed = json.loads(row['failed'])
+        known = set(all_failed)
+        all_failed += [f for f in failed if f not in known]
+        conn.execute(
+            'UPDATE checkpoints SET position=?, failed=?, '
+            'updated=CURRENT_TIMESTAMP WHERE id=?',
+            (str(position), json.dumps(all_failed), checkpoint_id)
+        )
+
+def set_failed(checkpoint_id, failed):
+    """Replace the list of failures e.g. after retrying them"""
+    with closing(statedb.connect()) as conn, conn:
+        conn.execute(
+            'UPDATE checkpoints SET failed=?, updated=CURRENT_TIMESTAMP WHERE id=?',
+            (json.dumps(list(failed)), checkpoint_id)
+        )
+
+def finish(checkpoint_id, status=DONE):
+    with closing(statedb.connect()) as conn, conn:
+        conn.execute(
+            'UPDATE checkpoints SET status=?, updated=CURRENT_TIMESTAMP WHERE id=?',
+            (status, checkpoint_id)
+        )
+
+def end(checkpoint, failed, retry=False):
+    """Record how a run, or a retry of its failures, ended
+
+    @param checkpoint: dict from get() at the start of the run
+    @param failed: list Failures of this run
+    @param retry: bool The run retried checkpoint's failures
+    @returns: str status
+    """
+    if retry:
+        set_failed(checkpoint['id'], failed)
+        if checkpoint['status'] == ENDED and not failed:
+            finish(checkpoint['id'])
+            return DONE
+        return checkpoint['status']
+    # includes failures from before the run was resumed
+    if get(checkpoint['id'])['failed']:
+        finish(checkpoint['id'], ENDED)
+        return ENDED
+    finish(checkpoint['id'])
+    return DONE
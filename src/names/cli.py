@@ -9,10 +9,22 @@ Sample usage:
     # Copy SQLite3 database, removing Django-specific tables
     $ namesdb exportdb
 
+    # Create full-text indexes used by admin search
+    $ namesdb fts person
+
+    # Report missing/unused indexes and create missing ones
+    $ namesdb indexes --apply
+
+    # Statements that take the most time, with query plans and N+1 flags
+    $ namesdb sqlreport
+
     # Create and destroy Elasticsearch indexes
     $ namesdb create -H localhost:9200
     $ namesdb destroy -H localhost:9200 --confirm
 
+    # Rebuild indexes with no downtime (alias swap)
+    $ namesdb reindex -H localhost:9200
+
     # Check status
     $ namesdb status -H localhost:9200
 
@@ -27,57 +39,183 @@ Sample usage:
     # Get record JSON from Elasticsearch
     $ namesdb get -H localhost:9200 person 0a1b2c3d4e
     
+    # Find (and fix) documents with no record and records with no document
+    $ namesdb reconcile -H localhost:9200 --delete --post
+
     # Delete records from Elasticsearch
     $ namesdb delete -H localhost:9200 person 0a1b2c3d4e
 
+    # Run many commands in one process (JSON lines in, JSON lines out)
+    $ namesdb serve < commands.jsonl > results.jsonl
+
 Note: You can set environment variables for HOSTS and INDEX.:
 
     $ export ES_HOSTS=localhost:9200
 
 """
 
+from contextlib import contextmanager
 from datetime import datetime, date
-from http import HTTPStatus
+import importlib
 import json
 from pathlib import Path
 import os
-import shutil
-import sqlite3
 import sys
 
 import click
-from dateutil import parser
-# Django must be initialized before settings can be accessed
+# Settings can be read without initializing Django; commands that use
+# models or the database initialize it when they first touch a module below.
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'editor.settings')
-import django
-django.setup()
-from django.conf import settings
-import httpx
-from tqdm import tqdm
-
-from . import batch
-from . import csvfile
-from . import docstore
-from . import fileio
-from . import models
-from . import noidminter
-from . import publish
-from namesdb_public import models as models_public
-from ireizo_public import models as models_ireizo
+
+from . import INDEX_PREFIX
+
+
+class LazySettings():
+    """django.conf.settings, imported and loaded the first time it is read
+
+    Importing django.conf and reading the config files costs more than the
+    rest of `namesdb help`.
+    """
+
+    def __getattr__(self, attr):
+        from django.conf import settings
+        return getattr(settings, attr)
+
+settings = LazySettings()
+
+def django_setup():
+    """Initialize Django, once"""
+    from django.apps import apps
+    if not apps.ready:
+        import django
+        django.setup()
+
+class LazyModule():
+    """Module that is imported the first time one of its attributes is used
+
+    Importing the models (and through them Django, elasticsearch-dsl, and
+    namesdb-public) takes most of namesdb's startup time; commands like
+    help and conf never pay for it.
+    """
+
+    def __init__(self, name, django=True):
+        self._name = name
+        self._django = django
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            if self._django:
+                django_setup()
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+def tqdm(*args, **kwargs):
+    from tqdm import tqdm as tqdm_
+    return tqdm_(*args, **kwargs)
+
+parser = LazyModule('dateutil.parser', django=False)
+batch = LazyModule('names.batch')
+cmdserver = LazyModule('names.cmdserver', django=False)
+checkpoints = LazyModule('names.checkpoints')
+csvfile = LazyModule('names.csvfile', django=False)
+database = LazyModule('names.database')
+dates = LazyModule('names.dates', django=False)
+docstore = LazyModule('names.docstore')
+export = LazyModule('names.export', django=False)
+family_ = LazyModule('names.family')
+fileio = LazyModule('names.fileio', django=False)
+fingerprints = LazyModule('names.fingerprints')
+fts_ = LazyModule('names.fts')
+indexes_ = LazyModule('names.indexes')
+jobs = LazyModule('names.jobs')
+metrics = LazyModule('names.metrics', django=False)
+models = LazyModule('names.models')
+noidminter = LazyModule('names.noidminter')
+paginators = LazyModule('names.paginators')
+profiling = LazyModule('names.profiling', django=False)
+publicdb = LazyModule('names.publicdb', django=False)
+publish = LazyModule('names.publish')
+query_ = LazyModule('names.query')
+reconcile_ = LazyModule('names.reconcile', django=False)
+reindex_ = LazyModule('names.reindex')
+snapshot_ = LazyModule('names.snapshot')
+writer = LazyModule('names.writer')
+sqllog = LazyModule('names.sqllog')
+models_public = LazyModule('namesdb_public.models')
+models_ireizo = LazyModule('ireizo_public.models')
 
 CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 
+# Option choices, here so that parsing options doesn't import the modules
+# (names.tests checks that they match)
+PROFILERS = ['cprofile', 'pyinstrument', 'tracemalloc']  # profiling.PROFILERS
+EXPORT_FORMATS = ['csv', 'jsonl', 'parquet', 'arrow']  # export.FORMATS
+EXPORT_COMPRESSIONS = ['gzip', 'zstd']  # export.COMPRESSIONS
+
+# Commands that never read settings, so they don't record metrics or SQL
+NO_SETTINGS = ['help', 'url']
+
 
 @click.group(context_settings=CONTEXT_SETTINGS)
 @click.option('--debug','-d', is_flag=True, default=False)
-def namesdb(debug):
+@click.option('--profile', type=click.Choice(PROFILERS), default=None,
+              help='Profile the command, writing results to PROFILE_DIR.')
+@click.pass_context
+def namesdb(ctx, debug, profile):
     """namesdb - Tools for working with FAR and WRA records
 
     \b
     See "namesdb help" for examples.
+    
+    \b
+    Profile any command:
+        namesdb --profile cprofile post -H localhost:9200 person
+        namesdb --profile tracemalloc load person people.csv gjost
     """
     if debug:
         click.echo('Debug mode is on')
+    if ctx.invoked_subcommand not in NO_SETTINGS:
+        if settings.SQL_LOG:
+            ctx.with_resource(sqllog.capture(f'cli:{ctx.invoked_subcommand}'))
+        metrics.start(ctx.invoked_subcommand)
+        ctx.call_on_close(_export_metrics)
+    if profile:
+        ctx.with_resource(_profiling(profile, ctx.invoked_subcommand))
+
+@contextmanager
+def _profiling(kind, command):
+    """Run the command under a profiler and say where the results went"""
+    try:
+        stop = profiling.start(kind)
+    except ImportError as err:
+        click.echo(f'ERROR: {err} (pip install {kind})', err=True)
+        sys.exit(1)
+    try:
+        yield
+    finally:
+        base = profiling.path_base(settings.PROFILE_DIR, f'namesdb-{command}-{kind}')
+        for path in stop(base):
+            click.echo(f'Profile: {path}', err=True)
+
+def _export_metrics():
+    """Write the run's stage timings wherever settings.METRICS_* say"""
+    run = metrics.finish()
+    if settings.METRICS_LOG:
+        metrics.write_log(settings.METRICS_LOG, run)
+    if settings.METRICS_SPANS:
+        metrics.write_spans(settings.METRICS_SPANS, run)
+    if settings.METRICS_TEXTFILE_DIR:
+        metrics.write_textfile(settings.METRICS_TEXTFILE_DIR, run)
+
+def _show_stages(enabled):
+    """Print the time spent in each stage when the command finishes"""
+    if not enabled:
+        return
+    def show():
+        for line in metrics.report():
+            click.echo(line, err=True)
+    click.get_current_context().call_on_close(show)
 
 @namesdb.command()
 def help():
@@ -116,29 +254,44 @@ def schema(model):
 @namesdb.command()
 @click.option('--debug','-d', is_flag=True, default=False)
 @click.option('--idfile','-i', default=None, help='Load primary keys from file (one per line)')
-@click.option('--search','-s', default=None, help='Search terms: "field=TERM;field=TERM;..."')
+@click.option('--search','-s', default=None, help='Search terms: "field=TERM;field>=TERM;..."')
 @click.option('--searchfile','-S', default=None, help='Search terms from file.')
 @click.option('--cols','-c', default=None, help='Fields to export: "family_name,given_name,..."')
 @click.option('--colsfile','-C', default=None, help='Fields to export, from file.')
 @click.option('--limit','-l', default=None, help='Limit number of records.')
+@click.option('--format','-f', 'fmt', default='csv',
+              type=click.Choice(EXPORT_FORMATS), help='Output format.')
+@click.option('--compress','-z', default=None,
+              type=click.Choice(EXPORT_COMPRESSIONS), help='Compress output.')
+@click.option('--output','-o', default=None, help='Write to file instead of STDOUT.')
+@click.option('--explain','-e', is_flag=True, default=False,
+              help='Print the SQLite query plan for the search and quit.')
 @click.argument('model')
-def dump(debug, idfile, search, searchfile, cols, colsfile, limit, model):
-    """Dump model data to STDOUT
+def dump(debug, idfile, search, searchfile, cols, colsfile, limit, fmt, compress, output, explain, model):
+    """Dump model data to STDOUT (or a file)
     
     \b
-    You can search using Django field lookups:
-    https://docs.djangoproject.com/en/4.0/ref/models/querysets/#field-lookups
     Use -s/--search to search a small number of fields from the command-line
     or -S/--searchfile to get search terms from a file.
+    Terms are separated by semicolons or newlines.
+        last_name=Morita               exact match
+        last_name~mori                 case-insensitive substring
+        last_name^Mori                 prefix
+        birth_date>=1920-01-01         also >, <, <=
+        birth_date=1920-01-01..1929-12-31   range (inclusive)
+        facility=Manzanar|Poston       any of these values
+        notes=                         empty
+        match=yasui min                full-text (see `namesdb fts`)
     Search (one line):
-        last_name=Morita; first_name=Noriyuki; birth_date__icontains=1932
+        last_name=Morita; first_name=Noriyuki; birth_date~1932
     Search (multiple lines):
         last_name=Morita
         first_name=Noriyuki
-        birth_date__icontains=1932
-    Search (mixed):
-        last_name=Morita; first_name=Noriyuki
-        birth_date__icontains=1932
+        birth_date~1932
+    
+    \b
+    Use -e/--explain to see whether a search can use an index:
+        namesdb dump farrecord -s "family_number=12345" --explain
     
     \b
     Use -c/--cols to specify output columns from the command-line
@@ -152,6 +305,13 @@ def dump(debug, idfile, search, searchfile, cols, colsfile, limit, model):
     Columns (mixed):
         last_name,first_name
         birth_date
+    
+    \b
+    Output is streamed in CSV (default), JSONL, Parquet, or Arrow format.
+    Parquet and Arrow require pyarrow; zstd compression requires zstandard.
+    Parquet is compressed internally and must be written with -o/--output.
+        namesdb dump farrecord -f jsonl -z gzip > farrecords.jsonl.gz
+        namesdb dump farrecord -f parquet -z zstd -o farrecords.parquet
     """
     # model
     model_class = models.MODEL_CLASSES[model]
@@ -174,9 +334,21 @@ def dump(debug, idfile, search, searchfile, cols, colsfile, limit, model):
     # search
     if searchfile:
         with Path(searchfile).open('r') as f:
-            search = _parse_search(f.read().strip(), debug)
-    elif search:
-        search = _parse_search(search, debug)
+            search = f.read().strip()
+    q = None
+    if search:
+        try:
+            terms = query_.parse(model_class, search)
+            q = query_.to_q(model_class, terms)
+        except query_.QueryError as err:
+            click.echo(f'ERROR: {err}', err=True)
+            sys.exit(1)
+        if debug: click.echo(f'search {q}', err=True)
+        _check_plan(model_class, q, terms, explain)
+    if explain:
+        if not search:
+            click.echo('ERROR: --explain requires -s/--search.', err=True)
+        return
     # columns
     if colsfile:
         with Path(colsfile).open('r') as f:
@@ -188,32 +360,44 @@ def dump(debug, idfile, search, searchfile, cols, colsfile, limit, model):
     if id_fieldname not in columns:
         columns.insert(0, id_fieldname)
     if debug: print(f'columns {columns}')
+    bad_columns = export.check_columns(model_class, columns)
+    if bad_columns:
+        click.echo(f'ERROR: Not fields of {model}: {bad_columns}', err=True)
+        sys.exit(1)
+    if fmt == 'parquet' and not output:
+        click.echo('ERROR: Parquet output requires -o/--output.', err=True)
+        sys.exit(1)
     # limit
     if limit:
         limit = int(limit)
     if debug: print(f'limit {limit}')
     # dump!
-    models.dump_csv(sys.stdout, model_class, ids, search, columns, limit, debug)
+    query = export.queryset(model_class, ids, q, limit)
+    num = export.export(model_class, columns, query, fmt, output, compress)
+    if debug: click.echo(f'{num} rows', err=True)
 
-def _parse_search(text, debug=False):
-    if debug:
-        click.echo(f'search "{text}"')
-    queries = []
-    for line in text.splitlines():
-        for term in line.split(';'):
-            queries.append(term)
-    params = {}
-    for terms in queries:
-        if terms.strip():
-            try:
-                key,val = terms.strip().split('=')
-                params[key.strip()] = val.strip()
-            except ValueError as err:
-                click.echo(f'Malformed search (see help): "{search}"')
-                sys.exit(1)
-    if debug:
-        click.echo(f'search "{params}"')
-    return params
+def _check_plan(model_class, q, terms, explain=False):
+    """Warn if search will scan whole tables; with explain print plan and
+    offer to index the searched columns
+    """
+    plan = database.explain(model_class.objects.filter(q))
+    if explain:
+        click.echo(database.format_plan(plan))
+    scans = database.full_scans(plan)
+    table = model_class._meta.db_table
+    if not scans:
+        return
+    click.echo(f'WARNING: full table scan of {", ".join(scans)}', err=True)
+    columns = query_.indexable_columns(model_class, terms)
+    if not (explain and columns and table in scans):
+        return
+    for column in columns:
+        name = database.index_name(table, [column])
+        if click.confirm(f'Create index {name}?', default=False, err=True):
+            database.create_index(table, [column])
+    click.echo(
+        database.format_plan(database.explain(model_class.objects.filter(q)))
+    )
 
 def _parse_columns(text, debug=False):
     if debug:
@@ -230,16 +414,24 @@ NOTE_DEFAULT = 'Load from CSV'
 
 @namesdb.command()
 @click.option('--debug','-d', is_flag=True, default=False)
-@click.option('--batchsize','-b', default=settings.NOIDMINTER_BATCH_SIZE,
+@click.option('--batchsize','-b', default=lambda: settings.NOIDMINTER_BATCH_SIZE,
               help='Batch size for requesting new Person.nr_ids.')
+@click.option('--commit-every', 'batch_size', default=lambda: settings.LOAD_BATCH_SIZE,
+              help='Rows saved per transaction.')
 @click.option('--offset','-o', default=0, help='Start at specified record.')
 @click.option('--limit','-l', default=1_000_000, help='Limit number of records.')
 @click.option('--note','-n', default=NOTE_DEFAULT,
               help=f'Optional note (default: "{NOTE_DEFAULT}".')
-@click.argument('model')
-@click.argument('datafile')
-@click.argument('username')
-def load(debug, batchsize, offset, limit, note, model, datafile, username):
+@click.option('--resume','-R', default=None, type=int,
+              help='Continue the run with this checkpoint ID.')
+@click.option('--retry-failed', default=None, type=int,
+              help='Load only the rows that failed in this checkpoint ID.')
+@click.option('--stages', is_flag=True, default=False,
+              help='Print time spent in each stage at the end.')
+@click.argument('model', required=False)
+@click.argument('datafile', required=False)
+@click.argument('username', required=False)
+def load(debug, batchsize, batch_size, offset, limit, note, resume, retry_failed, stages, model, datafile, username):
     """Load data from a data file
     
     See names.models.MODEL_CLASSES
@@ -258,9 +450,20 @@ def load(debug, batchsize, offset, limit, note, model, datafile, username):
     \b
     Load Facility data from densho-vocab
         namesdb load facility /opt/densho-vocab/api/0.2/facility.json USERNAME
+    
+    \b
+    CSV loads are checkpointed; continue a run that stopped, or load
+    only the rows that failed, using the checkpoint ID it printed:
+        namesdb load --resume 12
+        namesdb load --retry-failed 12
     """
+    _show_stages(stages)
+    database.use_profile('bulk-load')
+    if not (resume or retry_failed or (model and datafile and username)):
+        click.echo('ERROR: MODEL DATAFILE USERNAME are required.')
+        sys.exit(1)
     available_models = list(models.MODEL_CLASSES.keys())
-    if model not in available_models:
+    if model and model not in available_models:
         click.echo(f'ERROR: Bad model "{model}".')
         click.echo(f'Choices: {", ".join(available_models)}')
         sys.exit(1)
@@ -268,22 +471,77 @@ def load(debug, batchsize, offset, limit, note, model, datafile, username):
         offset = int(offset)
     if limit:
         limit = int(limit)
+    job = None
+    if resume or retry_failed or model not in ['ireirecord', 'facility']:
+        job,params = _checkpoint('load', resume, retry_failed, {
+            'model': model, 'datafile': str(Path(datafile).absolute()) if datafile else None,
+            'username': username, 'note': note, 'offset': offset, 'limit': limit,
+        })
+        model,datafile,username,note,offset,limit = [
+            params[key] for key in
+            ['model', 'datafile', 'username', 'note', 'offset', 'limit']
+        ]
     sql_class = models.MODEL_CLASSES[model]
     if model == 'ireirecord':
         load_irei(datafile, sql_class, username, note)
     elif model == 'facility':
-        load_facility(datafile, sql_class, username, note)
+        load_facility(datafile, sql_class, username, note, batch_size)
     else:
-        load_csv(datafile, sql_class, offset, limit, username, note)
+        # rebuild families once at the end instead of after every record
+        with family_.deferred(model):
+            load_csv(
+                datafile, sql_class, offset, limit, username, note, batch_size,
+                job, retry=bool(retry_failed)
+            )
+
+def _checkpoint(command, resume, retry_failed, params):
+    """Start a checkpoint for a new run, or get the one to resume or retry
 
-def load_csv(datafile, sql_class, offset, limit, username, note):
+    @returns: (dict checkpoint, dict params of the run)
+    """
+    if resume or retry_failed:
+        try:
+            job = checkpoints.get(resume or retry_failed, command)
+        except checkpoints.CheckpointError as err:
+            click.echo(f'ERROR: {err}')
+            sys.exit(1)
+        if retry_failed and not job['failed']:
+            click.echo(f'Nothing failed in checkpoint {job["id"]}.')
+            sys.exit(0)
+        return job, job['params']
+    job = checkpoints.get(checkpoints.start(command, params))
+    click.echo(f'Checkpoint {job["id"]} (continue with --resume {job["id"]})')
+    return job, params
+
+def load_csv(datafile, sql_class, offset, limit, username, note, batch_size, job=None, retry=False):
+    """Load rows from a CSV file, checkpointing each batch
+    
+    @param job: dict Checkpoint; rows up to job['position'] are skipped
+    @param retry: bool Load only the rows in job['failed']
+    """
     prepped_data = sql_class.prep_data()
-    rowds = csvfile.make_rowds(
-        fileio.read_csv(datafile, offset, limit)
-    )
+    start = offset
+    if job and job['position'] and not retry:
+        start = int(job['position']) + 1
+        click.echo(f'Resuming at row {start}')
+    with metrics.span('load.read') as stage:
+        rowds = csvfile.make_rowds(
+            fileio.read_csv(datafile, start, limit - (start - offset))
+        )
+        stage.rows += len(rowds)
+        stage.bytes += Path(datafile).stat().st_size
+    keys = list(range(start, start + len(rowds)))  # row offsets in file
+    if retry:
+        retry_keys = set(job['failed'])
+        pairs = [(key, rowd) for key,rowd in zip(keys, rowds) if key in retry_keys]
+        keys = [key for key,rowd in pairs]
+        rowds = [rowd for key,rowd in pairs]
     num = len(rowds)
-    processed = 0
-    failed = []
+    # parse each distinct date once, before the per-row loop
+    with metrics.span('load.dates'):
+        _,date_report = dates.parse_columns(
+            rowds, dates.DATE_COLUMNS.get(sql_class.__name__.lower(), [])
+        )
     noids = []
     if sql_class.__name__ == 'Person':  # How many NOIDs are needed
         # rowds with empty 'nr_id' fields
@@ -291,45 +549,73 @@ def load_csv(datafile, sql_class, offset, limit, username, note):
         if noids_to_get:
             # get from ddridservice in batch
             click.echo(f"Getting {noids_to_get} NRIDS")
-            noids = noidminter.get_noids(noids_to_get)
+            with metrics.span('load.noids') as stage:
+                noids = noidminter.get_noids(noids_to_get)
+                stage.rows += len(noids)
     noids_assigned = 0
-    for n,rowd in enumerate(tqdm(
-            rowds, desc='Writing database', ascii=True, unit='record'
-    )):
+    for rowd in rowds:
         if (sql_class.__name__ == 'Person') and not rowd['nr_id']:
             rowd['nr_id'] = noids.pop(0)
             noids_assigned += 1
-        try:
-            o,prepped_data = sql_class.load_rowd(rowd, prepped_data)
-            if o:
-                o.save(username=username, note=note)
-        except:
-            err = sys.exc_info()[0]
-            click.echo(f'FAIL {rowd} {err}')
-            failed.append( (n,rowd, err) )
-            raise
-        processed = processed + 1
-        if processed > limit:
-            break
-    if failed:
-        click.echo('FAILED ROWS')
-    for f in failed:
-        click.echo(f)
+    def save(rowd):
+        nonlocal prepped_data
+        # load_rowd pops fields; a copy keeps rowd intact for retries
+        o,prepped_data = sql_class.load_rowd(dict(rowd), prepped_data)
+        if o:
+            o.save(username=username, note=note)
+    _write(rowds, save, batch_size, keys, job, retry)
+    for line in date_report.lines():
+        click.echo(line)
 
-def load_facility(datafile, sql_class, username, note):
+def load_facility(datafile, sql_class, username, note, batch_size):
     """Load data files from densho-vocab/api/0.2/facility.json
     """
     with Path(datafile).open('r') as f:
         rowds = json.loads(f.read())['terms']
-    for n,rowd in enumerate(rowds):
-        try:
-            o = sql_class.load_from_vocab(rowd)
-            if o:
-                o.save()
-        except:
-            err = sys.exc_info()[0]
-            click.echo(f'FAIL {rowd} {err}')
-            raise
+    def save(rowd):
+        o = sql_class.load_from_vocab(rowd)
+        if o:
+            o.save()
+    _write(rowds, save, batch_size, list(range(len(rowds))))
+
+def _write(rowds, save, batch_size, keys, job=None, retry=False):
+    """Save rows in batches with a progress bar, report failures and throughput
+    
+    @param keys: list Row offsets or IDs recorded in the checkpoint
+    @param job: dict Checkpoint to advance after each batch (optional)
+    @param retry: bool Rows are retries; replace job's failures when done
+    """
+    with tqdm(total=len(rowds), desc='Writing database', ascii=True, unit='record') as bar:
+        def committed(result):
+            bar.update(result.committed - bar.n)
+            if job and not retry:
+                checkpoints.advance(
+                    job['id'], keys[result.committed - 1],
+                    [keys[n] for n,rowd,err in result.failed]
+                )
+        # recount admin row counts once at the end, not after every row
+        with metrics.span('write', batch_size=batch_size) as stage, \
+             paginators.deferred():
+            result = writer.write(rowds, save, batch_size, progress=committed)
+            stage.rows += result.written
+    if result.failed:
+        click.echo('FAILED ROWS')
+    for n,rowd,err in result.failed:
+        click.echo(f'FAIL {keys[n]} {rowd} {err!r}')
+    click.echo(result.summary())
+    if job:
+        status = checkpoints.end(
+            job, [keys[n] for n,rowd,err in result.failed], retry
+        )
+        _echo_checkpoint(job, status)
+    return result
+
+def _echo_checkpoint(job, status):
+    """Say how to continue a run that isn't done"""
+    if status == checkpoints.ENDED:
+        click.echo(f'Retry failures with --retry-failed {job["id"]}')
+    elif status == checkpoints.RUNNING:
+        click.echo(f'Continue the run with --resume {job["id"]}')
 
 @namesdb.command()
 @click.option('--debug','-d', is_flag=True, default=False)
@@ -337,9 +623,17 @@ def load_facility(datafile, sql_class, username, note):
               help='(YYYY-MM-DD) Date data was fetched if not today.')
 @click.option('--dryrun','-D', is_flag=True, default=False,
               help="Don't write to database.")
-@click.argument('output')
-@click.argument('username')
-def loadirei(debug, fetchdate, dryrun, output, username):
+@click.option('--commit-every', 'batch_size', default=lambda: settings.LOAD_BATCH_SIZE,
+              help='Rows saved per transaction.')
+@click.option('--resume','-R', default=None, type=int,
+              help='Continue the run with this checkpoint ID.')
+@click.option('--retry-failed', default=None, type=int,
+              help='Load only the records that failed in this checkpoint ID.')
+@click.option('--stages', is_flag=True, default=False,
+              help='Print time spent in each stage at the end.')
+@click.argument('output', required=False)
+@click.argument('username', required=False)
+def loadirei(debug, fetchdate, dryrun, batch_size, resume, retry_failed, stages, output, username):
     """Load data files from JSONL output from irei-fetch
 
     \b
@@ -359,7 +653,24 @@ def loadirei(debug, fetchdate, dryrun, output, username):
     Usage
     export TODAY=`date +%Y%m%d`
     namesdb loadirei /opt/ireizo-fetch/output/$TODAY/ gjost | tee -a log/$TODAY-irei-import.log
+
+    \b
+    Continue a run that stopped, or load only the records that failed:
+        namesdb loadirei --resume 12
+        namesdb loadirei --retry-failed 12
     """
+    _show_stages(stages)
+    database.use_profile('bulk-load')
+    if not (resume or retry_failed or (output and username)):
+        click.echo('ERROR: OUTPUT USERNAME are required.')
+        sys.exit(1)
+    job,params = _checkpoint('loadirei', resume, retry_failed, {
+        'output': str(Path(output).absolute()) if output else None,
+        'username': username, 'fetchdate': str(fetchdate), 'dryrun': dryrun,
+    })
+    output,username,fetchdate,dryrun = [
+        params[key] for key in ['output', 'username', 'fetchdate', 'dryrun']
+    ]
     if fetchdate:
         fetchdate = parser.parse(fetchdate)
     if Path(output).is_dir():
@@ -368,45 +679,162 @@ def loadirei(debug, fetchdate, dryrun, output, username):
         paths = [Path(output)]
     rowds_api = []
     rowds_wall = []
-    for n,path in enumerate(paths):
-        if not '.jsonl' in path.name:
-            continue
-        with path.open('r') as f:
-            rowds = [json.loads(line) for line in f.readlines()]
-        if 'api-people' in path.name:
-            for rowd in rowds:
-                rowds_api.append(rowd)
-        elif 'pubsite-people' in path.name:
-            for rowd in rowds:
-                rowds_wall.append(rowd)
+    with metrics.span('loadirei.read') as stage:
+        for n,path in enumerate(paths):
+            if not '.jsonl' in path.name:
+                continue
+            with path.open('r') as f:
+                rowds = [json.loads(line) for line in f.readlines()]
+            stage.rows += len(rowds)
+            stage.bytes += path.stat().st_size
+            if 'api-people' in path.name:
+                for rowd in rowds:
+                    rowds_api.append(rowd)
+            elif 'pubsite-people' in path.name:
+                for rowd in rowds:
+                    rowds_wall.append(rowd)
     click.echo(
         f"{n} files - {len(rowds_api)} API records - {len(rowds_wall)} wall records"
     )
     # merge data and save objects
-    irei_records = models.IreiRecord.load_irei_data(rowds_api, rowds_wall)
+    with metrics.span('loadirei.merge') as stage:
+        irei_records = models.IreiRecord.load_irei_data(rowds_api, rowds_wall)
+        stage.rows += len(irei_records)
     click.echo(f"{len(irei_records)=}")
-    start = datetime.now()
-    n = 0
-    num = len(irei_records.keys())
-    updated = 0
-    for irei_id,rowd in irei_records.items():
-        n += 1
+    with metrics.span('loadirei.dates'):
+        _,date_report = dates.parse_columns(
+            list(irei_records.values()), dates.DATE_COLUMNS['ireirecord']
+        )
+    feedbacks = {}
+    def save(rowd):
+        # save_record pops fields; a copy keeps rowd intact for retries
         feedback = models.IreiRecord.save_record(
-            rowd, fetchdate=fetchdate, dryrun=dryrun
+            dict(rowd), fetchdate=fetchdate, dryrun=dryrun
         )
         if feedback:
-            updated += 1
-            click.echo(f"{n}/{num} {irei_id} {feedback}")
-    click.echo(f"{updated} updated in {datetime.now() - start}")
+            feedbacks[rowd['irei_id']] = feedback
+    keys = list(irei_records.keys())
+    if retry_failed:
+        retry_keys = set(job['failed'])
+        keys = [key for key in keys if key in retry_keys]
+    elif job['position']:
+        if job['position'] not in irei_records:
+            click.echo(f'ERROR: {job["position"]} is not in {output}.')
+            sys.exit(1)
+        keys = keys[keys.index(job['position']) + 1:]
+        click.echo(f'Resuming after {job["position"]}')
+    _write(
+        [irei_records[key] for key in keys], save, batch_size, keys,
+        job, retry=bool(retry_failed)
+    )
+    for irei_id,feedback in feedbacks.items():
+        click.echo(f"{irei_id} {feedback}")
+    click.echo(f"{len(feedbacks)} updated")
+    for line in date_report.lines():
+        click.echo(line)
 
 @namesdb.command()
 @click.option('--hosts','-H', envvar='ES_HOST', help='Elasticsearch hosts.')
 def create(hosts):
     """Create specified Elasticsearch index and upload mappings.
     """
-    docstore.DocstoreManager(
-        models.INDEX_PREFIX, hosts_index(hosts), settings
-    ).create_indices()
+    ds = docstore_manager(hosts)
+    ds.create_indices()
+    _clear_fingerprints(ds)
+
+def _clear_fingerprints(ds):
+    """Forget what was posted to the indices, which are new or gone"""
+    for model in models.ELASTICSEARCH_CLASSES_BY_MODEL.keys():
+        fingerprints.clear(ds.index_name(model))
+
+@namesdb.command()
+@click.option('--hosts','-H', envvar='ES_HOST', help='Elasticsearch hosts.')
+@click.option('--delete-old','-D', is_flag=True, default=False,
+              help='Delete the previous indices after the swap.')
+@click.argument('model', nargs=-1)
+def reindex(hosts, delete_old, model):
+    """Rebuild indices in the background and swap them in atomically
+    
+    \b
+    Builds a new versioned index per model, loads it with the bulk API
+    (no refresh, no replicas), then moves the names* alias to it. The
+    public site keeps serving the old index until the swap.
+        namesdb reindex -H localhost:9200
+        namesdb reindex -H localhost:9200 person farrecord --delete-old
+    """
+    model_names = [model_w_abbreviations(m) for m in model] or reindex_.MODELS
+    for m in model_names:
+        if m not in reindex_.MODELS:
+            click.echo(f'ERROR: Bad model "{m}". Choices: {reindex_.MODELS}')
+            sys.exit(1)
+    ds = docstore_manager(hosts)
+    database.use_profile('read-only-publish')
+    for m in model_names:
+        bar = tqdm(desc=m, ascii=True, unit='record')
+        index,num,failed = reindex_.reindex(
+            ds, m, lambda done: bar.update(done - bar.n), delete_old
+        )
+        bar.close()
+        if failed:
+            click.echo(f'{m}: {len(failed)} of {num} failed, kept old index: {failed[:20]}')
+        else:
+            click.echo(f'{ds.index_name(m)} -> {index} ({num} records)')
+
+@namesdb.command()
+@click.option('--hosts','-H', envvar='ES_HOST', help='Elasticsearch hosts.')
+@click.option('--delete','-D', 'delete_extra', is_flag=True, default=False,
+              help='Delete documents that have no record.')
+@click.option('--post','-P', 'post_missing', is_flag=True, default=False,
+              help='Post records that have no document.')
+@click.option('--verbose','-v', is_flag=True, default=False, help='Print IDs.')
+@click.argument('model', nargs=-1)
+def reconcile(hosts, delete_extra, post_missing, verbose, model):
+    """Compare IDs in the database and Elasticsearch and fix differences
+    
+    \b
+    Reports records with no document (missing) and documents with no
+    record (extra) for each model. Both sides are streamed in ID order,
+    so this runs in constant memory.
+        namesdb reconcile -H localhost:9200
+        namesdb reconcile -H localhost:9200 person --delete --post
+    """
+    model_names = [model_w_abbreviations(m) for m in model] or reconcile_.MODELS
+    for m in model_names:
+        if m not in reconcile_.MODELS:
+            click.echo(f'ERROR: Bad model "{m}". Choices: {reconcile_.MODELS}')
+            sys.exit(1)
+    ds = docstore_manager(hosts)
+    database.use_profile('read-only-publish')
+    for m in model_names:
+        model_class = models.MODEL_CLASSES[m]
+        diffs = reconcile_.diff(
+            reconcile_.sql_ids(model_class), reconcile_.es_ids(ds, m)
+        )
+        counts = {reconcile_.MISSING: 0, reconcile_.EXTRA: 0}
+        pending = {reconcile_.MISSING: [], reconcile_.EXTRA: []}
+        def flush(kind):
+            ids = pending[kind]
+            if ids and kind == reconcile_.EXTRA and delete_extra:
+                publish.delete_docs(ds, m, ids)
+            elif ids and kind == reconcile_.MISSING and post_missing:
+                publish.post_records(
+                    model_class.objects.filter(pk__in=ids),
+                    publish.load_related(m, ids), ds
+                )
+            pending[kind] = []
+        for kind,record_id in diffs:
+            counts[kind] += 1
+            if verbose:
+                click.echo(f'{m} {kind} {record_id}')
+            pending[kind].append(record_id)
+            if len(pending[kind]) >= reconcile_.BATCH_SIZE:
+                flush(kind)
+        flush(reconcile_.MISSING)
+        flush(reconcile_.EXTRA)
+        click.echo(
+            f'{m:12} {counts[reconcile_.MISSING]} missing, '
+            f'{counts[reconcile_.EXTRA]} extra'
+        )
 
 def hosts_index(hosts):
     if not hosts:
@@ -414,6 +842,11 @@ def hosts_index(hosts):
         sys.exit(1)
     return publish.make_hosts(hosts)
 
+def docstore_manager(hosts):
+    """DocstoreManager for hosts, shared by all commands run by `namesdb serve`"""
+    hosts_index(hosts)
+    return publish.docstore_manager(hosts)
+
 @namesdb.command()
 @click.option('--hosts','-H', envvar='ES_HOST', help='Elasticsearch hosts.')
 @click.option('--confirm', is_flag=True,
@@ -430,9 +863,9 @@ def destroy(hosts, confirm):
     is for individual documents.
     """
     if confirm:
-        docstore.DocstoreManager(
-            models.INDEX_PREFIX, hosts_index(hosts), settings
-        ).delete_indices()
+        ds = docstore_manager(hosts)
+        ds.delete_indices()
+        _clear_fingerprints(ds)
     else:
         click.echo("Add '--confirm' if you're sure you want to do this.")
 
@@ -443,7 +876,7 @@ def status(hosts):
     
     More detail since you asked.
     """
-    ds = docstore.Docstore(models.INDEX_PREFIX, hosts_index(hosts), settings)
+    ds = docstore.Docstore(INDEX_PREFIX, hosts_index(hosts), settings)
     s = ds.status()
     
     print('------------------------------------------------------------------------',0)
@@ -517,11 +950,58 @@ TEST_DATA = {
 @click.option('--file','-f', default=None, help='Post records with IDs from file.')
 @click.option('--since','-s', default=None, help='Post records updated since date.')
 @click.option('--test','-T', is_flag=True, default=False, help='Post test data.')
+@click.option('--snapshot','-S', is_flag=True, default=False,
+              help='Post from a point-in-time copy of the database.')
+@click.option('--force','-F', is_flag=True, default=False,
+              help='Post documents even if unchanged since last posted.')
+@click.option('--delete-stale', is_flag=True, default=False,
+              help='Delete documents whose records are gone (full runs only).')
+@click.option('--resume','-R', default=None, type=int,
+              help='Continue the run with this checkpoint ID.')
+@click.option('--retry-failed', default=None, type=int,
+              help='Post only the records that failed in this checkpoint ID.')
+@click.option('--stages', is_flag=True, default=False,
+              help='Print time spent in each stage at the end.')
 @click.option('--debug','-d', is_flag=True, default=False)
-@click.argument('model')
-def post(hosts, limit, id, file, since, test, debug, model):
+@click.argument('model', required=False)
+def post(hosts, limit, id, file, since, test, snapshot, force, delete_stale, resume, retry_failed, stages, debug, model):
     """Post data from SQL database to Elasticsearch.
+    
+    \b
+    Only documents that changed since they were last posted are sent
+    (see names.fingerprints); use --force to send everything.
+    After posting a whole table, documents whose records no longer exist
+    are reported; --delete-stale removes them.
+    
+    \b
+    Use --snapshot for long runs: records are read from a consistent copy
+    of the database, so editors aren't blocked and families aren't split
+    across edits. The copy is deleted afterwards.
+    
+    \b
+    Runs that post a whole table (or --since) are checkpointed; continue
+    one that stopped, or post only the records that failed:
+        namesdb post -H localhost:9200 --resume 12
+        namesdb post -H localhost:9200 --retry-failed 12
+    
+    \b
+    --stages shows where the time went: fetching rows (post.sql),
+    building documents (post.document), serializing and hashing them
+    (post.serialize), Elasticsearch (post.elasticsearch), and relations.
     """
+    _show_stages(stages)
+    database.use_profile('read-only-publish')
+    job = None
+    if resume or retry_failed or (model and not (test or id or file)):
+        job,params = _checkpoint('post', resume, retry_failed, {
+            'model': model, 'limit': limit, 'since': since, 'force': force,
+        })
+        model,limit,since,force = [
+            params[key] for key in ['model', 'limit', 'since', 'force']
+        ]
+    if not model:
+        click.echo('ERROR: MODEL is required.')
+        sys.exit(1)
     # check inputs
     MODELS = [
         'person', 'farrecord', 'far', 'wrarecord', 'wra', 'farpage',
@@ -532,9 +1012,7 @@ def post(hosts, limit, id, file, since, test, debug, model):
         click.echo(f'Sorry, model has to be one of {MODELS}')
         sys.exit(1)
     model = model_w_abbreviations(model.lower().strip())
-    ds = docstore.DocstoreManager(
-        models.INDEX_PREFIX, hosts_index(hosts), settings
-    )
+    ds = docstore_manager(hosts)
     if file:
         file = Path(file)
         if not (file.exists() and file.is_file() and os.access(file, os.R_OK)):
@@ -552,31 +1030,35 @@ def post(hosts, limit, id, file, since, test, debug, model):
     if limit:
         limit = int(limit)
 
-    # load related info
+    if snapshot:
+        click.echo('Taking snapshot')
+        # removed, and the database restored, when the command ends
+        with metrics.span('post.snapshot'):
+            snapshot_path,generation = click.get_current_context().with_resource(
+                snapshot_.temporary()
+            )
+        click.echo(f'Snapshot {generation}')
+
+    # load related info (only for the requested records if possible)
     click.echo('Gathering relations')
-    related = {}
-    if model == 'person':
-        related['far_records'] = models.Person.related_farrecords()
-        related['wra_records'] = models.Person.related_wrarecords()
-        related['family'] = models.Person.related_family()
-    elif model in ['farrecord', 'far']:
-        related['persons'] = models.FarRecord.related_persons()
-        related['family'] = models.FarRecord.related_family()
-    elif model in ['wrarecord', 'wra']:
-        related['persons'] = models.WraRecord.related_persons()
-        related['family'] = models.WraRecord.related_family()
-    elif model in ['ireirecord', 'irei']:
-        related['persons'] = models.IreiRecord.related_persons()
-    elif model == 'personlocation':
-        related['persons'] = models.PersonLocation.related_persons()
-        related['locations'] = models.PersonLocation.related_locations()
-        related['facilities'] = models.PersonLocation.related_facilities()
+    related_ids = None
+    if retry_failed:
+        related_ids = job['failed']
+    elif id:
+        related_ids = [id]
+    elif file:
+        with file.open('r') as f:
+            related_ids = [line.strip() for line in f.readlines()]
+    with metrics.span('post.related'):
+        related = publish.load_related(model, related_ids)
 
     # select records to post
     click.echo('Loading from database')
     sql_class = models.MODEL_CLASSES[model]
     # TODO stretching this metaphor too far - revise
-    if test:
+    if retry_failed:
+        records = sql_class.objects.filter(pk__in=job['failed'])
+    elif test:
         if model == 'person':
             records = sql_class.objects.filter(nr_id__in=TEST_DATA['person'])
         elif model == 'personlocation':
@@ -624,26 +1106,78 @@ def post(hosts, limit, id, file, since, test, debug, model):
                 records = sql_class.objects.filter(irei_id__in=ids)
         # records updated since DATE(TIME)
         elif since:
-            records = sql_class.objects.filter(timestamp__gte=since)[:limit]
+            records = sql_class.objects.filter(timestamp__gte=since)
         # everything
         else:
-            records = sql_class.objects.all()[:limit]
+            records = sql_class.objects.all()
+        # in primary key order so a stopped run can be resumed
+        if job:
+            records = records.order_by('pk')
+            if job['position']:
+                click.echo(f'Resuming after {job["position"]}')
+                records = records.filter(pk__gt=job['position'])
+        if since or not (id or file):
+            records = records[:limit]
 
     # now post them
-    # TODO refactor use elasticsearch.helpers.bulk
+    posted,unchanged,failed,seen = _post(
+        records, related, ds, model, force, job, retry=bool(retry_failed)
+    )
+    for doc_id in failed:
+        click.echo(f"FAIL {doc_id}")
+    click.echo(f'{posted} posted, {unchanged} unchanged, {len(failed)} failed')
+    # documents for records that have been deleted
+    full_run = not (test or id or file or since or resume or retry_failed) \
+        and sql_class.objects.count() <= (limit or 0)
+    if full_run and not failed:
+        stale = fingerprints.stale(
+            fingerprints.key(ds, ds.index_name(model)), seen
+        )
+        if stale:
+            click.echo(f'{len(stale)} stale documents: {stale[:20]}')
+        if stale and delete_stale:
+            not_deleted = publish.delete_docs(ds, model, stale)
+            click.echo(f'Deleted {len(stale) - len(not_deleted)} stale documents')
+    if snapshot:
+        snapshot_.record_generation(ds, model, generation)
+
+# Records posted between checkpoints
+CHECKPOINT_EVERY = 5000
+
+def _post(records, related, ds, model, force, job=None, retry=False):
+    """post_changed() in chunks, checkpointing after each one
+    
+    @returns: (int posted, int unchanged, list of failed IDs, list of all IDs)
+    """
+    with metrics.timer('post.fingerprints'):
+        known = {} if force else fingerprints.load(
+            fingerprints.key(ds, ds.index_name(model))
+        )
+    posted = unchanged = 0
     failed = []
-    for record in tqdm(
-        records, desc='Writing to Elasticsearch', ascii=True, unit='record'
-    ):
-        try:
-            record.post(related, ds)
-        except:
-            failed.append(record)
-    if failed:
-        click.echo(f"FAIL {record}")
+    seen = []
+    records = tqdm(
+        metrics.iterate('post.sql', records.iterator(chunk_size=2000)),
+        total=records.count(),
+        desc='Writing to Elasticsearch', ascii=True, unit='record'
+    )
+    for chunk in publish.chunks(records, CHECKPOINT_EVERY):
+        with metrics.span('post.chunk', records=len(chunk)):
+            p,u,f,s = publish.post_changed(
+                chunk, related, ds, model, force, known=known
+            )
+        posted += p
+        unchanged += u
+        failed += f
+        seen += s
+        if job and not retry:
+            checkpoints.advance(job['id'], chunk[-1].pk, f)
+    if job:
+        _echo_checkpoint(job, checkpoints.end(job, failed, retry))
+    return posted, unchanged, failed, seen
 
 def _make_record_url(hosts, model, record_id):
-    return f'http://{hosts}/{models.INDEX_PREFIX}{model}/_doc/{record_id}'
+    return f'http://{hosts}/{INDEX_PREFIX}{model}/_doc/{record_id}'
 
 @namesdb.command()
 @click.option('--hosts','-H', envvar='ES_HOST', help='Elasticsearch hosts.')
@@ -654,60 +1188,86 @@ def url(hosts, model, record_id):
     """
     click.echo(_make_record_url(hosts, model, record_id))
 
+# IDs per mget request
+MGET_SIZE = 1000
+
+def _read_ids(record_ids, file):
+    """Yield IDs from arguments, then from file ('-' or piped: STDIN)"""
+    for record_id in record_ids:
+        yield record_id
+    if not file and not record_ids and not sys.stdin.isatty():
+        file = '-'
+    if file:
+        f = sys.stdin if file == '-' else open(file, 'r')
+        try:
+            for line in f:
+                if line.strip():
+                    yield line.strip()
+        finally:
+            if f is not sys.stdin:
+                f.close()
+
 @namesdb.command()
 @click.option('--hosts','-H', envvar='ES_HOST', help='Elasticsearch hosts.')
-@click.option('--json','-j', is_flag=True, default=False)
+@click.option('--json','-j', 'as_json', is_flag=True, default=False,
+              help='Print raw JSON, one document per line.')
+@click.option('--file','-f', default=None, help='Read IDs from file ("-" for STDIN).')
 @click.argument('model')
-@click.argument('record_id')
-def get(hosts, json, model, record_id):
+@click.argument('record_id', nargs=-1)
+def get(hosts, as_json, file, model, record_id):
     """Get specified Elasticsearch record JSON
+    
+    \b
+    Get many records with one request per thousand IDs:
+        namesdb get -H localhost:9200 person --json -f nr_ids.txt > people.jsonl
+        cat nr_ids.txt | namesdb get -H localhost:9200 person --json
+    IDs that are not found are reported on STDERR.
     """
     model = model_w_abbreviations(model)
-    if json:
-        # the slash in Person.nr_id is unsafe in URLs
-        record_id = record_id.replace('/', '%2F')
-        url = _make_record_url(hosts, model, record_id)
-        if settings.DOCSTORE_PASSWORD:
-            r = httpx.get(
-                url, auth=(settings.DOCSTORE_USERNAME, settings.DOCSTORE_PASSWORD)
-            )
-        else:
-            r = httpx.get(url)
-        if r.status_code == HTTPStatus.OK:
-            click.echo(r.text)
-        else:
-            click.echo(f'{r.status_code} {r.reason}')
-    else:
-        ds = docstore.Docstore(models.INDEX_PREFIX, hosts_index(hosts), settings)
-        es_class = models_public.ELASTICSEARCH_CLASSES_BY_MODEL[model]
-        record = es_class.get(id=record_id, using=ds.es)
-        click.echo(record)
+    ds = docstore_manager(hosts)
+    es_class = models_public.ELASTICSEARCH_CLASSES_BY_MODEL[model]
+    for chunk in publish.chunks(_read_ids(record_id, file), MGET_SIZE):
+        response = ds.es.mget(index=ds.index_name(model), body={'ids': chunk})
+        for doc in response['docs']:
+            if not doc.get('found'):
+                click.echo(f"NOT FOUND {doc['_id']}", err=True)
+            elif as_json:
+                click.echo(json.dumps(doc))
+            else:
+                click.echo(es_class.from_es(doc))
 
 @namesdb.command()
 @click.option('--hosts','-H', envvar='ES_HOST', help='Elasticsearch hosts.')
+@click.option('--file','-f', default=None, help='Read IDs from file ("-" for STDIN).')
 @click.argument('model')
-@click.argument('record_id')
-def delete(hosts, model, record_id):
-    """Delete records in CSV file from Elasticsearch.
+@click.argument('record_id', nargs=-1)
+def delete(hosts, file, model, record_id):
+    """Delete records from Elasticsearch.
+    
+    \b
+    Delete many records with the bulk API:
+        namesdb delete -H localhost:9200 person -f nr_ids.txt
     """
     model = model_w_abbreviations(model)
-    ds = docstore.DocstoreManager(
-        models.INDEX_PREFIX, hosts_index(hosts), settings
-    )
-    es_class = models_public.ELASTICSEARCH_CLASSES_BY_MODEL[model]
-    try:
-        record = es_class.get(id=record_id, using=ds.es)
-        result = record.delete(using=ds.es)
-    except docstore.NotFoundError as err:
-        click.echo(err)
+    ds = docstore_manager(hosts)
+    num = 0
+    failed = []
+    for chunk in publish.chunks(_read_ids(record_id, file), publish.BULK_CHUNK_SIZE):
+        failed += publish.delete_docs(ds, model, chunk)
+        num += len(chunk)
+    for doc_id in failed:
+        click.echo(f'FAIL {doc_id}')
+    click.echo(f'Deleted {num - len(failed)} of {num}')
 
 @namesdb.command()
 @click.option('--hosts','-H', envvar='ES_HOST', help='Elasticsearch hosts.')
 @click.option('--sql','-s', is_flag=True, default=False)
 @click.option('--elastic','-e', is_flag=True, default=False)
 @click.option('--noheaders','-n', is_flag=True, default=False)
+@click.option('--stages', is_flag=True, default=False,
+              help='Print time spent in each stage at the end (to STDERR).')
 @click.argument('csvfile')
-def searchmulti(hosts, sql, elastic, noheaders, csvfile):
+def searchmulti(hosts, sql, elastic, noheaders, stages, csvfile):
     """Reads output of `ddrnames dump` and suggests Person records for each name
     
     \b
@@ -725,13 +1285,13 @@ def searchmulti(hosts, sql, elastic, noheaders, csvfile):
     \b
     If you don't see results, you may need to prepare the SQLite database
     for full-text search:
-        sqlite-utils enable-fts --fts5 db/namesregistry.db names_person nr_id family_name given_name given_name_alt other_names middle_name prefix_name suffix_name jp_name preferred_name
+        namesdb fts person
     
     \b
-    If you get results but they look wrong, you may disable and re-enable
-    full-text search.  Run this before the previous command
-        sqlite-utils disable-fts db/namesregistry.db names_person
+    If you get results but they look wrong, you may rebuild the index:
+        namesdb fts person --rebuild
     """
+    _show_stages(stages)
     if elastic: method = 'elastic'
     elif sql: method = 'sql'
     else:
@@ -740,37 +1300,263 @@ def searchmulti(hosts, sql, elastic, noheaders, csvfile):
     for row in batch.search_multi(csvfile, method, not noheaders):
         click.echo(row)
 
+@namesdb.command()
+@click.option('--rebuild','-r', is_flag=True, default=False,
+              help='Regenerate from the record tables.')
+@click.argument('model', nargs=-1)
+def family(rebuild, model):
+    """Print (or rebuild) the number of precomputed families per model
+    
+    \b
+    Families listed in Person, FarRecord, and WraRecord documents are
+    kept in names_family, refreshed as records are saved.
+        namesdb family --rebuild
+        namesdb family --rebuild person
+    """
+    model_names = [model_w_abbreviations(m) for m in model] or list(family_.FAMILIES)
+    for m in model_names:
+        if m not in family_.FAMILIES:
+            click.echo(f'ERROR: Bad model "{m}". Choices: {list(family_.FAMILIES)}')
+            sys.exit(1)
+    if rebuild:
+        counts = family_.rebuild(model_names)
+    else:
+        counts = {m: len(family_.load(m)) for m in model_names}
+    for m,num in counts.items():
+        click.echo(f'{m:12} {num} families')
+
+@namesdb.command()
+@click.option('--rebuild','-r', is_flag=True, default=False,
+              help='Drop and recreate the index.')
+@click.argument('model')
+def fts(rebuild, model):
+    """Create or rebuild SQLite full-text (FTS5) index for a model
+    
+    \b
+    Used by admin search boxes and `namesdb searchmulti --sql`.
+    Indexes are kept up to date by triggers so run this once per model:
+        namesdb fts person
+        namesdb fts farrecord
+        namesdb fts wrarecord
+        namesdb fts ireirecord
+    """
+    model = model_w_abbreviations(model)
+    table = f'names_{model}'
+    if table not in fts_.FTS_COLUMNS:
+        click.echo(f'ERROR: No full-text index for "{model}".')
+        sys.exit(1)
+    path = settings.DATABASES['names']['NAME']
+    click.echo(fts_.enable_fts(path, table, rebuild=rebuild))
+
+@namesdb.command()
+@click.option('--poll','-p', default=5, help='Seconds between checks for new jobs.')
+@click.option('--burst','-b', is_flag=True, default=False,
+              help='Quit when the queue is empty.')
+def worker(poll, burst):
+    """Run background jobs queued by admin actions
+    
+    \b
+    Runs under supervisord in production (see conf/supervisor.conf).
+    Job progress is shown at /admin/jobs/.
+    """
+    jobs.work(poll_interval=poll, burst=burst)
+
+@namesdb.command()
+@click.option('--socket','-s', 'socket_path', default=None,
+              help='Listen on this unix socket instead of reading STDIN.')
+def serve(socket_path):
+    """Run commands sent as JSON lines, without restarting each time
+    
+    \b
+    Each line is a JSON list of arguments, or {"id": ..., "args": [...],
+    "stdin": "..."}.  Replies are JSON lines with exit code and output:
+        echo '["url", "-H", "localhost:9200", "person", "0a1b2c3d4e"]' | namesdb serve
+        namesdb serve --socket /tmp/namesdb.sock
+    See names/cmdserver.py.
+    """
+    # STDOUT carries the replies
+    cmdserver.log_to_stderr(publish.LOGGING_LEVEL)
+    # load everything up front so the first command is as fast as the rest
+    django_setup()
+    models.MODEL_CLASSES
+    publish.docstore_manager
+    if socket_path:
+        cmdserver.serve_socket(namesdb, socket_path)
+    else:
+        cmdserver.serve_stream(namesdb, sys.stdin, sys.stdout)
+
+COUNTED_MODELS = [
+    'person', 'farrecord', 'wrarecord', 'ireirecord', 'farpage',
+    'personlocation', 'location', 'facility', 'revision',
+]
+
+@namesdb.command()
+@click.option('--exact','-e', is_flag=True, default=False,
+              help='Recount with SELECT COUNT(*) and update the stored count.')
+@click.argument('model', required=False)
+def counts(exact, model):
+    """Print (and refresh) stored row counts used by admin changelists
+    
+    \b
+    Counts come from the state database, or are estimated from sqlite_stat1.
+    Use --exact to recount, e.g. from cron after a large import:
+        namesdb counts --exact
+        namesdb counts --exact farrecord
+    """
+    if model:
+        model_names = [model_w_abbreviations(model)]
+    else:
+        model_names = COUNTED_MODELS
+    for model_name in model_names:
+        if model_name == 'revision':
+            model_class = models.Revision
+        else:
+            model_class = models.MODEL_CLASSES[model_name]
+        if exact:
+            num = paginators.exact_count(model_class)
+        else:
+            num = paginators.table_count(model_class)
+        click.echo(f'{model_name:16} {num}')
+
+@namesdb.command()
+@click.option('--workload','-w', default=None,
+              help='SQL log to analyze (default: settings.SQL_LOG).')
+@click.option('--apply','-a', is_flag=True, default=False,
+              help='Create missing indexes and show before/after timings.')
+@click.option('--top','-t', default=10, help='Number of scanning statements to show.')
+def indexes(workload, apply, top):
+    """Report missing and unused indexes, and statements that scan tables
+    
+    \b
+    Record a workload by setting [debug] sql_log in the config file,
+    use the admin and run namesdb commands for a while, then:
+        namesdb indexes
+        namesdb indexes --apply
+    """
+    missing = indexes_.missing()
+    click.echo('Missing indexes:')
+    for name in missing:
+        click.echo(f'  {indexes_.create_sql(name)}')
+    if not missing:
+        click.echo('  none')
+    workload = workload or settings.SQL_LOG
+    if workload and Path(workload).exists():
+        statements = indexes_.workload(sqllog.read(workload))
+        used,scans = indexes_.analyze(statements)
+        click.echo(f'Unused indexes ({len(statements)} distinct statements in {workload}):')
+        for name,table in indexes_.unused(used):
+            click.echo(f'  {table:20} {name}')
+        click.echo('Statements that scan whole tables:')
+        for sql,stats,tables in scans[:top]:
+            click.echo(
+                f"  {stats['count']:6} runs {stats['ms']:10.1f}ms  "
+                f"{', '.join(tables)}  {', '.join(sorted(stats['sources']))}"
+            )
+            click.echo(f'    {sql[:200]}')
+    else:
+        click.echo('No SQL log to analyze (see [debug] sql_log).')
+    if apply and missing:
+        click.echo('Creating indexes (mean ms per lookup):')
+        for name,before,after in indexes_.apply(missing):
+            if before is None:
+                click.echo(f'  {name}  (no rows)')
+            else:
+                click.echo(f'  {name}  {before:.3f} -> {after:.3f}')
+
+SQLREPORT_SORTS = {'total': 'ms', 'count': 'count', 'p99': 'p99'}
+
+@namesdb.command()
+@click.option('--workload','-w', default=None,
+              help='SQL log to analyze (default: settings.SQL_LOG).')
+@click.option('--top','-t', default=20, help='Number of statements to show.')
+@click.option('--sort','-s', default='total', type=click.Choice(SQLREPORT_SORTS),
+              help='Rank statements by total time, count, or p99 time.')
+@click.option('--n-plus-one','-n', is_flag=True, default=False,
+              help='Only show statements flagged N+1.')
+@click.option('--no-explain', is_flag=True, default=False,
+              help="Don't show EXPLAIN QUERY PLAN.")
+def sqlreport(workload, top, sort, n_plus_one, no_explain):
+    """Report the statements that take the most time in the SQL log
+    
+    \b
+    Statements are grouped by fingerprint (the SQL with its values and
+    IN lists normalized).  For each one: how many times it ran, total
+    and 99th percentile milliseconds, where it ran from, and how it is
+    executed (EXPLAIN QUERY PLAN).  "N+1" marks a SELECT that a single
+    request or command ran at least sqllog.N_PLUS_ONE times.
+    
+    \b
+    Record a workload by setting [debug] sql_log in the config file,
+    use the admin and run namesdb commands for a while, then:
+        namesdb sqlreport
+        namesdb sqlreport --sort count --n-plus-one
+    """
+    workload = workload or settings.SQL_LOG
+    if not (workload and Path(workload).exists()):
+        click.echo('No SQL log to analyze (see [debug] sql_log).')
+        sys.exit(1)
+    from django.db import DatabaseError
+    statements = sqllog.aggregate(sqllog.read(workload))
+    ranked = sorted(
+        statements.items(), key=lambda item: item[1][SQLREPORT_SORTS[sort]],
+        reverse=True
+    )
+    if n_plus_one:
+        ranked = [(fp,s) for fp,s in ranked if s['n_plus_one']]
+    total_ms = sum(s['ms'] for s in statements.values()) or 1
+    click.echo(
+        f'{len(statements)} distinct statements in {workload}, '
+        f'{sum(s["count"] for s in statements.values())} runs, {total_ms:.1f}ms'
+    )
+    for n,(fp,s) in enumerate(ranked[:top]):
+        click.echo('')
+        click.echo(
+            f"{n+1:3}. {s['count']:8} runs {s['ms']:10.1f}ms "
+            f"({100 * s['ms'] / total_ms:4.1f}%)  p99 {s['p99']:.2f}ms  "
+            f"max {s['max']:.2f}ms  {', '.join(sorted(s['sources']))}"
+        )
+        if s['n_plus_one']:
+            click.echo(f"     N+1: up to {s['per_run']} runs by one request or command")
+        click.echo(f'     {fp[:500]}')
+        if no_explain:
+            continue
+        try:
+            plan = indexes_.plan(s['sql'])
+        except DatabaseError as err:  # table changed since statement was logged
+            click.echo(f'     (no plan: {err})')
+            continue
+        for line in database.format_plan(plan).splitlines():
+            click.echo(f'       {line}')
+
 @namesdb.command()
 @click.option('--debug','-d', is_flag=True, default=False)
-def exportdb(debug):
+@click.option('--compress','-z', default=None,
+              type=click.Choice(EXPORT_COMPRESSIONS), help='Compress output.')
+def exportdb(debug, compress):
     """Copy SQLite3 database, removing Django-specific tables
+    
+    \b
+    Only names_* tables are copied, in one read transaction, into a new
+    file next to the live database. Full-text indexes are rebuilt and the
+    copy is ANALYZEd. Safe to run while editors are working.
     """
     src = settings.DATABASES['names']['NAME']
     timestamp = datetime.now().strftime('%Y%m%d-%H%M')
     dst = os.path.join(
         os.path.dirname(src), f'namesregistry-{timestamp}.sqlite3'
     )
-    # copy database file
-    if debug:
-        click.echo('Copying database')
-        click.echo(f'cp {src} {dst}')
-    shutil.copy(src,dst)
-    # open copied db with sqlite3
-    c = sqlite3.connect(dst).cursor()
-    if debug:
-        click.echo('Getting table names')
-    schema = c.execute("SELECT name FROM sqlite_master WHERE type='table';").fetchall()
     if debug:
-        click.echo('Dropping Django tables')
-    for t in schema:
-        tablename = t[0]
-        if not (tablename.startswith('names_') or tablename.startswith('sqlite_')):
-            query = f'DROP TABLE {tablename}'
-            if debug:
-                click.echo(query)
-            c.execute(query)
-    # clean up
-    c.close()
+        click.echo(f'{src} -> {dst}')
+    bar = tqdm(desc='Copying', ascii=True, unit='row')
+    def counted(counts):
+        if debug:
+            for table,num in counts.items():
+                click.echo(f'{table:24} {num}')
+        bar.total = sum(counts.values())
+    publicdb.export_db(src, dst, progress=bar.update, counted=counted)
+    bar.close()
+    if compress:
+        dst = publicdb.compress(dst, compress)
     click.echo(dst)
 
 def model_w_abbreviations(model):
@@ -0,0 +1,151 @@
+"""Run many namesdb commands in one process (`namesdb serve`)
+
+Each namesdb invocation pays for Python, Django, the models, and a new
+Elasticsearch client before it does any work.  `namesdb serve` pays once:
+it reads one command per line as JSON, runs it in-process, and writes one
+JSON line with the result.  Django keeps its database connections open
+between commands and publish.docstore_manager() reuses one Elasticsearch
+client per cluster.  If a command changes the names database NAME or
+profile (e.g. `post --snapshot`, `load`) they are put back afterwards,
+reopening the connection only when NAME changed, so the next command
+doesn't run on a read-only copy.
+
+A command is a list of arguments, or an object with "args" and optionally
+"id" (echoed back) and "stdin" (text the command reads as STDIN):
+
+    ["url", "-H", "localhost:9200", "person", "0a1b2c3d4e"]
+    {"id": 7, "args": ["get", "-H", "localhost:9200", "person"], "stdin": "0a1b\\n2c3d\\n"}
+
+The reply holds the exit code and everything the command printed:
+
+    {"id": 7, "exit": 0, "stdout": "...", "stderr": ""}
+
+Commands are read from STDIN, or from connections to a unix socket:
+
+    namesdb serve < commands.jsonl > results.jsonl
+    namesdb serve --socket /tmp/namesdb.sock
+
+Log records go to the process's STDERR, never to the STDOUT replies.
+"""
+
+from contextlib import redirect_stderr, redirect_stdout
+import io
+import json
+import logging
+from pathlib import Path
+import socketserver
+import sys
+
+import click
+from django.conf import settings
+
+# Commands that can't be run from inside the server
+EXCLUDED = ['serve']
+
+
+def log_to_stderr(level='INFO'):
+    """Send logging to STDERR, replacing handlers that write to STDOUT"""
+    logging.basicConfig(
+        level=level,
+        format='%(asctime)s %(levelname)-8s %(message)s',
+        stream=sys.stderr,
+        force=True,
+    )
+
+def reset(name, profile):
+    """Put back the names database NAME and profile if a command changed them
+
+    The connection is closed only if NAME changed; a profile is applied to
+    the open connection.
+    """
+    from django.db import connections
+    from . import database
+    connection = connections['names']
+    if connection.settings_dict['NAME'] != name:
+        connection.close()
+        connection.settings_dict['NAME'] = name
+    if database.current_profile() != profile:
+        database.use_profile(profile, force=True)
+
+def parse(line):
+    """@returns: (id, list of args, str stdin)"""
+    data = json.loads(line)
+    if isinstance(data, list):
+        return None, data, ''
+    return data.get('id'), data['args'], data.get('stdin', '')
+
+def run(group, args, stdin=''):
+    """Run a command of the click group, capturing its output
+
+    @returns: (int exit code, str stdout, str stderr)
+    """
+    if args and args[0] in EXCLUDED:
+        return 2, '', f'"{args[0]}" cannot be run by the server\n'
+    out = io.StringIO()
+    err = io.StringIO()
+    stdin_ = sys.stdin
+    sys.stdin = io.StringIO(stdin)
+    from . import database
+    name = settings.DATABASES['names']['NAME']
+    profile = database.current_profile()
+    code = 0
+    try:
+        with redirect_stdout(out), redirect_stderr(err):
+            try:
+                group.main(args=[str(arg) for arg in args], standalone_mode=False)
+            except click.exceptions.Exit as e:
+                code = e.exit_code
+            except click.ClickException as e:
+                e.show()
+                code = e.exit_code
+            except click.Abort:
+                click.echo('Aborted!', err=True)
+                code = 1
+            except SystemExit as e:
+                code = e.code if isinstance(e.code, int) else 1
+            except Exception as e:
+                logging.exception(f'{args}')
+                click.echo(f'ERROR: {e}', err=True)
+                code = 1
+    finally:
+        sys.stdin = stdin_
+        reset(name, profile)
+    return code, out.getvalue(), err.getvalue()
+
+def handle(group, line):
+    """Run the command on one line of input, return the JSON reply"""
+    try:
+        id_,args,stdin = parse(line)
+    except (ValueError, KeyError, AttributeError) as e:
+        return json.dumps({'id': None, 'exit': 2, 'stdout': '', 'stderr': f'Bad command: {e}'})
+    code,out,err = run(group, args, stdin)
+    return json.dumps({'id': id_, 'exit': code, 'stdout': out, 'stderr': err})
+
+def serve_stream(group, rfile, wfile):
+    """Answer commands from rfile until it is closed"""
+    for line in rfile:
+        if not line.strip():
+            continue
+        wfile.write(handle(group, line) + '\n')
+        wfile.flush()
+
+def serve_socket(group, path):
+    """Answer commands on a unix socket, one connection at a time
+
+    Commands redirect the process's STDOUT and STDERR while they run, so
+    connections are not handled concurrently.
+    """
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            rfile = io.TextIOWrapper(self.rfile, encoding='utf-8')
+            wfile = io.TextIOWrapper(self.wfile, encoding='utf-8')
+            serve_stream(group, rfile, wfile)
+
+    path = Path(path)
+    if path.exists():
+        path.unlink()
+    with socketserver.UnixStreamServer(str(path), Handler) as server:
+        try:
+            server.serve_forever()
+        finally:
+            path.unlink(missing_ok=True)
@@ -0,0 +1,161 @@
+"""Helpers for inspecting and tuning the names SQLite database
+
+Connection profiles
+-------------------
+PRAGMAs are applied to each new connection (see NamesConfig.ready) from
+the profile selected by $NAMESDB_DB_PROFILE or [database] profile:
+
+    interactive        Admin and ad hoc commands.
+    bulk-load          namesdb load/loadirei: synchronous=NORMAL, big cache.
+    read-only-publish  namesdb post: query_only, big cache and mmap.
+    snapshot           namesdb post --snapshot (see names.snapshot).
+
+All profiles except snapshot use WAL so that readers (the admin, post) and one writer
+(load) don't block each other, and a busy_timeout so a writer waits for
+the lock instead of failing with "database is locked".  use_profile()
+changes the PRAGMAs of an open connection, so the writable profiles set
+query_only=OFF explicitly rather than relying on the default.
+"""
+
+import logging
+import os
+import re
+
+from django.conf import settings
+from django.db import connections
+
+PROFILES = {
+    'interactive': {
+        'journal_mode': 'WAL',
+        'query_only': 'OFF',
+        'synchronous': 'FULL',
+        'busy_timeout': 10000,
+        'cache_size': -32000,  # KiB
+        'temp_store': 'MEMORY',
+        'mmap_size': 256 * 1024 * 1024,
+    },
+    'bulk-load': {
+        'journal_mode': 'WAL',
+        'query_only': 'OFF',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 60000,
+        'cache_size': -256000,
+        'temp_store': 'MEMORY',
+        'mmap_size': 1024 * 1024 * 1024,
+    },
+    'read-only-publish': {
+        'journal_mode': 'WAL',
+        'query_only': 'ON',
+        'busy_timeout': 60000,
+        'cache_size': -256000,
+        'temp_store': 'MEMORY',
+        'mmap_size': 1024 * 1024 * 1024,
+    },
+    # Read-only immutable copy: no journal, no locking
+    'snapshot': {
+        'query_only': 'ON',
+        'cache_size': -256000,
+        'temp_store': 'MEMORY',
+        'mmap_size': 1024 * 1024 * 1024,
+    },
+}
+DEFAULT_PROFILE = 'interactive'
+# Databases other than 'names' (Django sessions, users, etc) always get this
+OTHER_PROFILE = 'interactive'
+
+_profile = None
+
+
+def current_profile():
+    """Name of connection profile for the names database"""
+    global _profile
+    if not _profile:
+        _profile = os.environ.get(
+            'NAMESDB_DB_PROFILE', getattr(settings, 'DB_PROFILE', DEFAULT_PROFILE)
+        )
+        if _profile not in PROFILES:
+            raise Exception(f'Unknown database profile "{_profile}"')
+    return _profile
+
+def apply_profile(connection, name):
+    """Run the profile's PRAGMAs on a Django sqlite3 connection"""
+    with connection.cursor() as cursor:
+        for pragma,value in PROFILES[name].items():
+            cursor.execute(f'PRAGMA {pragma}={value}')
+
+def on_connect(sender, connection, **kwargs):
+    """connection_created receiver"""
+    if connection.vendor != 'sqlite':
+        return
+    if connection.alias == 'names':
+        apply_profile(connection, current_profile())
+    else:
+        apply_profile(connection, OTHER_PROFILE)
+
+def use_profile(name, force=False):
+    """Switch the names database to profile, including an open connection
+
+    Called by commands before they touch the database, e.g. `namesdb load`.
+    $NAMESDB_DB_PROFILE takes precedence unless force is True.
+    """
+    global _profile
+    if name not in PROFILES:
+        raise Exception(f'Unknown database profile "{name}"')
+    if os.environ.get('NAMESDB_DB_PROFILE') and not force:
+        return
+    _profile = name
+    connection = connections['names']
+    if connection.connection is not None:
+        apply_profile(connection, name)
+    logging.debug(f'database profile {name}')
+
+# e.g. "SCAN names_person" or "SCAN TABLE names_person" (SQLite < 3.36)
+SCAN = re.compile(
+    r'^SCAN (TABLE )?(?P<table>\w+)(?!.*(USING (COVERING )?INDEX|VIRTUAL TABLE))'
+)
+
+
+def explain(queryset):
+    """SQLite EXPLAIN QUERY PLAN for queryset
+
+    @returns: list of (id, parent, detail) tuples
+    """
+    sql,params = queryset.query.sql_with_params()
+    with connections[queryset.db].cursor() as cursor:
+        cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+        return [(row[0], row[1], row[-1]) for row in cursor.fetchall()]
+
+def format_plan(plan):
+    """Indent EXPLAIN QUERY PLAN rows like the sqlite3 shell does
+    """
+    depth = {0: -1}
+    lines = []
+    for id,parent,detail in plan:
+        depth[id] = depth.get(parent, -1) + 1
+        lines.append('  ' * depth[id] + detail)
+    return '\n'.join(lines)
+
+def full_scans(plan):
+    """Names of tables the plan reads without using an index
+    """
+    tables = []
+    for id,parent,detail in plan:
+        m = SCAN.match(detail)
+        if m and m.group('table') not in tables:
+            tables.append(m.group('table'))
+    return tables
+
+def index_name(table, columns):
+    return f"{table}_{'_'.join(columns)}_idx"
+
+def create_index(table, columns, using='names'):
+    """CREATE INDEX IF NOT EXISTS and ANALYZE it
+
+    @returns: str Name of index
+    """
+    name = index_name(table, columns)
+    cols = ', '.join(f'"{column}"' for column in columns)
+    with connections[using].cursor() as cursor:
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS "{name}" ON "{table}" ({cols})')
+        cursor.execute(f'ANALYZE "{name}"')
+    return name
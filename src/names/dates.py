@@ -0,0 +1,113 @@
+"""Date parsing for imports
+
+Nearly all dates in the data files are in one of a few formats, and the
+same values (birth dates especially) repeat many times.  parse() tries
+the format that matched last, then the other FORMATS with strptime, and
+only hands values that match none of them to dateutil.  Results are
+memoized by string.
+
+parse_columns() runs over whole columns of a data file before it is
+loaded.  It parses each distinct value once, warming parse()'s memo, and
+reports which formats were found and which values couldn't be parsed.
+"""
+
+from collections import Counter
+from datetime import datetime
+import functools
+
+from dateutil import parser
+
+# Most common first
+FORMATS = [
+    '%Y-%m-%d',
+    '%Y-%m-%d %H:%M:%S',
+    '%Y-%m-%dT%H:%M:%S',
+    '%m/%d/%Y',
+    '%m/%d/%Y %H:%M:%S',
+    '%B %d, %Y',
+    '%b %d, %Y',
+    '%d %B %Y',
+    '%d %b %Y',
+]
+FALLBACK = 'dateutil'
+
+# Columns of each model's data files that hold dates
+DATE_COLUMNS = {
+    'person': ['birth_date', 'birth_date_text', 'death_date', 'death_date_text'],
+    'farrecord': ['date_of_birth', 'date_of_original_entry', 'departure_date'],
+    'ireirecord': ['birthday'],
+}
+
+_last = [FORMATS[0]]
+
+
+@functools.lru_cache(maxsize=100_000)
+def classify(value):
+    """Parse a date string
+
+    @returns: (datetime or None, str format or FALLBACK or None)
+    """
+    value = value.strip()
+    if not value:
+        return None, None
+    for fmt in _last + FORMATS:
+        try:
+            dt = datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        _last[0] = fmt
+        return dt, fmt
+    try:
+        return parser.parse(value), FALLBACK
+    except (ValueError, OverflowError):  # ParserError is a ValueError
+        return None, None
+
+def parse(value):
+    """datetime from a date string, or None if it can't be parsed"""
+    if not value:
+        return None
+    return classify(value)[0]
+
+
+class Report():
+    """Formats found and unparseable values, by column"""
+
+    def __init__(self):
+        self.formats = {}
+        self.unparseable = {}
+
+    def add(self, column, value, fmt, rows=1):
+        if fmt:
+            self.formats.setdefault(column, Counter())[fmt] += rows
+        else:
+            self.unparseable.setdefault(column, Counter())[value] += rows
+
+    def lines(self):
+        for column,formats in self.formats.items():
+            found = ', '.join(f'{fmt} {num}' for fmt,num in formats.most_common())
+            yield f'{column}: {found}'
+        for column,values in self.unparseable.items():
+            for value,num in values.most_common():
+                yield f'UNPARSEABLE {column}: "{value}" ({num} rows)'
+
+
+def parse_columns(rowds, columns):
+    """Parse the date columns of a data file, each distinct value once
+
+    @param rowds: list of dicts
+    @param columns: list of column names (see DATE_COLUMNS)
+    @returns: (dict column: {value: datetime or None}, Report)
+    """
+    report = Report()
+    parsed = {}
+    for column in columns:
+        counts = Counter(
+            rowd[column].strip() for rowd in rowds
+            if isinstance(rowd.get(column), str) and rowd[column].strip()
+        )
+        parsed[column] = {}
+        for value,num in counts.items():
+            dt,fmt = classify(value)
+            parsed[column][value] = dt
+            report.add(column, value, fmt, num)
+    return parsed, report
@@ -0,0 +1,201 @@
+"""Streaming export of names database tables
+
+Used by `namesdb dump`.  Only the requested columns are selected, with
+values_list(...).iterator(), so no model objects are built and memory use
+does not grow with the size of the table.
+
+Formats:
+    csv      Same dialect as the CSV importers (see names.fileio)
+    jsonl    One JSON object per line
+    parquet  Columnar, written in batches (requires pyarrow)
+    arrow    Arrow IPC stream, written in batches (requires pyarrow)
+
+csv, jsonl, and arrow output can be compressed with gzip or zstd (zstd
+requires zstandard).  Parquet uses its own internal compression instead.
+"""
+
+from contextlib import contextmanager
+import gzip
+import io
+import json
+import sys
+
+from . import fileio
+
+FORMATS = ['csv', 'jsonl', 'parquet', 'arrow']
+COMPRESSIONS = ['gzip', 'zstd']
+
+# Rows fetched from SQLite per round trip
+CHUNK_SIZE = 2000
+# Rows per Parquet row group / Arrow record batch
+BATCH_SIZE = 50000
+
+
+def queryset(model_class, ids=None, search=None, limit=None):
+    """Select records by primary key, search, or all of them
+
+    @param search: Q object from names.query.to_q()
+    """
+    if ids:
+        query = model_class.objects.filter(pk__in=ids)
+    elif search:
+        query = model_class.objects.filter(search)
+    else:
+        query = model_class.objects.all()
+    query = query.order_by('pk')
+    if limit:
+        query = query[:limit]
+    return query
+
+def check_columns(model_class, columns):
+    """Return list of columns that are not fields of model_class
+    """
+    fieldnames = []
+    for field in model_class._meta.concrete_fields:
+        fieldnames += [field.name, field.attname]
+    return [column for column in columns if column not in fieldnames]
+
+def rows(query, columns, chunk_size=CHUNK_SIZE):
+    """Tuples of column values, fetched chunk_size rows at a time
+    """
+    return query.values_list(*columns).iterator(chunk_size=chunk_size)
+
+@contextmanager
+def output(path=None, compression=None):
+    """Binary file object for path (default STDOUT), optionally compressed
+    """
+    raw = open(path, 'wb') if path else sys.stdout.buffer
+    try:
+        if compression == 'gzip':
+            f = gzip.GzipFile(fileobj=raw, mode='wb')
+        elif compression == 'zstd':
+            import zstandard
+            f = zstandard.ZstdCompressor().stream_writer(raw, closefd=False)
+        else:
+            f = raw
+        yield f
+        if f is not raw:
+            f.close()  # flush the compressor
+    finally:
+        if path:
+            raw.close()
+        else:
+            raw.flush()
+
+def write_csv(f, columns, rows):
+    text = io.TextIOWrapper(f, encoding='utf-8', newline='', write_through=True)
+    writer = fileio.csv_writer(text)
+    writer.writerow(columns)
+    n = 0
+    for row in rows:
+        writer.writerow(row)
+        n += 1
+    text.detach()
+    return n
+
+def write_jsonl(f, columns, rows):
+    n = 0
+    for row in rows:
+        f.write(
+            json.dumps(dict(zip(columns, row)), default=str).encode('utf-8')
+        )
+        f.write(b'\n')
+        n += 1
+    return n
+
+def _batches(rows, batch_size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def arrow_schema(model_class, columns):
+    """pyarrow.Schema for columns of model_class, from Django field types
+    """
+    import pyarrow as pa
+    TYPES = {
+        'AutoField': pa.int64(),
+        'BigAutoField': pa.int64(),
+        'BooleanField': pa.bool_(),
+        'DateField': pa.date32(),
+        'DateTimeField': pa.timestamp('us'),
+        'FloatField': pa.float64(),
+        'IntegerField': pa.int64(),
+        'PositiveIntegerField': pa.int64(),
+        'SmallIntegerField': pa.int64(),
+    }
+    model_fields = {}
+    for field in model_class._meta.concrete_fields:
+        model_fields[field.name] = model_fields[field.attname] = field
+    fields = []
+    for column in columns:
+        field = model_fields[column]
+        if field.is_relation:
+            field = field.target_field
+        fields.append(
+            pa.field(column, TYPES.get(field.get_internal_type(), pa.string()))
+        )
+    return pa.schema(fields)
+
+def _record_batch(schema, batch):
+    import pyarrow as pa
+    columns = list(zip(*batch))
+    return pa.RecordBatch.from_arrays(
+        [
+            pa.array(column, type=field.type) for field,column in zip(schema, columns)
+        ],
+        schema=schema,
+    )
+
+def write_parquet(f, schema, rows, compression=None, batch_size=BATCH_SIZE):
+    import pyarrow.parquet as pq
+    n = 0
+    with pq.ParquetWriter(f, schema, compression=compression or 'snappy') as writer:
+        for batch in _batches(rows, batch_size):
+            writer.write_batch(_record_batch(schema, batch))
+            n += len(batch)
+    return n
+
+def write_arrow(f, schema, rows, batch_size=BATCH_SIZE):
+    import pyarrow as pa
+    n = 0
+    with pa.ipc.new_stream(f, schema) as writer:
+        for batch in _batches(rows, batch_size):
+            writer.write_batch(_record_batch(schema, batch))
+            n += len(batch)
+    return n
+
+def export(model_class, columns, query, fmt='csv', path=None, compression=None):
+    """Write columns of records selected by query to path (default STDOUT)
+
+    @param model_class: Django model class
+    @param columns: list Field names
+    @param query: QuerySet from queryset()
+    @param fmt: str One of FORMATS
+    @param path: str Output file (default: STDOUT)
+    @param compression: str One of COMPRESSIONS or None
+    @returns: int Number of rows written
+    """
+    if fmt not in FORMATS:
+        raise Exception(f'Unknown format "{fmt}"')
+    if compression and compression not in COMPRESSIONS:
+        raise Exception(f'Unknown compression "{compression}"')
+    data = rows(query, columns)
+    if fmt == 'parquet':
+        # Parquet compresses column chunks itself
+        if not path:
+            raise Exception('Parquet output must be written to a file')
+        schema = arrow_schema(model_class, columns)
+        with output(path) as f:
+            return write_parquet(f, schema, data, compression)
+    with output(path, compression) as f:
+        if fmt == 'csv':
+            return write_csv(f, columns, data)
+        elif fmt == 'jsonl':
+            return write_jsonl(f, columns, data)
+        elif fmt == 'arrow':
+            return write_arrow(f, arrow_schema(model_class, columns), data)
@@ -0,0 +1,207 @@
+"""Materialized family groupings (names_family)
+
+Person, FarRecord, and WraRecord documents each list the other members of
+their family.  Rather than grouping the whole table on every post, the
+members of each family are kept in names_family as a JSON list of the
+fields that are published, with birth dates already reduced to years:
+
+    CREATE TABLE names_family (
+        model varchar(32) NOT NULL,
+        family_key varchar(255) NOT NULL,
+        members text NOT NULL,
+        PRIMARY KEY (model, family_key)
+    ) WITHOUT ROWID;
+
+The table is created and filled by migration 0017.  Saving or deleting a
+record refreshes the family it belongs to (and the one it left if its
+family number changed); loaders suspend that with deferred() and rebuild
+at the end.  `namesdb family --rebuild` regenerates it in one pass.
+"""
+
+from contextlib import contextmanager
+import json
+
+from django.db import connections, transaction
+
+TABLE = 'names_family'
+
+CREATE_SQL = f"""CREATE TABLE IF NOT EXISTS {TABLE} (
+    model varchar(32) NOT NULL,
+    family_key varchar(255) NOT NULL,
+    members text NOT NULL,
+    PRIMARY KEY (model, family_key)
+) WITHOUT ROWID;"""
+
+# model: (table, family key column, primary key column, member fields)
+# Member fields are (name in document, SQL expression).
+FAMILIES = {
+    'person': ('names_person', 'wra_family_no', 'nr_id', [
+        ('nr_id', 'nr_id'),
+        ('preferred_name', 'preferred_name'),
+        # redact exact birth date
+        ('birth_year', 'CAST(substr(birth_date, 1, 4) AS INTEGER)'),
+        ('wra_individual_no', 'wra_individual_no'),
+        ('gender', 'gender'),
+    ]),
+    'farrecord': ('names_farrecord', 'family_number', 'far_record_id', [
+        ('far_record_id', 'far_record_id'),
+        ('last_name', 'last_name'),
+        ('first_name', 'first_name'),
+    ]),
+    'wrarecord': ('names_wrarecord', 'familyno', 'wra_record_id', [
+        ('wra_record_id', 'wra_record_id'),
+        ('lastname', 'lastname'),
+        ('firstname', 'firstname'),
+    ]),
+}
+
+# Models whose refreshes are put off until the end of a deferred() block
+_deferred = set()
+
+
+def _select_sql(model, where=''):
+    """INSERT ... SELECT that groups model's table into families
+
+    Members are listed in rowid (insertion) order, as before.
+    """
+    table,key,pk,fields = FAMILIES[model]
+    members = ', '.join(f"'{name}', {expr}" for name,expr in fields)
+    return f"""
+        INSERT INTO {TABLE} (model, family_key, members)
+        SELECT '{model}', {key}, json_group_array(json_object({members}))
+        FROM (SELECT * FROM {table} WHERE {key} IS NOT NULL AND {key} != ''
+              {where} ORDER BY {key}, rowid)
+        GROUP BY {key};
+    """
+
+def create(using='names'):
+    with connections[using].cursor() as cursor:
+        cursor.execute(CREATE_SQL)
+
+def rebuild(model_names=None, using='names'):
+    """Regenerate families of models (default: all) in one statement each
+
+    @returns: dict model: number of families
+    """
+    counts = {}
+    with transaction.atomic(using=using), connections[using].cursor() as cursor:
+        cursor.execute(CREATE_SQL)
+        for model in model_names or FAMILIES.keys():
+            cursor.execute(f'DELETE FROM {TABLE} WHERE model=%s', [model])
+            cursor.execute(_select_sql(model))
+            counts[model] = cursor.rowcount
+    return counts
+
+def refresh(model, keys, using='names'):
+    """Regenerate the listed families of model"""
+    keys = [key for key in set(keys) if key]
+    if not keys:
+        return
+    placeholders = ','.join(['%s'] * len(keys))
+    table,key,pk,fields = FAMILIES[model]
+    with transaction.atomic(using=using), connections[using].cursor() as cursor:
+        cursor.execute(
+            f'DELETE FROM {TABLE} WHERE model=%s AND family_key IN ({placeholders})',
+            [model] + keys
+        )
+        cursor.execute(
+            _select_sql(model, f'AND {key} IN ({placeholders})'), keys
+        )
+
+def member_ids(model, keys, using='names'):
+    """Primary keys of the members of model's families with keys"""
+    keys = [key for key in set(keys) if key]
+    if not keys:
+        return []
+    placeholders = ','.join(['%s'] * len(keys))
+    table,key,pk,fields = FAMILIES[model]
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            f"SELECT json_extract(value, '$.{pk}') FROM {TABLE}, json_each(members) "
+            f"WHERE model=%s AND family_key IN ({placeholders})",
+            [model] + keys
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+def load(model, ids=None, using='names'):
+    """Families of model, optionally only those of the records with ids
+
+    @returns: dict family_key: list of member dicts
+    """
+    table,key,pk,fields = FAMILIES[model]
+    sql = f'SELECT family_key, members FROM {TABLE} WHERE model=%s'
+    params = [model]
+    if ids is not None:
+        if not ids:
+            return {}
+        placeholders = ','.join(['%s'] * len(ids))
+        sql += (
+            f' AND family_key IN '
+            f'(SELECT {key} FROM {table} WHERE {pk} IN ({placeholders}))'
+        )
+        params += list(ids)
+    with connections[using].cursor() as cursor:
+        cursor.execute(sql, params)
+        return {
+            family_key: json.loads(members)
+            for family_key,members in cursor.fetchall()
+        }
+
+@contextmanager
+def deferred(model):
+    """Skip per-record refreshes of model's families, rebuild them at the end
+
+    For loaders that save many records one at a time.  Does nothing for
+    models without families.
+    """
+    if model not in FAMILIES:
+        yield
+        return
+    _deferred.add(model)
+    try:
+        yield
+    finally:
+        _deferred.discard(model)
+    rebuild([model])
+
+
+# signal receivers (connected in names.apps) ---------------------------
+
+def create_table(sender, using=None, **kwargs):
+    """post_migrate receiver: make sure names_family exists
+
+    Test databases are built from the models, not the migrations.
+    """
+    if using == 'names':
+        create(using)
+
+def _model(sender):
+    return sender.__name__.lower()
+
+def remember_key(sender, instance, **kwargs):
+    """pre_save receiver: note the family the record is leaving, if any"""
+    model = _model(sender)
+    if model in _deferred:
+        return
+    table,key,pk,fields = FAMILIES[model]
+    instance._family_key_old = sender.objects.filter(
+        pk=instance.pk
+    ).values_list(key, flat=True).first()
+
+def refresh_saved(sender, instance, **kwargs):
+    """post_save receiver: refresh the record's old and new families"""
+    model = _model(sender)
+    if model in _deferred:
+        return
+    table,key,pk,fields = FAMILIES[model]
+    refresh(model, [
+        getattr(instance, key), getattr(instance, '_family_key_old', None)
+    ])
+
+def refresh_deleted(sender, instance, **kwargs):
+    """post_delete receiver: refresh the family the record was in"""
+    model = _model(sender)
+    if model in _deferred:
+        return
+    table,key,pk,fields = FAMILIES[model]
+    refresh(model, [getattr(instance, key)])
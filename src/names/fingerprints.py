@@ -0,0 +1,107 @@
+"""Hashes of the documents last published to each Elasticsearch index
+
+Kept in the state database (see names.statedb) so that `namesdb post`
+only sends documents whose content changed since they were last posted,
+and can tell which documents no longer have a record in the database.
+
+Fingerprints are kept per index *instance*, under key(), which includes
+the UUID of the concrete index behind the name or alias.  An index that
+is destroyed and re-created, or the same index name on another cluster,
+starts with no fingerprints, so everything is posted to it.  `namesdb
+create` and `destroy` also clear() them.
+"""
+
+from contextlib import closing
+import hashlib
+import json
+
+from elasticsearch.exceptions import NotFoundError
+
+from . import statedb
+
+# Rows per executemany()
+BATCH_SIZE = 1000
+
+
+def canonical(doc):
+    """Canonical JSON of an Elasticsearch document
+    """
+    return json.dumps(
+        doc.to_dict(), sort_keys=True, separators=(',', ':'), default=str
+    )
+
+def digest(doc, text=None):
+    """SHA1 of the canonical JSON of an Elasticsearch document
+    
+    @param text: str canonical(doc), if the caller already has it
+    """
+    if text is None:
+        text = canonical(doc)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+def key(ds, index):
+    """Fingerprint key of index on ds's cluster: "NAME@UUID"
+
+    @param index: str Name of index or alias
+    @returns: str, or None if the index does not exist
+    """
+    try:
+        response = ds.es.indices.get_settings(index=index, name='index.uuid')
+    except NotFoundError:
+        return None
+    uuids = sorted(
+        data['settings']['index']['uuid'] for data in response.values()
+    )
+    return f"{index}@{','.join(uuids)}"
+
+def load(key):
+    """dict doc_id: hash of documents last published to the index"""
+    if not key:
+        return {}
+    with closing(statedb.connect()) as conn, conn:
+        return dict(conn.execute(
+            'SELECT doc_id, hash FROM fingerprints WHERE index_name=?', (key,)
+        ).fetchall())
+
+def save(key, hashes):
+    """Record (doc_id, hash) pairs as published to the index"""
+    if not key:
+        return
+    with closing(statedb.connect()) as conn, conn:
+        conn.executemany(
+            'INSERT INTO fingerprints (index_name, doc_id, hash) VALUES (?, ?, ?) '
+            'ON CONFLICT (index_name, doc_id) DO UPDATE SET '
+            'hash=excluded.hash, published=CURRENT_TIMESTAMP',
+            [(key, doc_id, h) for doc_id,h in hashes]
+        )
+
+def delete(key, doc_ids):
+    if not key:
+        return
+    with closing(statedb.connect()) as conn, conn:
+        conn.executemany(
+            'DELETE FROM fingerprints WHERE index_name=? AND doc_id=?',
+            [(key, doc_id) for doc_id in doc_ids]
+        )
+
+def clear(index):
+    """Forget every instance of index, e.g. when it is destroyed"""
+    with closing(statedb.connect()) as conn, conn:
+        conn.execute(
+            'DELETE FROM fingerprints '
+            'WHERE index_name=? OR substr(index_name, 1, ?)=?',
+            (index, len(index) + 1, f'{index}@')
+        )
+
+def replace(key, hashes):
+    """Replace all fingerprints for the index e.g. after a reindex
+
+    Fingerprints of the instances it replaced are dropped too.
+    """
+    clear(key.split('@')[0])
+    for n in range(0, len(hashes), BATCH_SIZE):
+        save(key, hashes[n:n+BATCH_SIZE])
+
+def stale(key, doc_ids):
+    """IDs fingerprinted for the index that are not in doc_ids"""
+    return sorted(set(load(key).keys()) - set(doc_ids))
@@ -0,0 +1,152 @@
+"""SQLite FTS5 full-text indexes for the names database
+
+The admin search boxes and `namesdb searchmulti --sql` use these instead of
+OR-ing `icontains` lookups across every column, which scans the whole table.
+
+Indexes are created with sqlite-utils and kept in sync by triggers, so
+edits made in the admin are searchable immediately:
+
+    namesdb fts person
+    namesdb fts farrecord --rebuild
+"""
+
+import re
+import shlex
+
+from django.db import connections
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+
+# Columns indexed for each table.  Column names may be used as prefixes
+# in admin searches e.g. "family_name:yasui".
+FTS_COLUMNS = {
+    'names_person': [
+        'nr_id', 'family_name', 'given_name', 'given_name_alt', 'other_names',
+        'middle_name', 'prefix_name', 'suffix_name', 'jp_name',
+        'preferred_name',
+    ],
+    'names_farrecord': [
+        'far_record_id', 'facility', 'family_number',
+        'last_name', 'first_name', 'other_names',
+        'pre_evacuation_address', 'departure_destination',
+        'camp_address_original', 'original_notes',
+    ],
+    'names_wrarecord': [
+        'wra_record_id', 'facility', 'familyno', 'individualno',
+        'lastname', 'firstname', 'middleinitial',
+        'birthplace', 'originaladdress', 'notes',
+    ],
+    'names_ireirecord': [
+        'irei_id', 'name', 'lastname', 'firstname', 'middlename', 'camps',
+    ],
+}
+
+FIELD_TERM = re.compile(r'^(?P<field>[a-z_]+):(?P<value>.+)$')
+
+
+def fts_table(table):
+    return f'{table}_fts'
+
+# Columns of the FTS indexes found so far: (database NAME, table): [columns]
+_columns = {}
+
+
+def fts_columns(table, using='names'):
+    """List of columns in table's FTS index, or [] if there is no index
+
+    Reads the columns from the database rather than FTS_COLUMNS so that
+    indexes created by hand with fewer columns still work.  Indexes that
+    exist are remembered so searches don't query sqlite_master every time;
+    missing ones are not, so an index made by `namesdb fts` in another
+    process is used as soon as it exists.
+    """
+    key = (connections[using].settings_dict['NAME'], table)
+    if key in _columns:
+        return _columns[key]
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' AND name=%s",
+            [fts_table(table)]
+        )
+        if not cursor.fetchone():
+            return []
+        cursor.execute(f'PRAGMA table_info("{fts_table(table)}")')
+        columns = [row[1] for row in cursor.fetchall()]
+    _columns[key] = columns
+    return columns
+
+def clear_cache():
+    """Forget the FTS columns, e.g. after an index is created or dropped"""
+    _columns.clear()
+
+def enable_fts(path, table, rebuild=False):
+    """Create (or rebuild) FTS5 index with triggers using sqlite-utils
+
+    @param path: str Path to SQLite database file
+    @param table: str Name of content table e.g. 'names_person'
+    @param rebuild: bool Drop and recreate the index
+    """
+    import sqlite_utils
+    db = sqlite_utils.Database(path)
+    if rebuild and db[table].detect_fts():
+        db[table].disable_fts()
+    if not db[table].detect_fts():
+        db[table].enable_fts(
+            FTS_COLUMNS[table], fts_version='FTS5', create_triggers=True
+        )
+    db[table].optimize()
+    clear_cache()
+    return fts_table(table)
+
+def split_terms(text):
+    """Split search text into terms, respecting "quoted phrases"
+    """
+    try:
+        return shlex.split(text)
+    except ValueError:  # unbalanced quotes
+        return text.replace('"', ' ').split()
+
+def quote(term):
+    """Quote term as an FTS5 prefix string so punctuation can't break MATCH
+    """
+    term = term.replace('"', '""')
+    return f'"{term}"*'
+
+def parse_search(text, columns, exact_fields):
+    """Parse admin search text into an FTS5 MATCH expression and exact lookups
+
+    Terms of the form "field:value" are restricted to that FTS column,
+    or become exact lookups if field is listed in exact_fields.
+    All other terms are matched (as prefixes) against every column.
+
+    >>> parse_search('family_name:yasui min', ['family_name'], ['nr_id'])
+    ('family_name : "yasui"* "min"*', {})
+
+    @param text: str Search text from the admin
+    @param columns: list Names of columns in the FTS index
+    @param exact_fields: list Fields that must be matched exactly
+    @returns: (str MATCH expression, dict of exact lookups)
+    """
+    match = []
+    exact = {}
+    for term in split_terms(text):
+        m = FIELD_TERM.match(term)
+        if m and m.group('field') in exact_fields:
+            exact[m.group('field')] = m.group('value')
+        elif m and m.group('field') in columns:
+            match.append(f"{m.group('field')} : {quote(m.group('value'))}")
+        elif term.strip():
+            match.append(quote(term))
+    return ' '.join(match), exact
+
+def match_q(model, expression):
+    """Q object selecting model rows whose FTS index matches expression
+    """
+    table = model._meta.db_table
+    pk = model._meta.pk.column
+    return Q(pk__in=RawSQL(
+        f'SELECT "{pk}" FROM "{table}" WHERE rowid IN ('
+        f'SELECT rowid FROM "{fts_table(table)}" '
+        f'WHERE "{fts_table(table)}" MATCH %s)',
+        [expression]
+    ))
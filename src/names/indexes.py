@@ -0,0 +1,195 @@
+"""Index definitions and index advisor for the names database
+
+INDEXES lists the indexes the editor and the namesdb command rely on.
+Migration 0016 creates them on the tables that exist when it runs.
+`namesdb indexes --apply` creates any that are missing, e.g. on tables
+made by hand or restored from a copy after migrating.
+
+The advisor reads the SQL log written by names.sqllog, runs EXPLAIN QUERY
+PLAN on each distinct statement, and reports
+- defined indexes that don't exist yet,
+- existing indexes that no logged statement uses,
+- statements that scan a whole table, by total time.
+
+    namesdb indexes
+    namesdb indexes --apply
+"""
+
+from collections import OrderedDict
+import re
+import time
+
+from django.db import connections, DatabaseError
+
+from . import database
+
+# name: (table, columns, WHERE clause of partial index or '')
+# "col IS NOT NULL" partial indexes are still used for "col = ?" and
+# "col IN (...)" lookups but leave out the many records with no value.
+INDEXES = OrderedDict([
+    ('names_person_wra_family_no_idx',
+     ('names_person', ['wra_family_no'], 'wra_family_no IS NOT NULL')),
+    ('names_person_family_name_given_name_idx',
+     ('names_person', ['family_name', 'given_name'], '')),
+    ('names_person_timestamp_idx',
+     ('names_person', ['timestamp'], '')),
+    ('names_farrecord_family_number_idx',
+     ('names_farrecord', ['family_number'], 'family_number IS NOT NULL')),
+    ('names_farrecord_facility_far_page_idx',
+     ('names_farrecord', ['facility', 'far_page'], '')),
+    ('names_farrecord_timestamp_idx',
+     ('names_farrecord', ['timestamp'], '')),
+    ('names_wrarecord_familyno_idx',
+     ('names_wrarecord', ['familyno'], 'familyno IS NOT NULL')),
+    ('names_wrarecord_facility_idx',
+     ('names_wrarecord', ['facility'], '')),
+    ('names_wrarecord_timestamp_idx',
+     ('names_wrarecord', ['timestamp'], '')),
+    ('names_ireirecord_timestamp_idx',
+     ('names_ireirecord', ['timestamp'], '')),
+])
+
+USES_INDEX = re.compile(r'USING (COVERING )?INDEX (?P<index>\w+)')
+# Number of sample values used to time an index
+SAMPLES = 20
+
+
+def create_sql(name):
+    table,columns,where = INDEXES[name]
+    cols = ', '.join(f'"{column}"' for column in columns)
+    sql = f'CREATE INDEX IF NOT EXISTS "{name}" ON "{table}" ({cols})'
+    if where:
+        sql += f' WHERE {where}'
+    return sql
+
+def existing(using='names'):
+    """Explicitly created indexes in the database
+
+    Leaves out automatic indexes for primary keys and UNIQUE constraints,
+    which can't be dropped.
+
+    @returns: dict name: table
+    """
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            "SELECT name, tbl_name FROM sqlite_master "
+            "WHERE type='index' AND sql IS NOT NULL AND tbl_name LIKE %s",
+            ['names_%']
+        )
+        return dict(cursor.fetchall())
+
+def workload(records):
+    """Aggregate SQL log records by statement
+
+    @param records: iterable of dicts from sqllog.read()
+    @returns: dict sql: {'count': int, 'ms': float, 'sources': set}
+    """
+    statements = {}
+    for record in records:
+        sql = record['sql']
+        if not sql.lstrip().upper().startswith('SELECT'):
+            continue
+        s = statements.setdefault(sql, {'count': 0, 'ms': 0.0, 'sources': set()})
+        s['count'] += 1
+        s['ms'] += record['ms']
+        s['sources'].add(record['source'])
+    return statements
+
+def plan(sql, using='names'):
+    """EXPLAIN QUERY PLAN for a logged statement
+
+    Parameters aren't logged so NULLs are bound instead; the plan is the
+    same unless a value changes which index SQLite picks.
+    """
+    with connections[using].cursor() as cursor:
+        cursor.execute(f'EXPLAIN QUERY PLAN {sql}', [None] * sql.count('%s'))
+        return [(row[0], row[1], row[-1]) for row in cursor.fetchall()]
+
+def analyze(statements, using='names'):
+    """Index usage and full table scans for workload() statements
+
+    @returns: (dict index: total count, list of (sql, stats, tables scanned))
+    """
+    used = {}
+    scans = []
+    for sql,stats in statements.items():
+        try:
+            rows = plan(sql, using)
+        except DatabaseError:  # table changed since statement was logged
+            continue
+        for _,_,detail in rows:
+            m = USES_INDEX.search(detail)
+            if m:
+                used[m.group('index')] = used.get(m.group('index'), 0) + stats['count']
+        tables = database.full_scans(rows)
+        if tables:
+            scans.append((sql, stats, tables))
+    scans.sort(key=lambda scan: scan[1]['ms'], reverse=True)
+    return used, scans
+
+def _table_exists(table, using='names'):
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' AND name=%s",
+            [table]
+        )
+        return bool(cursor.fetchone())
+
+def missing(using='names'):
+    """Names of defined indexes that do not exist in the database"""
+    present = existing(using)
+    return [
+        name for name,(table,columns,where) in INDEXES.items()
+        if name not in present and _table_exists(table, using)
+    ]
+
+def unused(used, using='names'):
+    """Existing indexes that no logged statement used"""
+    return [
+        (name, table) for name,table in existing(using).items()
+        if name not in used
+    ]
+
+def samples(name, using='names', num=SAMPLES):
+    """Values of the indexed columns from num random rows"""
+    table,columns,where = INDEXES[name]
+    cols = ', '.join(f'"{column}"' for column in columns)
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            f'SELECT {cols} FROM "{table}" WHERE {where or "1"} '
+            f'ORDER BY random() LIMIT %s',
+            [num]
+        )
+        return cursor.fetchall()
+
+def benchmark(name, values, using='names'):
+    """Mean milliseconds of "SELECT * WHERE col1=? [AND col2=?]" lookups
+
+    @param values: list of tuples from samples()
+    """
+    if not values:
+        return None
+    table,columns,where = INDEXES[name]
+    conditions = ' AND '.join(f'"{column}"=%s' for column in columns)
+    with connections[using].cursor() as cursor:
+        start = time.perf_counter()
+        for value in values:
+            cursor.execute(f'SELECT * FROM "{table}" WHERE {conditions}', list(value))
+            cursor.fetchall()
+        return (time.perf_counter() - start) * 1000 / len(values)
+
+def apply(names, using='names'):
+    """Create indexes, timing the same lookups before and after
+
+    @returns: list of (name, ms before, ms after)
+    """
+    results = []
+    for name in names:
+        values = samples(name, using)
+        before = benchmark(name, values, using)
+        with connections[using].cursor() as cursor:
+            cursor.execute(create_sql(name))
+            cursor.execute(f'ANALYZE "{name}"')
+        after = benchmark(name, values, using)
+        results.append((name, before, after))
+    return results
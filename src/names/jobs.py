@@ -0,0 +1,234 @@
+"""Background jobs for admin actions
+
+Admin actions that touch many records (publishing to Elasticsearch,
+exporting CSV, republishing families) are queued in the state database
+(see names.statedb) and run by a worker process, so they don't tie up
+gunicorn workers or hit request timeouts:
+
+    namesdb worker
+
+Editors follow progress at /admin/jobs/.
+"""
+
+from contextlib import closing
+import csv
+from datetime import datetime
+import json
+import logging
+import time
+
+from django.conf import settings
+
+from . import models
+from . import publish
+from . import publisher
+from . import statedb
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# Write progress to the state database every N records
+PROGRESS_INTERVAL = 100
+# Max number of IDs in one "pk IN (...)" query
+CHUNK_SIZE = 500
+
+# Family number field for each model that has families
+FAMILY_FIELDS = {
+    'person': 'wra_family_no',
+    'farrecord': 'family_number',
+    'wrarecord': 'familyno',
+}
+
+
+def enqueue(action, model, ids, username, params=None):
+    """Add a job to the queue
+
+    @param action: str Key in ACTIONS
+    @param model: str Model name e.g. 'person'
+    @param ids: list Primary keys of selected records
+    @param username: str
+    @param params: dict (optional)
+    @returns: int job ID
+    """
+    if action not in ACTIONS:
+        raise Exception(f'Unknown job action "{action}"')
+    if params is None:
+        params = {}
+    with closing(statedb.connect()) as conn, conn:
+        cursor = conn.execute(
+            'INSERT INTO jobs (action, model, ids, params, username, total) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (action, model, json.dumps(ids), json.dumps(params), username, len(ids))
+        )
+        return cursor.lastrowid
+
+def get(job_id):
+    with closing(statedb.connect()) as conn, conn:
+        return conn.execute('SELECT * FROM jobs WHERE id=?', (job_id,)).fetchone()
+
+def recent(limit=50):
+    with closing(statedb.connect()) as conn, conn:
+        return conn.execute(
+            'SELECT id, action, model, username, status, done, total, '
+            'created, started, finished FROM jobs ORDER BY id DESC LIMIT ?',
+            (limit,)
+        ).fetchall()
+
+def claim():
+    """Mark the oldest queued job as running and return it, or None
+    """
+    conn = statedb.connect()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        job = conn.execute(
+            'SELECT * FROM jobs WHERE status=? ORDER BY id LIMIT 1', (QUEUED,)
+        ).fetchone()
+        if job:
+            conn.execute(
+                'UPDATE jobs SET status=?, started=CURRENT_TIMESTAMP WHERE id=?',
+                (RUNNING, job['id'])
+            )
+        conn.commit()
+        return job
+    finally:
+        conn.close()
+
+def requeue_interrupted():
+    """Put jobs left running by a dead worker back in the queue
+    """
+    with closing(statedb.connect()) as conn, conn:
+        return conn.execute(
+            'UPDATE jobs SET status=?, done=0 WHERE status=?', (QUEUED, RUNNING)
+        ).rowcount
+
+def set_progress(job_id, done, total=None):
+    with closing(statedb.connect()) as conn, conn:
+        if total is None:
+            conn.execute('UPDATE jobs SET done=? WHERE id=?', (done, job_id))
+        else:
+            conn.execute(
+                'UPDATE jobs SET done=?, total=? WHERE id=?', (done, total, job_id)
+            )
+
+def finish(job_id, status, result='', error=''):
+    with closing(statedb.connect()) as conn, conn:
+        conn.execute(
+            'UPDATE jobs SET status=?, result=?, error=?, '
+            'finished=CURRENT_TIMESTAMP WHERE id=?',
+            (status, result, error, job_id)
+        )
+
+def run(job):
+    """Run a claimed job and record the outcome
+    """
+    job_id = job['id']
+    ids = json.loads(job['ids'])
+    params = json.loads(job['params'])
+    def progress(done, total=None):
+        if (done % PROGRESS_INTERVAL == 0) or (total is not None):
+            set_progress(job_id, done, total)
+    logging.info(f"job {job_id} {job['action']} {job['model']} ({len(ids)})")
+    try:
+        result = ACTIONS[job['action']](job['model'], ids, params, progress)
+    except Exception as err:
+        logging.exception(f'job {job_id} failed')
+        finish(job_id, FAILED, error=repr(err))
+        return FAILED
+    finish(job_id, DONE, result=result)
+    return DONE
+
+def work(poll_interval=5, burst=False):
+    """Run queued jobs until killed (or until the queue is empty if burst)
+
+    Also publishes records queued by admin edits (see names.publisher).
+    """
+    num = requeue_interrupted()
+    if num:
+        logging.info(f'requeued {num} interrupted jobs')
+    while True:
+        if settings.PUBLISH_ON_SAVE:
+            try:
+                publisher.drain(delay=0 if burst else None)
+            except Exception:
+                logging.exception('publish queue')
+        job = claim()
+        if job:
+            run(job)
+        elif burst:
+            return
+        else:
+            time.sleep(poll_interval)
+
+
+def _records(model_class, ids):
+    """Yield records for the IDs, CHUNK_SIZE at a time"""
+    for chunk in publish.chunks(ids, CHUNK_SIZE):
+        for record in model_class.objects.filter(pk__in=chunk).order_by('pk'):
+            yield record
+
+def _post(model, ids, progress):
+    model_class = models.MODEL_CLASSES[model]
+    ds = publish.docstore_manager()
+    related = publish.load_related(model, ids)
+    failed = publish.post_records(
+        _records(model_class, ids), related, ds, progress
+    )
+    progress(len(ids), len(ids))
+    if failed:
+        return f'Posted {len(ids) - len(failed)} {model} records, ' \
+            f'{len(failed)} failed: {", ".join(str(r.pk) for r in failed)}'
+    return f'Posted {len(ids)} {model} records'
+
+def publish_records(model, ids, params, progress):
+    """Post selected records to Elasticsearch"""
+    return _post(model, ids, progress)
+
+def export_csv(model, ids, params, progress):
+    """Write selected records to a CSV file in settings.EXPORT_ROOT"""
+    model_class = models.MODEL_CLASSES[model]
+    # attname so FKs are written as IDs without fetching related objects
+    columns = [field.attname for field in model_class._meta.fields]
+    settings.EXPORT_ROOT.mkdir(parents=True, exist_ok=True)
+    timestamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+    path = settings.EXPORT_ROOT / f'{model}-{timestamp}.csv'
+    with path.open('w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for n,record in enumerate(_records(model_class, ids)):
+            writer.writerow([getattr(record, column) for column in columns])
+            progress(n+1)
+    progress(len(ids), len(ids))
+    return path.name
+
+def reindex_family(model, ids, params, progress):
+    """Republish the families of the selected records
+
+    Posts all Persons, FarRecords, and WraRecords with the same family number.
+    """
+    model_class = models.MODEL_CLASSES[model]
+    family_nos = set()
+    for chunk in publish.chunks(ids, CHUNK_SIZE):
+        family_nos.update(
+            model_class.objects.filter(pk__in=chunk).values_list(
+                FAMILY_FIELDS[model], flat=True
+            )
+        )
+    family_nos = sorted([f for f in family_nos if f])
+    results = []
+    for family_model,fieldname in FAMILY_FIELDS.items():
+        family_class = models.MODEL_CLASSES[family_model]
+        family_ids = []
+        for chunk in publish.chunks(family_nos, CHUNK_SIZE):
+            family_ids += family_class.objects.filter(
+                **{f'{fieldname}__in': chunk}
+            ).values_list('pk', flat=True)
+        results.append(_post(family_model, family_ids, progress))
+    return f'{len(family_nos)} families. ' + '. '.join(results)
+
+ACTIONS = {
+    'publish': publish_records,
+    'export': export_csv,
+    'reindex_family': reindex_family,
+}
@@ -0,0 +1,79 @@
+"""Cached Facility and FarPage lookups
+
+Facilities and FAR pages are a small vocabulary that almost never changes,
+but posting, loading, and the admin used to query them again every time.
+They are now kept in the Django cache under a version number, with a copy
+in each process.  Saving or deleting a Facility or FarPage (including
+`namesdb load facility`) bumps the version, so every process reloads them
+on its next lookup.
+"""
+
+import time
+
+from django.core.cache import cache
+
+VERSION_KEY = 'names:lookups:version'
+
+# Copies in this process: name: (version, value)
+_local = {}
+
+
+def version():
+    """Current version of the cached lookups"""
+    return cache.get_or_set(VERSION_KEY, 0, timeout=None)
+
+def invalidate(*args, **kwargs):
+    """Make every process reload the lookups (also a post_save/post_delete receiver)"""
+    cache.set(VERSION_KEY, time.time_ns(), timeout=None)
+    _local.clear()
+
+def _cached(name, load):
+    """Value of load() for the current version, from this process or the cache"""
+    v = version()
+    if name in _local and _local[name][0] == v:
+        return _local[name][1]
+    key = f'names:lookups:{name}:{v}'
+    value = cache.get(key)
+    if value is None:
+        value = load()
+        cache.set(key, value, timeout=None)
+    _local[name] = (v, value)
+    return value
+
+def facilities():
+    """dict facility_id: Facility
+
+    The Facility objects are shared; copy one before changing it.
+    """
+    from .models import Facility
+    return _cached('facilities', lambda: {
+        f.facility_id: f for f in Facility.objects.all()
+    })
+
+def facility_titles():
+    """dict facility_id: title"""
+    return {
+        facility_id: facility.title
+        for facility_id,facility in facilities().items()
+    }
+
+def far_pages():
+    """dict (facility_id, page): file_id
+
+    If a page has more than one file the lowest file_id wins.
+    """
+    from .models import FarPage
+    return _cached('farpages', lambda: {
+        (facility_id, page): file_id
+        for facility_id,page,file_id in FarPage.objects.order_by(
+            '-file_id'
+        ).values_list('facility_id', 'page', 'file_id')
+    })
+
+def far_page_file_id(facility_id, page):
+    """file_id of FAR ledger page, or None"""
+    try:
+        page = int(page)
+    except (TypeError, ValueError):
+        return None
+    return far_pages().get((facility_id, page))
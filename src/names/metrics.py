@@ -0,0 +1,268 @@
+"""Timings, counts, and memory use of namesdb runs
+
+Each namesdb command is a run.  Code that does the work records how long
+each stage took and how many rows and bytes went through it:
+
+    with metrics.span('post.related'):
+        related = load_related(model)
+
+    with metrics.timer('post.document') as stage:
+        doc = record.es_document(related)
+        stage.rows += 1
+
+span() also records an OpenTelemetry-style span; use it for the few big
+phases of a command and timer() for things done once per row.
+iterate() times each step of an iterator, e.g. rows fetched from SQLite.
+Resident memory is sampled at the end of each span.
+
+When the run ends the totals can be appended to a JSON log, written to a
+Prometheus textfile, and the spans appended to a file (see settings
+METRICS_LOG, METRICS_TEXTFILE_DIR, METRICS_SPANS).  report() is the
+per-stage breakdown that `--stages` prints.
+"""
+
+from contextlib import contextmanager
+import json
+import os
+from pathlib import Path
+import resource
+import secrets
+import sys
+import time
+
+
+class Stage():
+    """Totals for one stage of a run"""
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.seconds = 0.0
+        self.rows = 0
+        self.bytes = 0
+        self.rss = 0  # largest resident memory seen at the end of a span
+
+    def add(self, seconds=0.0, rows=0, bytes=0):
+        self.calls += 1
+        self.seconds += seconds
+        self.rows += rows
+        self.bytes += bytes
+
+    def dict(self):
+        return {
+            'calls': self.calls,
+            'seconds': round(self.seconds, 6),
+            'rows': self.rows,
+            'bytes': self.bytes,
+            'rss': self.rss,
+        }
+
+
+class Run():
+    """Stages and spans of one command"""
+
+    def __init__(self, command):
+        self.command = command
+        self.trace_id = secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.start = time.time_ns()
+        self.perf_start = time.perf_counter()
+        self.elapsed = 0.0
+        self.stages = {}
+        self.spans = []
+        self.parents = [self.span_id]
+
+    def stage(self, name):
+        if name not in self.stages:
+            self.stages[name] = Stage(name)
+        return self.stages[name]
+
+    def dict(self):
+        return {
+            'ts': round(self.start / 1e9, 3),
+            'command': self.command,
+            'trace_id': self.trace_id,
+            'elapsed': round(self.elapsed, 6),
+            'peak_rss': peak_rss(),
+            'stages': {name: stage.dict() for name,stage in self.stages.items()},
+        }
+
+
+_run = Run(None)
+
+
+def start(command):
+    """Begin a new run, discarding the previous one"""
+    global _run
+    _run = Run(command)
+    return _run
+
+def current():
+    return _run
+
+def finish():
+    """Stop the run's clock and close its root span"""
+    _run.elapsed = time.perf_counter() - _run.perf_start
+    _run.spans.append(_span_dict(
+        _run.command, _run.span_id, None, _run.start, time.time_ns(),
+        {'peak_rss': peak_rss()},
+    ))
+    return _run
+
+def add(name, seconds=0.0, rows=0, bytes=0):
+    """Add to the totals of a stage"""
+    _run.stage(name).add(seconds, rows, bytes)
+
+@contextmanager
+def timer(name):
+    """Time the block as one call of the stage; yields the Stage"""
+    stage = _run.stage(name)
+    start = time.perf_counter()
+    try:
+        yield stage
+    finally:
+        stage.add(time.perf_counter() - start)
+
+@contextmanager
+def span(name, **attributes):
+    """timer() that also records a span and samples resident memory"""
+    span_id = secrets.token_hex(8)
+    parent = _run.parents[-1]
+    _run.parents.append(span_id)
+    start = time.time_ns()
+    try:
+        with timer(name) as stage:
+            yield stage
+    finally:
+        _run.parents.pop()
+        stage.rss = max(stage.rss, rss())
+        _run.spans.append(_span_dict(
+            name, span_id, parent, start, time.time_ns(), attributes
+        ))
+
+def iterate(name, iterable):
+    """Yield from iterable, timing each step as a row of the stage"""
+    stage = _run.stage(name)
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            stage.seconds += time.perf_counter() - start
+            return
+        stage.add(time.perf_counter() - start, rows=1)
+        yield item
+
+def _span_dict(name, span_id, parent_id, start, end, attributes):
+    return {
+        'traceId': _run.trace_id,
+        'spanId': span_id,
+        'parentSpanId': parent_id,
+        'name': name,
+        'startTimeUnixNano': start,
+        'endTimeUnixNano': end,
+        'attributes': dict(attributes, command=_run.command),
+    }
+
+
+# memory ---------------------------------------------------------------
+
+def peak_rss():
+    """Largest resident set size of this process so far, in bytes"""
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return maxrss
+    return maxrss * 1024
+
+def rss():
+    """Current resident set size in bytes (peak if not available)"""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return peak_rss()
+
+
+# output ---------------------------------------------------------------
+
+def report(run=None):
+    """Lines of the per-stage breakdown, slowest first"""
+    run = run or _run
+    elapsed = run.elapsed or (time.perf_counter() - run.perf_start)
+    yield (
+        f'{"stage":<28} {"calls":>8} {"seconds":>10} {"%":>6} '
+        f'{"rows":>10} {"rows/s":>10} {"MB":>9} {"rss MB":>8}'
+    )
+    for stage in sorted(run.stages.values(), key=lambda s: -s.seconds):
+        rate = stage.rows / stage.seconds if stage.seconds else 0
+        yield (
+            f'{stage.name:<28} {stage.calls:>8} {stage.seconds:>10.3f} '
+            f'{100 * stage.seconds / elapsed if elapsed else 0:>6.1f} '
+            f'{stage.rows:>10} {rate:>10.0f} {stage.bytes / 1e6:>9.1f} '
+            f'{stage.rss / 1e6:>8.0f}'
+        )
+    yield (
+        f'{run.command}: {elapsed:.3f}s, '
+        f'peak resident memory {peak_rss() / 1e6:.0f} MB'
+    )
+
+def write_log(path, run=None):
+    """Append the run's totals to a JSON lines file"""
+    run = run or _run
+    with open(path, 'a') as f:
+        f.write(json.dumps(run.dict()) + '\n')
+
+def write_spans(path, run=None):
+    """Append the run's spans to a JSON lines file"""
+    run = run or _run
+    with open(path, 'a') as f:
+        for span_ in run.spans:
+            f.write(json.dumps(span_) + '\n')
+
+def prometheus(run=None):
+    """The run's totals in Prometheus text exposition format"""
+    run = run or _run
+    command = run.command
+    lines = []
+    def metric(name, kind, help, samples):
+        lines.append(f'# HELP namesdb_{name} {help}')
+        lines.append(f'# TYPE namesdb_{name} {kind}')
+        for labels,value in samples:
+            labels = ','.join(f'{key}="{val}"' for key,val in labels.items())
+            lines.append(f'namesdb_{name}{{{labels}}} {value}')
+    stages = run.stages.values()
+    metric('stage_seconds', 'gauge', 'Seconds spent in each stage of the last run', [
+        ({'command': command, 'stage': s.name}, round(s.seconds, 6)) for s in stages
+    ])
+    metric('stage_calls', 'gauge', 'Calls of each stage in the last run', [
+        ({'command': command, 'stage': s.name}, s.calls) for s in stages
+    ])
+    metric('stage_rows', 'gauge', 'Rows through each stage in the last run', [
+        ({'command': command, 'stage': s.name}, s.rows) for s in stages
+    ])
+    metric('stage_bytes', 'gauge', 'Bytes through each stage in the last run', [
+        ({'command': command, 'stage': s.name}, s.bytes) for s in stages
+    ])
+    metric('run_seconds', 'gauge', 'Duration of the last run', [
+        ({'command': command}, round(run.elapsed, 6))
+    ])
+    metric('run_peak_rss_bytes', 'gauge', 'Peak resident memory of the last run', [
+        ({'command': command}, peak_rss())
+    ])
+    metric('run_timestamp_seconds', 'gauge', 'When the last run started', [
+        ({'command': command}, round(run.start / 1e9, 3))
+    ])
+    return '\n'.join(lines) + '\n'
+
+def write_textfile(directory, run=None):
+    """Write namesdb-COMMAND.prom for the node_exporter textfile collector
+
+    The file is replaced atomically so the collector never reads half of it.
+    """
+    run = run or _run
+    path = Path(directory) / f'namesdb-{run.command}.prom'
+    tmp = path.with_suffix(f'.prom.{os.getpid()}')
+    tmp.write_text(prometheus(run))
+    tmp.replace(path)
+    return path
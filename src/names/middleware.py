@@ -0,0 +1,98 @@
+from collections import Counter
+from contextlib import ExitStack
+import json
+from pathlib import Path
+import time
+
+from django.conf import settings
+from django.db import connections
+
+from . import profiling
+from . import sqllog
+
+
+class SQLLogMiddleware:
+    """Record names database statements run by each request (see names.sqllog)
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with sqllog.capture('web'):
+            return self.get_response(request)
+
+
+class SQLCounter:
+    """Django execute_wrapper that counts and times statements by database"""
+
+    def __init__(self):
+        self.queries = Counter()
+        self.seconds = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            alias = context['connection'].alias
+            self.queries[alias] += 1
+            self.seconds[alias] += time.perf_counter() - start
+
+
+class ProfileMiddleware:
+    """Record SQL count and time of each request, and profile slow ones
+
+    Each request appends a line to PROFILE_DIR/requests.jsonl:
+
+        {"ts": 1700000000.0, "method": "GET", "path": "/admin/names/person/",
+         "status": 200, "ms": 812.4, "queries": {"names": 14, "default": 3},
+         "sql_ms": {"names": 640.2, "default": 1.1}, "profile": "..."}
+
+    and reports the same numbers in a Server-Timing header.  Every request
+    is sampled (see names.profiling.Sampler); for requests that take
+    settings.PROFILE_SLOW_MS or longer the samples are written to
+    PROFILE_DIR as collapsed stacks and named in "profile".
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.directory = Path(settings.PROFILE_DIR)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.log = self.directory / 'requests.jsonl'
+
+    def __call__(self, request):
+        counter = SQLCounter()
+        sampler = profiling.Sampler().start()
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for alias in connections:
+                    stack.enter_context(connections[alias].execute_wrapper(counter))
+                response = self.get_response(request)
+        finally:
+            sampler.stop()
+        ms = (time.perf_counter() - start) * 1000
+        record = {
+            'ts': round(time.time(), 3),
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'ms': round(ms, 1),
+            'queries': dict(counter.queries),
+            'sql_ms': {
+                alias: round(seconds * 1000, 1)
+                for alias,seconds in counter.seconds.items()
+            },
+        }
+        if ms >= settings.PROFILE_SLOW_MS:
+            base = profiling.path_base(self.directory, 'request')
+            record['profile'] = str(sampler.write(f'{base}.collapsed'))
+        with self.log.open('a') as f:
+            f.write(json.dumps(record) + '\n')
+        response['Server-Timing'] = ', '.join([
+            f'sql;dur={sum(counter.seconds.values()) * 1000:.1f};'
+            f'desc="{sum(counter.queries.values())} queries"',
+            f'total;dur={ms:.1f}',
+        ])
+        return response
@@ -0,0 +1,57 @@
+# Indexes for family, name, facility, and timestamp lookups.
+# names.indexes defines the current set; `namesdb indexes` reports on them.
+# The statements are copied here so later changes to names.indexes don't
+# change what this migration does.
+
+from django.db import DatabaseError, migrations
+
+# (name, table, CREATE INDEX statement)
+INDEXES = [
+    ('names_person_wra_family_no_idx', 'names_person',
+     'CREATE INDEX IF NOT EXISTS "names_person_wra_family_no_idx" ON "names_person" ("wra_family_no") WHERE wra_family_no IS NOT NULL'),
+    ('names_person_family_name_given_name_idx', 'names_person',
+     'CREATE INDEX IF NOT EXISTS "names_person_family_name_given_name_idx" ON "names_person" ("family_name", "given_name")'),
+    ('names_person_timestamp_idx', 'names_person',
+     'CREATE INDEX IF NOT EXISTS "names_person_timestamp_idx" ON "names_person" ("timestamp")'),
+    ('names_farrecord_family_number_idx', 'names_farrecord',
+     'CREATE INDEX IF NOT EXISTS "names_farrecord_family_number_idx" ON "names_farrecord" ("family_number") WHERE family_number IS NOT NULL'),
+    ('names_farrecord_facility_far_page_idx', 'names_farrecord',
+     'CREATE INDEX IF NOT EXISTS "names_farrecord_facility_far_page_idx" ON "names_farrecord" ("facility", "far_page")'),
+    ('names_farrecord_timestamp_idx', 'names_farrecord',
+     'CREATE INDEX IF NOT EXISTS "names_farrecord_timestamp_idx" ON "names_farrecord" ("timestamp")'),
+    ('names_wrarecord_familyno_idx', 'names_wrarecord',
+     'CREATE INDEX IF NOT EXISTS "names_wrarecord_familyno_idx" ON "names_wrarecord" ("familyno") WHERE familyno IS NOT NULL'),
+    ('names_wrarecord_facility_idx', 'names_wrarecord',
+     'CREATE INDEX IF NOT EXISTS "names_wrarecord_facility_idx" ON "names_wrarecord" ("facility")'),
+    ('names_wrarecord_timestamp_idx', 'names_wrarecord',
+     'CREATE INDEX IF NOT EXISTS "names_wrarecord_timestamp_idx" ON "names_wrarecord" ("timestamp")'),
+    ('names_ireirecord_timestamp_idx', 'names_ireirecord',
+     'CREATE INDEX IF NOT EXISTS "names_ireirecord_timestamp_idx" ON "names_ireirecord" ("timestamp")'),
+]
+
+
+def create_indexes(apps, schema_editor):
+    tables = schema_editor.connection.introspection.table_names()
+    for name,table,sql in INDEXES:
+        if table not in tables:
+            continue
+        try:
+            schema_editor.execute(sql)
+        except DatabaseError as err:
+            # tables created by hand may be missing columns
+            print(f'\n  Skipping {name}: {err}')
+
+def drop_indexes(apps, schema_editor):
+    for name,table,sql in INDEXES:
+        schema_editor.execute(f'DROP INDEX IF EXISTS "{name}"')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('names', '0015_auto_20210816_1326'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_indexes, drop_indexes),
+    ]
@@ -0,0 +1,78 @@
+# Materialized family groupings.  See names.family.
+# The statements are copied here so later changes to names.family don't
+# change what this migration does.
+
+from django.db import DatabaseError, migrations
+
+CREATE_SQL = """CREATE TABLE IF NOT EXISTS names_family (
+    model varchar(32) NOT NULL,
+    family_key varchar(255) NOT NULL,
+    members text NOT NULL,
+    PRIMARY KEY (model, family_key)
+) WITHOUT ROWID;"""
+
+# (model, INSERT ... SELECT that groups its table into families)
+FILL_SQL = [
+    ('person', """
+        INSERT INTO names_family (model, family_key, members)
+        SELECT 'person', wra_family_no, json_group_array(json_object(
+            'nr_id', nr_id,
+            'preferred_name', preferred_name,
+            'birth_year', CAST(substr(birth_date, 1, 4) AS INTEGER),
+            'wra_individual_no', wra_individual_no,
+            'gender', gender
+        ))
+        FROM (SELECT * FROM names_person
+              WHERE wra_family_no IS NOT NULL AND wra_family_no != ''
+              ORDER BY wra_family_no, rowid)
+        GROUP BY wra_family_no;
+    """),
+    ('farrecord', """
+        INSERT INTO names_family (model, family_key, members)
+        SELECT 'farrecord', family_number, json_group_array(json_object(
+            'far_record_id', far_record_id,
+            'last_name', last_name,
+            'first_name', first_name
+        ))
+        FROM (SELECT * FROM names_farrecord
+              WHERE family_number IS NOT NULL AND family_number != ''
+              ORDER BY family_number, rowid)
+        GROUP BY family_number;
+    """),
+    ('wrarecord', """
+        INSERT INTO names_family (model, family_key, members)
+        SELECT 'wrarecord', familyno, json_group_array(json_object(
+            'wra_record_id', wra_record_id,
+            'lastname', lastname,
+            'firstname', firstname
+        ))
+        FROM (SELECT * FROM names_wrarecord
+              WHERE familyno IS NOT NULL AND familyno != ''
+              ORDER BY familyno, rowid)
+        GROUP BY familyno;
+    """),
+]
+
+
+def create_family(apps, schema_editor):
+    schema_editor.execute(CREATE_SQL)
+    for model,sql in FILL_SQL:
+        try:
+            schema_editor.execute(sql)
+        except DatabaseError as err:
+            # tables created by hand may be missing columns
+            print(f'\n  Skipping {model} families: {err}')
+
+def drop_family(apps, schema_editor):
+    schema_editor.execute('DROP TABLE IF EXISTS "names_family"')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('names', '0016_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_family, drop_family),
+    ]
@@ -2,7 +2,6 @@ from datetime import datetime, date
 import difflib
 import json
 
-from dateutil import parser
 from httpx import RequestError
 from tabulate import tabulate
 
@@ -13,7 +12,8 @@ from django.db import connections, models
 from django.urls import reverse
 from django.utils import timezone
 
-from names import csvfile,fileio,noidminter
+from names import csvfile,dates,export,family,fileio,lookups,noidminter
+from names import INDEX_PREFIX
 from namesdb_public.models import Person as ESPerson, FIELDS_PERSON
 from namesdb_public.models import Facility as ESFacility
 from namesdb_public.models import PersonLocation as ESPersonLocation
@@ -24,8 +24,6 @@ from namesdb_public.models import FIELDS_BY_MODEL
 from ireizo_public.models import IreiRecord as ESIreiRecord, FIELDS_IREIRECORD
 
 
-INDEX_PREFIX = 'names'
-
 ELASTICSEARCH_CLASSES = {
     'all': [
         {'doctype': 'person', 'class': ESPerson},
@@ -49,6 +47,15 @@ ELASTICSEARCH_CLASSES_BY_MODEL = {
 }
 
 
+def _where_in(column, ids):
+    """SQL WHERE clause and params limiting a query to ids (None: no limit)
+    """
+    if ids is None:
+        return '',[]
+    placeholders = ','.join(['%s'] * len(ids))
+    return f'WHERE {column} IN ({placeholders})', list(ids)
+
+
 class NamesRouter:
     """Write all Names DB data to separate DATABASES['names'] database.
     
@@ -192,12 +199,17 @@ class Facility(models.Model):
             d[fieldname] = value
         return d
 
-    def post(self, related, ds):
-        """Post Facility record to Elasticsearch
+    def es_document(self, related):
+        """Elasticsearch document for Facility record
         """
         data = self.dict(related)
         es_class = ELASTICSEARCH_CLASSES_BY_MODEL['facility']
-        return es_class.from_dict(data['facility_id'], data).save(
+        return es_class.from_dict(data['facility_id'], data)
+
+    def post(self, related, ds):
+        """Post Facility record to Elasticsearch
+        """
+        return self.es_document(related).save(
             index=ds.index_name('facility'), using=ds.es
         )
 
@@ -256,10 +268,7 @@ class Location(models.Model):
         """Prepare data for loading CSV full of Locations
         """
         return {
-            'facilities': {
-                f.facility_id:
-                f for f in Facility.objects.all()
-            },
+            'facilities': dict(lookups.facilities()),
         }
 
     @staticmethod
@@ -410,26 +419,23 @@ ALTER TABLE names_person ADD COLUMN "wikidata_url" varchar(255) NULL;
             names = names.replace("'",'').replace('"','').split(',')
             if names:
                 o.other_names = '\n'.join(names)
+        # dates that can't be parsed are left out
         if rowd.get('birth_date'):
-            try:
-                o.birth_date = parser.parse(rowd.pop('birth_date')).date()
-            except parser._parser.ParserError:
-                pass
+            birth_date = dates.parse(rowd.pop('birth_date'))
+            if birth_date:
+                o.birth_date = birth_date.date()
         elif rowd.get('birth_date_text'):
-            try:
-                o.birth_date = parser.parse(rowd.pop('birth_date_text')).date()
-            except parser._parser.ParserError:
-                pass
+            birth_date = dates.parse(rowd.pop('birth_date_text'))
+            if birth_date:
+                o.birth_date = birth_date.date()
         if rowd.get('death_date'):
-            try:
-                o.death_date = parser.parse(rowd.pop('death_date')).date()
-            except parser._parser.ParserError:
-                pass
+            death_date = dates.parse(rowd.pop('death_date'))
+            if death_date:
+                o.death_date = death_date.date()
         elif rowd.get('death_date_text'):
-            try:
-                o.death_date = parser.parse(rowd.pop('death_date_text')).date()
-            except parser._parser.ParserError:
-                pass
+            death_date = dates.parse(rowd.pop('death_date_text'))
+            if death_date:
+                o.death_date = death_date.date()
         # everything else
         for key,val in rowd.items():
             val = val.strip()
@@ -526,21 +532,25 @@ ALTER TABLE names_person ADD COLUMN "wikidata_url" varchar(255) NULL;
             )
 
     @staticmethod
-    def related_farrecords():
+    def related_farrecords(nr_ids=None):
         """Build dict of Person->FarRecord relations
+        
+        @param nr_ids: list Limit to these Persons (default: all)
         """
-        facility_titles = {f.facility_id: f.title for f in Facility.objects.all()}
-        query = """
+        facility_titles = lookups.facility_titles()
+        where,params = _where_in('names_person.nr_id', nr_ids)
+        query = f"""
             SELECT names_person.nr_id,
                    names_farrecord.far_record_id,
                    names_farrecord.facility,
                    names_farrecord.last_name, names_farrecord.first_name
             FROM names_farrecord INNER JOIN names_person
-            ON names_farrecord.person_id = names_person.nr_id;
+            ON names_farrecord.person_id = names_person.nr_id
+            {where};
         """
         x = {}
         with connections['names'].cursor() as cursor:
-            cursor.execute(query)
+            cursor.execute(query, params)
             for nr_id,far_record_id,facility_id,last_name,first_name in cursor.fetchall():
                 if nr_id:
                     if not x.get(nr_id):
@@ -556,21 +566,25 @@ ALTER TABLE names_person ADD COLUMN "wikidata_url" varchar(255) NULL;
         return x
 
     @staticmethod
-    def related_wrarecords():
+    def related_wrarecords(nr_ids=None):
         """Build dict of Person->WraRecord relations
+        
+        @param nr_ids: list Limit to these Persons (default: all)
         """
-        facility_titles = {f.facility_id: f.title for f in Facility.objects.all()}
-        query = """
+        facility_titles = lookups.facility_titles()
+        where,params = _where_in('names_person.nr_id', nr_ids)
+        query = f"""
             SELECT names_person.nr_id,
                    names_wrarecord.wra_record_id,
                    names_wrarecord.facility,
                    names_wrarecord.lastname, names_wrarecord.firstname
             FROM names_wrarecord INNER JOIN names_person
-            ON names_wrarecord.person_id = names_person.nr_id;
+            ON names_wrarecord.person_id = names_person.nr_id
+            {where};
         """
         x = {}
         with connections['names'].cursor() as cursor:
-            cursor.execute(query)
+            cursor.execute(query, params)
             for nr_id,wra_record_id,facility_id,lastname,firstname in cursor.fetchall():
                 if nr_id:
                     if not x.get(nr_id):
@@ -586,39 +600,14 @@ ALTER TABLE names_person ADD COLUMN "wikidata_url" varchar(255) NULL;
         return x
 
     @staticmethod
-    def related_family():
+    def related_family(nr_ids=None):
         """Build dict of Person wra_family_no->nr_id relations
+        
+        Reads the families precomputed in names_family (see names.family).
+        
+        @param nr_ids: list Limit to families of these Persons (default: all)
         """
-        query = """
-            SELECT names_person.wra_family_no,
-                   names_person.nr_id,
-                   names_person.preferred_name,
-                   names_person.birth_date,
-                   names_person.wra_individual_no,
-                   names_person.gender
-            FROM names_person;
-        """
-        x = {}
-        with connections['names'].cursor() as cursor:
-            cursor.execute(query)
-            for row in cursor.fetchall():
-                wra_family_no,nr_id,preferred_name,birth_date,wra_individual_no,gender = row
-                if not x.get(wra_family_no):
-                    x[wra_family_no] = []
-                # redact exact birth date
-                try:
-                    birth_year = birth_date.year
-                except:
-                    birth_year = None
-                data = {
-                    'nr_id': nr_id,
-                    'preferred_name': preferred_name,
-                    'birth_year': birth_year,
-                    'wra_individual_no': wra_individual_no,
-                    'gender': gender,
-                }
-                x[wra_family_no].append(data)
-        return x
+        return family.load('person', nr_ids)
 
     def dict(self, related):
         """JSON-serializable dict
@@ -643,12 +632,17 @@ ALTER TABLE names_person ADD COLUMN "wikidata_url" varchar(255) NULL;
             ]
         return d
 
-    def post(self, related, ds):
-        """Post Person record to Elasticsearch
+    def es_document(self, related):
+        """Elasticsearch document for Person record
         """
         data = self.dict(related)
         es_class = ELASTICSEARCH_CLASSES_BY_MODEL['person']
-        return es_class.from_dict(data['nr_id'], data).save(
+        return es_class.from_dict(data['nr_id'], data)
+
+    def post(self, related, ds):
+        """Post Person record to Elasticsearch
+        """
+        return self.es_document(related).save(
             index=ds.index_name('person'), using=ds.es
         )
 
@@ -785,7 +779,7 @@ python src/manage.py loaddata --database=names ./db/namesdb-kyuzo-YYYYMMDD-HHMM-
                 fieldname: getattr(facility, fieldname, None)
                 for fieldname in FIELDS_FACILITY
             }
-            for facility in Facility.objects.all()
+            for facility in lookups.facilities().values()
         }
 
     def dict(self, related):
@@ -824,12 +818,17 @@ python src/manage.py loaddata --database=names ./db/namesdb-kyuzo-YYYYMMDD-HHMM-
             entry_date=''
         return '_'.join([person_id, str(location_id), entry_date])
 
-    def post(self, related, ds):
-        """Post FarRecord to Elasticsearch
+    def es_document(self, related):
+        """Elasticsearch document for PersonLocation
         """
         data = self.dict(related)
         es_class = ELASTICSEARCH_CLASSES_BY_MODEL['personlocation']
-        return es_class.from_dict(data['id'], data).save(
+        return es_class.from_dict(data['id'], data)
+
+    def post(self, related, ds):
+        """Post FarRecord to Elasticsearch
+        """
+        return self.es_document(related).save(
             index=ds.index_name('personlocation'), using=ds.es
         )
 
@@ -957,15 +956,17 @@ class FarRecord(models.Model):
         return Revision.revisions(self, 'far_record_id')
 
     @staticmethod
-    def related_persons():
-        query = """
+    def related_persons(far_record_ids=None):
+        where,params = _where_in('names_farrecord.far_record_id', far_record_ids)
+        query = f"""
             SELECT names_farrecord.far_record_id, names_person.nr_id,
                    names_person.preferred_name
             FROM names_farrecord
             INNER JOIN names_person ON names_farrecord.person_id = names_person.nr_id
+            {where}
         """
         with connections['names'].cursor() as cursor:
-            cursor.execute(query)
+            cursor.execute(query, params)
             return {
                 far_record_id: {
                     'nr_id': nr_id, 'preferred_name': preferred_name
@@ -975,27 +976,14 @@ class FarRecord(models.Model):
             }
 
     @staticmethod
-    def related_family():
+    def related_family(far_record_ids=None):
         """Build dict of FarRecord family_number->far_record_id relations
+        
+        Reads the families precomputed in names_family (see names.family).
+        
+        @param far_record_ids: list Limit to families of these (default: all)
         """
-        query = """
-            SELECT names_farrecord.family_number, names_farrecord.far_record_id,
-                   names_farrecord.last_name, names_farrecord.first_name
-            FROM names_farrecord;
-        """
-        x = {}
-        with connections['names'].cursor() as cursor:
-            cursor.execute(query)
-            for fields in cursor.fetchall():
-                family_number,far_record_id,last_name,first_name = fields
-                if not x.get(family_number):
-                    x[family_number] = []
-                x[family_number].append({
-                    'far_record_id': far_record_id,
-                    'last_name': last_name,
-                    'first_name': first_name,
-                })
-        return x
+        return family.load('farrecord', far_record_ids)
 
     def dict(self, related):
         """JSON-serializable dict
@@ -1022,12 +1010,17 @@ class FarRecord(models.Model):
             ]
         return d
 
-    def post(self, related, ds):
-        """Post FarRecord to Elasticsearch
+    def es_document(self, related):
+        """Elasticsearch document for FarRecord
         """
         data = self.dict(related)
         es_class = ELASTICSEARCH_CLASSES_BY_MODEL['farrecord']
-        return es_class.from_dict(data['far_record_id'], data).save(
+        return es_class.from_dict(data['far_record_id'], data)
+
+    def post(self, related, ds):
+        """Post FarRecord to Elasticsearch
+        """
+        return self.es_document(related).save(
             index=ds.index_name('farrecord'), using=ds.es
         )
 
@@ -1092,18 +1085,15 @@ class FarPage(models.Model):
         unique_together = ('facility', 'file_id')
 
     def __str__(self):
-        return f'{self.facility.facility_id}_{self.page}'
+        return f'{self.facility_id}_{self.page}'
 
     def es_id(self):
-        return f'{self.facility.facility_id}_{self.page}'
+        return f'{self.facility_id}_{self.page}'
 
     @staticmethod
     def prep_data():
         return {
-            'facilities': {
-                f.facility_id: f
-                for f in Facility.objects.all()
-            },
+            'facilities': dict(lookups.facilities()),
         }
 
     @staticmethod
@@ -1134,16 +1124,21 @@ class FarPage(models.Model):
                 d[fieldname] = value
         return d
 
-    def post(self, related, ds):
-        """Post FarPage to Elasticsearch
+    def es_document(self, related):
+        """Elasticsearch document for FarPage
         """
         if not self.page:
-            return
+            return None
         data = self.dict()
         es_class = ELASTICSEARCH_CLASSES_BY_MODEL['farpage']
-        return es_class.from_dict(data['far_page_id'], data).save(
-            index=ds.index_name('farpage'), using=ds.es
-        )
+        return es_class.from_dict(data['far_page_id'], data)
+
+    def post(self, related, ds):
+        """Post FarPage to Elasticsearch
+        """
+        doc = self.es_document(related)
+        if doc:
+            return doc.save(index=ds.index_name('farpage'), using=ds.es)
 
 
 class WraRecord(models.Model):
@@ -1270,15 +1265,17 @@ class WraRecord(models.Model):
         return Revision.revisions(self, 'wra_record_id')
 
     @staticmethod
-    def related_persons():
-        query = """
+    def related_persons(wra_record_ids=None):
+        where,params = _where_in('names_wrarecord.wra_record_id', wra_record_ids)
+        query = f"""
             SELECT names_wrarecord.wra_record_id, names_person.nr_id,
                    names_person.preferred_name
             FROM names_wrarecord
             INNER JOIN names_person ON names_wrarecord.person_id = names_person.nr_id
+            {where}
         """
         with connections['names'].cursor() as cursor:
-            cursor.execute(query)
+            cursor.execute(query, params)
             return {
                 wra_record_id: {
                     'nr_id': nr_id, 'preferred_name': preferred_name
@@ -1288,27 +1285,14 @@ class WraRecord(models.Model):
             }
 
     @staticmethod
-    def related_family():
+    def related_family(wra_record_ids=None):
         """Build dict of WraRecord family_number->far_record_id relations
+        
+        Reads the families precomputed in names_family (see names.family).
+        
+        @param wra_record_ids: list Limit to families of these (default: all)
         """
-        query = """
-            SELECT names_wrarecord.familyno, names_wrarecord.wra_record_id,
-                   names_wrarecord.lastname, names_wrarecord.firstname
-            FROM names_wrarecord;
-        """
-        x = {}
-        with connections['names'].cursor() as cursor:
-            cursor.execute(query)
-            for fields in cursor.fetchall():
-                familyno,wra_record_id,lastname,firstname = fields
-                if not x.get(familyno):
-                    x[familyno] = []
-                x[familyno].append({
-                    'wra_record_id': wra_record_id,
-                    'lastname': lastname,
-                    'firstname': firstname,
-                })
-        return x
+        return family.load('wrarecord', wra_record_ids)
 
     def dict(self, related):
         """JSON-serializable dict
@@ -1333,12 +1317,17 @@ class WraRecord(models.Model):
             ]
         return d
 
-    def post(self, related, ds):
-        """Post WraRecord to Elasticsearch
+    def es_document(self, related):
+        """Elasticsearch document for WraRecord
         """
         data = self.dict(related)
         es_class = ELASTICSEARCH_CLASSES_BY_MODEL['wrarecord']
-        return es_class.from_dict(data['wra_record_id'], data).save(
+        return es_class.from_dict(data['wra_record_id'], data)
+
+    def post(self, related, ds):
+        """Post WraRecord to Elasticsearch
+        """
+        return self.es_document(related).save(
             index=ds.index_name('wrarecord'), using=ds.es
         )
 
@@ -1435,6 +1424,7 @@ class IreiRecord(models.Model):
     );
     CREATE INDEX "names_ireirecord_person_id_76c77728" ON "names_ireirecord" ("irei_id");
     CREATE INDEX "names_ireirecord_person_id_876c7772" ON "names_ireirecord" ("person_id");
+    CREATE INDEX IF NOT EXISTS "names_ireirecord_timestamp_idx" ON "names_ireirecord" ("timestamp");
     """
     irei_id   = models.CharField(max_length=255, primary_key=1, verbose_name='Irei ID')
     person    = models.ForeignKey(Person, on_delete=models.SET_NULL, blank=1, null=1)
@@ -1529,10 +1519,7 @@ class IreiRecord(models.Model):
         # birthday -> birthdate
         if rowd.get('birthday') and rowd['birthday'] != record.birthday:
             record.birthday = rowd.pop('birthday')
-            try:
-                record.birthdate = parser.parse(record.birthday)
-            except parser._parser.ParserError:
-                record.birthdate = None
+            record.birthdate = dates.parse(record.birthday)
             changed.append('birthday')
         # camps
         camps = '; '.join(rowd.pop('camps'))
@@ -1569,15 +1556,17 @@ class IreiRecord(models.Model):
         
 
     @staticmethod
-    def related_persons():
-        query = """
+    def related_persons(irei_ids=None):
+        where,params = _where_in('names_ireirecord.irei_id', irei_ids)
+        query = f"""
             SELECT names_ireirecord.irei_id, names_person.nr_id,
                    names_person.preferred_name
             FROM names_ireirecord
             INNER JOIN names_person ON names_ireirecord.person_id = names_person.nr_id
+            {where}
         """
         with connections['names'].cursor() as cursor:
-            cursor.execute(query)
+            cursor.execute(query, params)
             return {
                 irei_id: {
                     'nr_id': nr_id, 'preferred_name': preferred_name
@@ -1604,12 +1593,17 @@ class IreiRecord(models.Model):
             d[fieldname] = value
         return d
 
-    def post(self, related, ds):
-        """Post IreiRecord to Elasticsearch
+    def es_document(self, related):
+        """Elasticsearch document for IreiRecord
         """
         data = self.dict(related)
         es_class = ELASTICSEARCH_CLASSES_BY_MODEL['ireirecord']
-        return es_class.from_dict(data['irei_id'], data).save(
+        return es_class.from_dict(data['irei_id'], data)
+
+    def post(self, related, ds):
+        """Post IreiRecord to Elasticsearch
+        """
+        return self.es_document(related).save(
             index=ds.index_name('ireirecord'), using=ds.es
         )
 
@@ -1795,31 +1789,14 @@ MODEL_CLASSES = {
 }
 
 def dump_csv(output, model_class, ids, search, cols, limit=None, debug=False):
-    """Writes rowds of specified model class to STDOUT
+    """Writes specified columns of model class records to output as CSV
+
+    See names.export for other formats.
     """
     writer = fileio.csv_writer(output)
     if debug: print(f'header {cols}')
     writer.writerow(cols)
-    
-    if ids:
-        query = model_class.objects.filter(pk__in=ids)
-    elif search:
-        # TODO SEARCH IS HORRIBLY UNSAFE!!!
-        query = model_class.objects.filter(**search)
-    else:
-        query = model_class.objects.all()
-    
-    n = 0
-    if limit:
-        for o in query[:limit]:
-            row = list(o.dump_rowd(cols).values())
-            if debug: print(f'{n}/{limit} row {row}')
-            writer.writerow(row)
-            n += 1
-    else:
-        num = len(query)
-        for o in query:
-            row = list(o.dump_rowd(cols).values())
-            if debug: print(f'{n}/{num} {row[0]}')
-            writer.writerow(row)
-            n += 1
+    query = export.queryset(model_class, ids, search, limit)
+    for n,row in enumerate(export.rows(query, cols)):
+        if debug: print(f'{n} {row[0]}')
+        writer.writerow(row)
@@ -0,0 +1,170 @@
+"""Admin changelist counts without a full-table COUNT(*) on every page
+
+Unfiltered changelists get their count from a per-table row count kept in
+the state database (see names.statedb), where every web worker and the
+namesdb command see it and where it doesn't expire.  The count is seeded
+from sqlite_stat1 (written by ANALYZE) if available, is adjusted in place
+as rows are added and deleted (once the names transaction commits, so
+rolled-back saves don't count), and is only recounted exactly when asked
+(`namesdb counts --exact`).  Loaders suspend the adjustments with
+deferred() and recount the tables they wrote at the end.
+Filtered counts and list_filter choices are cached for a few minutes.
+"""
+
+from contextlib import closing, contextmanager
+from functools import partial
+import hashlib
+
+from django.conf import settings
+from django.contrib import admin
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db import connections, DatabaseError, transaction
+from django.utils.functional import cached_property
+
+from . import statedb
+
+# The first number of a sqlite_stat1 row is the number of rows in the
+# index, which is the whole table unless the index is partial.  Rows with
+# idx NULL (tables without indexes) count the table itself.
+STAT1_SQL = """
+SELECT stat FROM sqlite_stat1
+WHERE tbl=%s
+AND (idx IS NULL OR idx IN (SELECT name FROM pragma_index_list(%s) WHERE partial=0))
+ORDER BY idx IS NOT NULL
+LIMIT 1
+"""
+
+# Models saved to during a deferred() block, or None
+_deferred = None
+
+
+def stat1_estimate(table, using='names'):
+    """Estimated number of rows in table from sqlite_stat1, or None
+    """
+    with connections[using].cursor() as cursor:
+        try:
+            cursor.execute(STAT1_SQL, [table, table])
+        except DatabaseError:  # ANALYZE has never been run
+            return None
+        row = cursor.fetchone()
+    if row and row[0]:
+        return int(row[0].split()[0])
+    return None
+
+def _get_count(table):
+    with closing(statedb.connect()) as conn:
+        row = conn.execute(
+            'SELECT num FROM rowcounts WHERE tbl=?', (table,)
+        ).fetchone()
+    if row:
+        return row['num']
+    return None
+
+def _set_count(table, num):
+    with closing(statedb.connect()) as conn, conn:
+        conn.execute(
+            'INSERT OR REPLACE INTO rowcounts (tbl, num) VALUES (?, ?)',
+            (table, num)
+        )
+
+def exact_count(model, using='names'):
+    """SELECT COUNT(*) and store the result as the table's row count
+    """
+    num = model.objects.using(using).count()
+    _set_count(model._meta.db_table, num)
+    return num
+
+def table_count(model, using='names'):
+    """Number of rows in model's table, stored or estimated if possible
+    """
+    table = model._meta.db_table
+    num = _get_count(table)
+    if num is None:
+        num = stat1_estimate(table, using)
+        if num is None:
+            return exact_count(model, using)
+        _set_count(table, num)
+    return num
+
+def queryset_count(queryset):
+    """Count for a changelist queryset, using cached values where possible
+    """
+    query = queryset.query
+    if not (query.where or query.distinct or query.low_mark or query.high_mark):
+        return table_count(queryset.model, queryset.db)
+    sql,params = query.sql_with_params()
+    key = 'names:count:' + hashlib.md5(
+        f'{sql} {params}'.encode('utf-8')
+    ).hexdigest()
+    return cache.get_or_set(
+        key, queryset.count, timeout=settings.ADMIN_COUNT_TIMEOUT
+    )
+
+def _apply_count(table, delta):
+    # a single UPDATE, so concurrent saves in other workers aren't lost;
+    # does nothing if the table hasn't been counted yet
+    with closing(statedb.connect()) as conn, conn:
+        conn.execute(
+            'UPDATE rowcounts SET num=num+?, updated=CURRENT_TIMESTAMP '
+            'WHERE tbl=?',
+            (delta, table)
+        )
+
+def _adjust_count(model, delta, using):
+    if _deferred is not None:
+        _deferred.add(model)
+        return
+    # dropped by Django if the transaction (or savepoint) is rolled back
+    transaction.on_commit(
+        partial(_apply_count, model._meta.db_table, delta), using=using
+    )
+
+@contextmanager
+def deferred(using='names'):
+    """Skip per-row count adjustments, recount the tables written at the end
+
+    For loaders that save many records one at a time: one COUNT(*) per
+    table instead of a state database write for every row.
+    """
+    global _deferred
+    if _deferred is not None:  # already deferred by an outer block
+        yield
+        return
+    _deferred = set()
+    try:
+        yield
+    finally:
+        saved,_deferred = _deferred,None
+        for model in saved:
+            exact_count(model, using)
+
+def count_saved(sender, instance, created, using='names', **kwargs):
+    """post_save receiver: keep stored row counts current"""
+    if created:
+        _adjust_count(sender, 1, using)
+
+def count_deleted(sender, instance, using='names', **kwargs):
+    """post_delete receiver: keep stored row counts current"""
+    _adjust_count(sender, -1, using)
+
+
+class CachedCountPaginator(Paginator):
+    """Paginator whose count comes from queryset_count()"""
+
+    @cached_property
+    def count(self):
+        return queryset_count(self.object_list)
+
+
+class CachedAllValuesFieldListFilter(admin.AllValuesFieldListFilter):
+    """AllValuesFieldListFilter that caches the SELECT DISTINCT of choices"""
+
+    def __init__(self, field, request, params, model, model_admin, field_path):
+        super().__init__(field, request, params, model, model_admin, field_path)
+        lookup_choices = self.lookup_choices
+        self.lookup_choices = cache.get_or_set(
+            f'names:choices:{model._meta.db_table}:{field_path}',
+            lambda: list(lookup_choices),
+            timeout=settings.ADMIN_COUNT_TIMEOUT,
+        )
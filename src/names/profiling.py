@@ -0,0 +1,141 @@
+"""Profile namesdb commands and slow admin requests
+
+`namesdb --profile KIND COMMAND ...` runs the command under one of
+PROFILERS and writes the results to settings.PROFILE_DIR:
+
+    cprofile      NAME.prof (pstats; snakeviz, `python -m pstats`) and NAME.txt
+    pyinstrument  NAME.html and NAME.txt (requires pyinstrument)
+    tracemalloc   NAME.tracemalloc (Snapshot.load()) and NAME.txt
+
+Sampler takes a stack sample of one thread at regular intervals without
+tracing every call, cheap enough to leave running for every admin request
+(see names.middleware.ProfileMiddleware).  Samples are written as
+collapsed stacks, one "frame;frame;frame count" line per stack, which
+speedscope and flamegraph.pl read offline.
+"""
+
+from collections import Counter
+from datetime import datetime
+import os
+from pathlib import Path
+import sys
+import threading
+
+PROFILERS = ['cprofile', 'pyinstrument', 'tracemalloc']
+
+# Functions or allocation sites listed in NAME.txt
+TOP = 50
+# Frames of traceback kept for each tracemalloc allocation
+TRACEMALLOC_FRAMES = 10
+# Seconds between samples
+INTERVAL = 0.005
+
+
+def path_base(directory, name):
+    """directory/NAME-YYYYMMDD-HHMMSS-PID (no suffix), creating directory"""
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+    return directory / f'{name}-{stamp}-{os.getpid()}'
+
+def _start_cprofile():
+    import cProfile
+    import pstats
+    profiler = cProfile.Profile()
+    profiler.enable()
+    def stop(base):
+        profiler.disable()
+        prof = Path(f'{base}.prof')
+        txt = Path(f'{base}.txt')
+        profiler.dump_stats(prof)
+        with txt.open('w') as f:
+            stats = pstats.Stats(profiler, stream=f)
+            stats.sort_stats('cumulative').print_stats(TOP)
+        return [prof, txt]
+    return stop
+
+def _start_pyinstrument():
+    from pyinstrument import Profiler
+    profiler = Profiler()
+    profiler.start()
+    def stop(base):
+        profiler.stop()
+        html = Path(f'{base}.html')
+        txt = Path(f'{base}.txt')
+        html.write_text(profiler.output_html())
+        txt.write_text(profiler.output_text())
+        return [html, txt]
+    return stop
+
+def _start_tracemalloc():
+    import tracemalloc
+    tracemalloc.start(TRACEMALLOC_FRAMES)
+    def stop(base):
+        snapshot = tracemalloc.take_snapshot()
+        current,peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        dump = Path(f'{base}.tracemalloc')
+        txt = Path(f'{base}.txt')
+        snapshot.dump(str(dump))
+        with txt.open('w') as f:
+            f.write(f'current {current / 1e6:.1f} MB, peak {peak / 1e6:.1f} MB\n\n')
+            for stat in snapshot.statistics('lineno')[:TOP]:
+                f.write(f'{stat}\n')
+        return [dump, txt]
+    return stop
+
+STARTERS = {
+    'cprofile': _start_cprofile,
+    'pyinstrument': _start_pyinstrument,
+    'tracemalloc': _start_tracemalloc,
+}
+
+def start(kind):
+    """Start a profiler of kind (see PROFILERS)
+
+    Raises ImportError if the profiler is not installed.
+
+    @returns: function stop(path_base) that writes the results and
+        returns a list of the paths written
+    """
+    return STARTERS[kind]()
+
+
+class Sampler():
+    """Sample the stack of one thread (default: this one) every interval"""
+
+    def __init__(self, thread_id=None, interval=INTERVAL):
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval
+        self.stacks = Counter()
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._done.set()
+        self._thread.join()
+        return self
+
+    def _run(self):
+        while not self._done.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(
+                    f'{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})'
+                )
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def write(self, path):
+        """Write samples as collapsed stacks, most frequent first"""
+        with Path(path).open('w') as f:
+            for stack,num in self.stacks.most_common():
+                f.write(f'{stack} {num}\n')
+        return path
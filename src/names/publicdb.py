@@ -0,0 +1,145 @@
+"""Build the public copy of the names database (`namesdb exportdb`)
+
+The live database is ATTACHed read-only to a new, empty file and only the
+names_* tables are copied, inside one transaction so the copy is
+consistent even while editors are saving.  Because the file is built from
+scratch there is nothing to VACUUM.  Indexes and triggers are created after
+the rows are loaded, full-text indexes are rebuilt from their content
+tables, and the result is ANALYZEd so it is ready to query.
+"""
+
+from pathlib import Path
+import shutil
+import sqlite3
+
+from . import export
+
+# Rows copied per INSERT ... SELECT
+BATCH_SIZE = 50000
+TABLE_PREFIX = 'names_'
+
+
+def _schema(conn, schema='main'):
+    return conn.execute(
+        f'SELECT type, name, tbl_name, sql FROM {schema}.sqlite_master '
+        'WHERE sql IS NOT NULL ORDER BY rowid'
+    ).fetchall()
+
+def plan(conn, schema='src'):
+    """Sort the attached database's schema into what to copy and how
+
+    @returns: dict with lists of tables, fts (virtual tables), and
+              post_sql (indexes and triggers to create after loading)
+    """
+    rows = _schema(conn, schema)
+    fts = [
+        (name, sql) for type_,name,tbl_name,sql in rows
+        if type_ == 'table' and name.startswith(TABLE_PREFIX)
+        and sql.upper().startswith('CREATE VIRTUAL TABLE')
+    ]
+    fts_names = [name for name,sql in fts]
+    def is_shadow(name):
+        return any(name.startswith(f'{f}_') for f in fts_names)
+    tables = [
+        (name, sql) for type_,name,tbl_name,sql in rows
+        if type_ == 'table' and name.startswith(TABLE_PREFIX)
+        and name not in fts_names and not is_shadow(name)
+    ]
+    table_names = [name for name,sql in tables] + fts_names
+    post_sql = [
+        sql for type_,name,tbl_name,sql in rows
+        if type_ in ['index', 'trigger'] and tbl_name in table_names
+        and not is_shadow(tbl_name)
+    ]
+    return {'tables': tables, 'fts': fts, 'post_sql': post_sql}
+
+def row_counts(conn, tables, schema='src'):
+    return {
+        name: conn.execute(f'SELECT COUNT(*) FROM {schema}."{name}"').fetchone()[0]
+        for name,sql in tables
+    }
+
+def copy_table(conn, name, progress=None, batch_size=BATCH_SIZE, rowid=True):
+    """Copy rows from src.name to main.name in rowid order, batch_size at a time
+
+    Batches are bounded by the source's rowids, which have gaps where rows
+    were deleted; the copy's rowids don't.  WITHOUT ROWID tables
+    (rowid=False) are copied in one statement.
+    """
+    if not rowid:
+        cursor = conn.execute(f'INSERT INTO main."{name}" SELECT * FROM src."{name}"')
+        if progress and cursor.rowcount > 0:
+            progress(cursor.rowcount)
+        return
+    last = 0
+    while True:
+        # last source rowid of the batch, before copying it
+        end = conn.execute(
+            f'SELECT MAX(rowid) FROM (SELECT rowid FROM src."{name}" '
+            f'WHERE rowid > ? ORDER BY rowid LIMIT ?)',
+            (last, batch_size)
+        ).fetchone()[0]
+        if end is None:
+            return
+        cursor = conn.execute(
+            f'INSERT INTO main."{name}" SELECT * FROM src."{name}" '
+            f'WHERE rowid > ? AND rowid <= ? ORDER BY rowid',
+            (last, end)
+        )
+        if progress:
+            progress(cursor.rowcount)
+        last = end
+
+def export_db(src, dst, progress=None, counted=None):
+    """Copy names_* tables from src into a new database at dst
+
+    @param src: str Path to live names database
+    @param dst: str Path to new database (must not exist)
+    @param progress: function(num_rows) called after each batch (optional)
+    @param counted: function(dict table: rows) called before copying (optional)
+    @returns: dict table: rows
+    """
+    if Path(dst).exists():
+        raise Exception(f'File exists: {dst}')
+    conn = sqlite3.connect(dst, isolation_level=None, uri=True)
+    try:
+        conn.execute('PRAGMA journal_mode=OFF')  # file is thrown away on failure
+        conn.execute('PRAGMA synchronous=OFF')
+        conn.execute(f"ATTACH DATABASE 'file:{src}?mode=ro' AS src")
+        # one transaction: the source is read at a single point in time
+        conn.execute('BEGIN')
+        p = plan(conn)
+        counts = row_counts(conn, p['tables'])
+        if counted:
+            counted(counts)
+        for name,sql in p['tables']:
+            conn.execute(sql)
+            copy_table(
+                conn, name, progress, rowid='WITHOUT ROWID' not in sql.upper()
+            )
+        for name,sql in p['fts']:
+            conn.execute(sql)
+            conn.execute(f'INSERT INTO "{name}"("{name}") VALUES(\'rebuild\')')
+        for sql in p['post_sql']:
+            conn.execute(sql)
+        conn.execute('COMMIT')
+        conn.execute('DETACH DATABASE src')
+        conn.execute('ANALYZE')
+        for name,sql in p['fts']:
+            conn.execute(f'INSERT INTO "{name}"("{name}") VALUES(\'optimize\')')
+        conn.execute('PRAGMA journal_mode=DELETE')
+    except:
+        conn.close()
+        Path(dst).unlink(missing_ok=True)
+        raise
+    conn.close()
+    return counts
+
+def compress(path, compression):
+    """Compress file with gzip or zstd, remove original, return new path"""
+    ext = {'gzip': '.gz', 'zstd': '.zst'}[compression]
+    out = Path(f'{path}{ext}')
+    with open(path, 'rb') as src, export.output(out, compression) as f:
+        shutil.copyfileobj(src, f, 1024 * 1024)
+    Path(path).unlink()
+    return out
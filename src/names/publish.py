@@ -1,6 +1,14 @@
+import functools
 import logging
 import sys
+import time
 
+from django.conf import settings
+from elasticsearch.helpers import streaming_bulk
+
+from . import docstore
+from . import fingerprints
+from . import metrics
 from . import models
 from namesdb_public import models as pubmodels
 
@@ -21,3 +29,235 @@ def make_hosts(text):
         h,p = host.split(':')
         hosts.append( {'host':h, 'port':p} )
     return hosts
+
+
+@functools.lru_cache
+def docstore_manager(hosts=None):
+    """DocstoreManager for hosts, or settings.DOCSTORE_HOST
+
+    Managers are cached so a long-running process reuses one client (and
+    its connection pool) per cluster.
+    """
+    return docstore.DocstoreManager(
+        models.INDEX_PREFIX, make_hosts(hosts or settings.DOCSTORE_HOST), settings
+    )
+
+# Above this many IDs it's faster to load relations for the whole table.
+RELATED_IDS_MAX = 10_000
+# Most variables allowed in one statement by SQLite before 3.32
+SQLITE_MAX_VARIABLES = 999
+
+def chunks(items, size=SQLITE_MAX_VARIABLES):
+    """Split items into lists of at most size items, e.g. for IN (...)
+
+    items may be any iterable, including a generator, and is only read as
+    far as the chunk being yielded.
+    """
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def load_related(model, ids=None):
+    """Load relations used by the dict() method of model's records
+    
+    @param model: str Model name (no abbreviations)
+    @param ids: list Only load relations for these records (default: all)
+        Queried SQLITE_MAX_VARIABLES at a time.
+    @returns: dict
+    """
+    if ids is not None and len(ids) > RELATED_IDS_MAX:
+        ids = None
+    builders = {}
+    if model == 'person':
+        builders['far_records'] = (models.Person.related_farrecords, [ids])
+        builders['wra_records'] = (models.Person.related_wrarecords, [ids])
+        builders['family'] = (models.Person.related_family, [ids])
+    elif model == 'farrecord':
+        builders['persons'] = (models.FarRecord.related_persons, [ids])
+        builders['family'] = (models.FarRecord.related_family, [ids])
+    elif model == 'wrarecord':
+        builders['persons'] = (models.WraRecord.related_persons, [ids])
+        builders['family'] = (models.WraRecord.related_family, [ids])
+    elif model == 'ireirecord':
+        builders['persons'] = (models.IreiRecord.related_persons, [ids])
+    elif model == 'personlocation':
+        builders['persons'] = (models.PersonLocation.related_persons, [])
+        builders['locations'] = (models.PersonLocation.related_locations, [])
+        builders['facilities'] = (models.PersonLocation.related_facilities, [])
+    related = {}
+    for key,(build,args) in builders.items():
+        with metrics.span(f'related.{model}.{key}') as stage:
+            if args and args[0]:
+                related[key] = {}
+                for chunk in chunks(list(args[0])):
+                    related[key].update(build(chunk))
+            else:
+                related[key] = build(*args)
+            stage.rows += len(related[key])
+    return related
+
+def post_records(records, related, ds, progress=None):
+    """Post records to Elasticsearch, one request per record
+    
+    @param records: iterable of model objects
+    @param related: dict from load_related()
+    @param ds: DocstoreManager
+    @param progress: function(num_done) called after each record (optional)
+    @returns: list of records that failed
+    """
+    failed = []
+    hashes = {}
+    for n,record in enumerate(records):
+        try:
+            doc = record.es_document(related)
+            if doc:
+                index = ds.index_name(record._meta.model_name)
+                doc.save(index=index, using=ds.es)
+                hashes.setdefault(index, []).append(
+                    (doc.meta.id, fingerprints.digest(doc))
+                )
+        except Exception as err:
+            logging.error(f'{record} {err}')
+            failed.append(record)
+        if progress:
+            progress(n+1)
+    for index,items in hashes.items():
+        fingerprints.save(fingerprints.key(ds, index), items)
+    return failed
+
+# Documents per Elasticsearch bulk request
+BULK_CHUNK_SIZE = 500
+
+def bulk_post(records, related, ds, index, progress=None, known=None):
+    """Post records to index with the bulk API
+    
+    Documents whose hash is the same as in known are not sent, nor are
+    documents whose ID was already sent in this call.
+    Does not update fingerprints; see post_changed().
+    
+    @param records: iterable of model objects
+    @param related: dict from load_related()
+    @param ds: DocstoreManager
+    @param index: str Name of index (or alias)
+    @param progress: function(num_done) called after each record (optional)
+    @param known: dict doc_id: hash from fingerprints.load() (optional)
+    @returns: (list of (doc_id, hash) posted, list of failed IDs,
+               list of all IDs, int unchanged documents not sent)
+    """
+    if known is None:
+        known = {}
+    seen = []
+    ids = set()
+    failed = []
+    hashes = {}
+    unchanged = 0
+    document = metrics.current().stage('post.document')
+    serialize = metrics.current().stage('post.serialize')
+    def actions():
+        nonlocal unchanged
+        for n,record in enumerate(records):
+            if progress:
+                progress(n+1)
+            start = time.perf_counter()
+            try:
+                doc = record.es_document(related)
+            except Exception as err:
+                logging.error(f'{record} {err}')
+                failed.append(str(record.pk))
+                continue
+            finally:
+                built = time.perf_counter()
+                document.add(built - start, rows=1)
+            if not doc:
+                continue
+            doc_id = doc.meta.id
+            if doc_id in ids:
+                # records contained the same object twice
+                continue
+            ids.add(doc_id)
+            seen.append(doc_id)
+            text = fingerprints.canonical(doc)
+            h = fingerprints.digest(doc, text)
+            serialize.add(time.perf_counter() - built, rows=1, bytes=len(text))
+            if known.get(doc_id) == h:
+                unchanged += 1
+                continue
+            hashes[doc_id] = h
+            action = doc.to_dict(include_meta=True)
+            action['_index'] = index
+            yield action
+    posted = []
+    results = streaming_bulk(
+        ds.es, actions(), chunk_size=BULK_CHUNK_SIZE,
+        raise_on_error=False, raise_on_exception=False,
+    )
+    # time in streaming_bulk that wasn't spent making documents
+    start = time.perf_counter()
+    before = document.seconds + serialize.seconds
+    for ok,item in results:
+        result = list(item.values())[0]
+        doc_id = result.get('_id')
+        if ok:
+            # a duplicate result has no hash left
+            h = hashes.pop(doc_id, None)
+            if h is not None:
+                posted.append((doc_id, h))
+        else:
+            logging.error(f"{doc_id} {result.get('error')}")
+            failed.append(doc_id)
+    metrics.add(
+        'post.elasticsearch',
+        time.perf_counter() - start - (document.seconds + serialize.seconds - before),
+        rows=len(posted),
+    )
+    return posted, failed, seen, unchanged
+
+def post_changed(records, related, ds, model, force=False, progress=None, known=None):
+    """Bulk-post documents that changed since they were last published
+    
+    @param force: bool Post every document regardless of fingerprints
+    @param known: dict doc_id: hash (default: load from fingerprints)
+    @returns: (int posted, int unchanged, list of failed IDs, list of all IDs)
+    """
+    index = ds.index_name(model)
+    if force:
+        known = {}
+    elif known is None:
+        known = fingerprints.load(fingerprints.key(ds, index))
+    posted,failed,seen,unchanged = bulk_post(
+        records, related, ds, index, progress, known
+    )
+    with metrics.timer('post.fingerprints'):
+        # the index may have been created by this post
+        fingerprints.save(fingerprints.key(ds, index), posted)
+    return len(posted), unchanged, failed, seen
+
+def delete_docs(ds, model, doc_ids):
+    """Bulk-delete documents (and their fingerprints)
+    
+    @returns: list of IDs that could not be deleted
+    """
+    index = ds.index_name(model)
+    actions = (
+        {'_op_type': 'delete', '_index': index, '_id': doc_id}
+        for doc_id in doc_ids
+    )
+    failed = []
+    for ok,item in streaming_bulk(
+        ds.es, actions, chunk_size=BULK_CHUNK_SIZE,
+        raise_on_error=False, raise_on_exception=False,
+    ):
+        result = item['delete']
+        # already gone is fine
+        if not ok and result.get('status') != 404:
+            logging.error(f"{result.get('_id')} {result.get('error')}")
+            failed.append(result.get('_id'))
+    fingerprints.delete(
+        fingerprints.key(ds, index), [i for i in doc_ids if i not in failed]
+    )
+    return failed
@@ -0,0 +1,184 @@
+"""Publish admin edits to Elasticsearch in the background
+
+When settings.PUBLISH_ON_SAVE is enabled, saving a Person, FarRecord,
+WraRecord, or IreiRecord in the admin (or deleting one) adds it to the
+publish_queue table in the state database (see names.statedb) instead of
+talking to Elasticsearch during the request.  Records whose documents embed
+the edited record are queued too: a Person's FarRecords, WraRecords, and
+IreiRecords, the Person of a record (and the Person it was moved from),
+and the other members of the record's family (and the family it left).
+
+Repeated saves of the same record only keep one row, so a burst of edits is
+posted once.  The worker (`namesdb worker`) posts records that have been in
+the queue for settings.PUBLISH_DELAY seconds, in bulk, grouped by model.
+"""
+
+from contextlib import closing
+import logging
+
+from django.conf import settings
+
+from . import family
+from . import models
+from . import publish
+from . import statedb
+
+POST = 'post'
+DELETE = 'delete'
+
+PUBLISHED_MODELS = {
+    models.Person: 'person',
+    models.FarRecord: 'farrecord',
+    models.WraRecord: 'wrarecord',
+    models.IreiRecord: 'ireirecord',
+}
+# Models whose documents embed the Person they are linked to
+PERSON_RECORD_MODELS = [models.FarRecord, models.WraRecord, models.IreiRecord]
+
+
+def queue(items):
+    """Add (model, record_id, action) items to the publish queue
+
+    A record already in the queue keeps its place but takes the new action.
+    """
+    with closing(statedb.connect()) as conn, conn:
+        conn.executemany(
+            'INSERT INTO publish_queue (model, record_id, action) '
+            'VALUES (?, ?, ?) '
+            'ON CONFLICT (model, record_id) DO UPDATE SET action=excluded.action',
+            items
+        )
+
+def _is_admin_edit(instance):
+    # Admin save_model() sets obj.user; imports and CLI saves don't
+    return settings.PUBLISH_ON_SAVE and getattr(instance, 'user', None)
+
+def _family_items(sender, instance):
+    """Other members of the record's family, and of the family it left
+
+    family.remember_key notes the old family before the record is saved.
+    """
+    model = PUBLISHED_MODELS[sender]
+    if model not in family.FAMILIES:
+        return []
+    table,key,pk,fields = family.FAMILIES[model]
+    keys = [getattr(instance, key), getattr(instance, '_family_key_old', None)]
+    return [
+        (model, member, POST)
+        for member in family.member_ids(model, keys)
+        if member != instance.pk
+    ]
+
+def _person_items(instance):
+    """The record's Person, and the Person it was moved from"""
+    person_ids = {
+        instance.person_id, getattr(instance, '_person_id_old', None)
+    }
+    return [
+        ('person', person_id, POST) for person_id in person_ids if person_id
+    ]
+
+def remember_person(sender, instance, **kwargs):
+    """pre_save receiver: note the Person a record is linked to before saving"""
+    if not _is_admin_edit(instance):
+        return
+    instance._person_id_old = sender.objects.filter(
+        pk=instance.pk
+    ).values_list('person_id', flat=True).first()
+
+def queue_saved(sender, instance, **kwargs):
+    """post_save receiver: queue the record and records that embed it"""
+    if not _is_admin_edit(instance):
+        return
+    items = [(PUBLISHED_MODELS[sender], instance.pk, POST)]
+    if sender == models.Person:
+        for record_class in PERSON_RECORD_MODELS:
+            items += [
+                (PUBLISHED_MODELS[record_class], pk, POST)
+                for pk in record_class.objects.filter(
+                    person_id=instance.pk
+                ).values_list('pk', flat=True)
+            ]
+    else:
+        items += _person_items(instance)
+    items += _family_items(sender, instance)
+    queue(items)
+
+def queue_deleted(sender, instance, **kwargs):
+    """post_delete receiver: queue removal of the record's document
+
+    The Person and family members whose documents embedded it are posted.
+    """
+    # The admin doesn't set obj.user when deleting
+    if not settings.PUBLISH_ON_SAVE:
+        return
+    items = [(PUBLISHED_MODELS[sender], instance.pk, DELETE)]
+    if sender != models.Person:
+        items += _person_items(instance)
+    items += _family_items(sender, instance)
+    queue(items)
+
+def take(delay):
+    """Remove and return queue items that have been waiting at least delay seconds
+    """
+    conn = statedb.connect()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        items = conn.execute(
+            'SELECT model, record_id, action FROM publish_queue '
+            "WHERE queued <= datetime('now', ?) ORDER BY queued",
+            (f'-{int(delay)} seconds',)
+        ).fetchall()
+        conn.executemany(
+            'DELETE FROM publish_queue WHERE model=? AND record_id=?',
+            [(item['model'], item['record_id']) for item in items]
+        )
+        conn.commit()
+        return items
+    finally:
+        conn.close()
+
+def drain(delay=None):
+    """Post (or delete) queued records, grouped by model
+
+    Records that fail to post or delete are put back in the queue.
+
+    @param delay: int Seconds since first queued (default settings.PUBLISH_DELAY)
+    @returns: int Number of records published
+    """
+    if delay is None:
+        delay = settings.PUBLISH_DELAY
+    items = take(delay)
+    if not items:
+        return 0
+    ds = publish.docstore_manager()
+    failed = []
+    for model in sorted(set(item['model'] for item in items)):
+        model_class = models.MODEL_CLASSES[model]
+        post_ids = [
+            item['record_id'] for item in items
+            if item['model'] == model and item['action'] == POST
+        ]
+        delete_ids = [
+            item['record_id'] for item in items
+            if item['model'] == model and item['action'] == DELETE
+        ]
+        for chunk in publish.chunks(post_ids):
+            records = model_class.objects.filter(pk__in=chunk)
+            related = publish.load_related(model, chunk)
+            failed += [
+                (model, record.pk, POST)
+                for record in publish.post_records(records, related, ds)
+            ]
+        if delete_ids:
+            failed += [
+                (model, record_id, DELETE)
+                for record_id in publish.delete_docs(ds, model, delete_ids)
+            ]
+        logging.info(
+            f'published {model} {len(post_ids)} posted {len(delete_ids)} deleted'
+        )
+    if failed:
+        queue(failed)
+    return len(items) - len(failed)
+
@@ -0,0 +1,166 @@
+"""Small query language for `namesdb dump --search`
+
+Searches are compiled to Django Q objects.  Field names are checked against
+models.model_fields() and only a fixed set of lookups is allowed, so search
+text cannot reach related tables or arbitrary ORM lookups.
+
+Terms are separated by semicolons or newlines and are ANDed together:
+
+    last_name=Morita               exact match
+    last_name~mori                 case-insensitive substring (icontains)
+    last_name^Mori                 prefix (startswith)
+    birth_date>=1920-01-01         also >, <, <=
+    birth_date=1920-01-01..1929-12-31   range (inclusive)
+    facility=Manzanar|Poston       IN list
+    notes=                         empty or NULL (NULL for non-text fields)
+    match=yasui min                full-text search (see names.fts)
+
+Django-style lookups are accepted for backwards compatibility if the lookup
+is in LOOKUPS e.g. "birth_date__icontains=1932".
+
+Values compared as the field's type are converted with its to_python() when
+the search is parsed, so "birth_date>=abc" is a QueryError rather than an
+exception when the query runs.
+"""
+
+import re
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+
+from . import fts
+from . import models
+
+# Lookups that may appear in search text
+LOOKUPS = [
+    'exact', 'iexact', 'contains', 'icontains', 'startswith', 'istartswith',
+    'gt', 'gte', 'lt', 'lte', 'in', 'range', 'isnull',
+]
+# Lookups that SQLite can satisfy with an index on the column
+INDEXABLE_LOOKUPS = ['exact', 'gt', 'gte', 'lt', 'lte', 'in', 'range']
+# Lookups whose values are converted to the field's type
+TYPED_LOOKUPS = ['exact', 'gt', 'gte', 'lt', 'lte', 'in', 'range']
+
+OPERATORS = {
+    '>=': 'gte', '<=': 'lte', '>': 'gt', '<': 'lt',
+    '~': 'icontains', '^': 'startswith', '=': 'exact',
+}
+TERM = re.compile(
+    r'^\s*(?P<field>[a-z_]+?)\s*(?P<op>>=|<=|>|<|~|\^|=)\s*(?P<value>.*?)\s*$'
+)
+FTS_FIELD = 'match'
+
+
+class QueryError(Exception):
+    pass
+
+
+def fieldnames(model_class):
+    """Names of fields of model_class that can be searched
+    """
+    return [
+        name for name,*_ in models.model_fields(model_class)
+        if model_class._meta.get_field(name).concrete
+    ]
+
+def split_terms(text):
+    terms = []
+    for line in text.splitlines():
+        terms += [term for term in line.split(';') if term.strip()]
+    return terms
+
+def parse_term(term, valid_fields):
+    """Parse one search term
+
+    @returns: (field, lookup, value)
+    """
+    m = TERM.match(term)
+    if not m:
+        raise QueryError(f'Malformed search term "{term}"')
+    field,op,value = m.group('field'), m.group('op'), m.group('value')
+    if field == FTS_FIELD:
+        if op != '=':
+            raise QueryError(f'Use "{FTS_FIELD}=TERMS" for full-text search')
+        return field, 'match', value
+    lookup = OPERATORS[op]
+    if '__' in field:
+        field,lookup = field.split('__', 1)
+        if op != '=' or lookup not in LOOKUPS:
+            raise QueryError(f'Lookup not allowed: "{term}"')
+    if field not in valid_fields:
+        raise QueryError(f'Unknown field "{field}"')
+    if lookup == 'exact':
+        if '..' in value:
+            lookup,value = 'range', value.split('..', 1)
+        elif '|' in value:
+            lookup,value = 'in', value.split('|')
+        elif value == '':
+            return field, 'empty', value
+    elif lookup == 'in':
+        value = value.split('|')
+    elif lookup == 'range':
+        value = value.split('..', 1)
+    elif lookup == 'isnull':
+        value = value.lower() in ['1', 'true', 'yes']
+    return field, lookup, value
+
+def convert(model_class, field, lookup, value):
+    """Convert a term's value(s) with the field's to_python()
+
+    @returns: (field, lookup, value)
+    """
+    if lookup not in TYPED_LOOKUPS:
+        return field, lookup, value
+    model_field = model_class._meta.get_field(field)
+    try:
+        if isinstance(value, list):
+            value = [model_field.to_python(v) for v in value]
+        else:
+            value = model_field.to_python(value)
+    except (ValidationError, ValueError, TypeError):
+        raise QueryError(f'Bad value for {field}: "{value}"')
+    return field, lookup, value
+
+def parse(model_class, text):
+    """Parse search text into a list of (field, lookup, value) terms
+    """
+    valid_fields = fieldnames(model_class)
+    return [
+        convert(model_class, *parse_term(term, valid_fields))
+        for term in split_terms(text)
+    ]
+
+def to_q(model_class, terms):
+    """Q object for terms from parse()
+    """
+    q = Q()
+    for field,lookup,value in terms:
+        if lookup == 'match':
+            table = model_class._meta.db_table
+            columns = fts.fts_columns(table)
+            if not columns:
+                raise QueryError(
+                    f'No full-text index for {table}. Run "namesdb fts".'
+                )
+            expression,exact = fts.parse_search(value, columns, [])
+            q &= fts.match_q(model_class, expression)
+        elif lookup == 'empty':
+            if model_class._meta.get_field(field).empty_strings_allowed:
+                q &= Q(**{field: ''}) | Q(**{f'{field}__isnull': True})
+            else:
+                q &= Q(**{f'{field}__isnull': True})
+        else:
+            q &= Q(**{f'{field}__{lookup}': value})
+    return q
+
+def indexable_columns(model_class, terms):
+    """Columns used by terms in ways an index could speed up
+    """
+    columns = []
+    for field,lookup,value in terms:
+        if lookup not in INDEXABLE_LOOKUPS:
+            continue
+        column = model_class._meta.get_field(field).column
+        if column not in columns:
+            columns.append(column)
+    return columns
@@ -0,0 +1,89 @@
+"""Find Elasticsearch documents with no record, and records with no document
+
+Both sides are read as sorted streams of IDs -- the names database by
+keyset pagination on the primary key and Elasticsearch with a point in
+time and search_after, with _source disabled -- and merged, so memory use
+does not depend on the size of the index.
+
+    namesdb reconcile -H localhost:9200
+    namesdb reconcile -H localhost:9200 person --delete --post
+"""
+
+# Field that holds the primary key in each model's documents.  Sorting on
+# it puts documents in the same order as SQLite's (binary) primary key.
+PK_FIELDS = {
+    'person': 'nr_id',
+    'farrecord': 'far_record_id',
+    'wrarecord': 'wra_record_id',
+    'ireirecord': 'irei_id',
+    'facility': 'facility_id',
+}
+MODELS = list(PK_FIELDS.keys())
+BATCH_SIZE = 5000
+KEEP_ALIVE = '5m'
+
+MISSING = 'missing'  # record with no document
+EXTRA = 'extra'      # document with no record
+
+
+def sql_ids(model_class, batch_size=BATCH_SIZE):
+    """Primary keys in ascending order, batch_size per query
+    """
+    last = None
+    while True:
+        query = model_class.objects.order_by('pk')
+        if last is not None:
+            query = query.filter(pk__gt=last)
+        ids = list(query.values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            return
+        yield from ids
+        last = ids[-1]
+
+def es_ids(ds, model, batch_size=BATCH_SIZE):
+    """Document IDs in ascending order of PK_FIELDS[model]
+    """
+    field = PK_FIELDS[model]
+    pit = ds.es.open_point_in_time(index=ds.index_name(model), keep_alive=KEEP_ALIVE)
+    pit_id = pit['id']
+    search_after = None
+    try:
+        while True:
+            body = {
+                'size': batch_size,
+                '_source': False,
+                'sort': [{field: 'asc'}],
+                'pit': {'id': pit_id, 'keep_alive': KEEP_ALIVE},
+            }
+            if search_after:
+                body['search_after'] = search_after
+            response = ds.es.search(body=body)
+            pit_id = response.get('pit_id', pit_id)
+            hits = response['hits']['hits']
+            if not hits:
+                return
+            for hit in hits:
+                yield hit['_id']
+            search_after = hits[-1]['sort']
+    finally:
+        ds.es.close_point_in_time(body={'id': pit_id})
+
+def diff(sql, es):
+    """Merge two ascending streams of IDs
+
+    @returns: generator of (MISSING|EXTRA, id)
+    """
+    sql = iter(sql)
+    es = iter(es)
+    s = next(sql, None)
+    e = next(es, None)
+    while s is not None or e is not None:
+        if e is None or (s is not None and s < e):
+            yield MISSING, s
+            s = next(sql, None)
+        elif s is None or e < s:
+            yield EXTRA, e
+            e = next(es, None)
+        else:
+            s = next(sql, None)
+            e = next(es, None)
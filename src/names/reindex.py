@@ -0,0 +1,119 @@
+"""Rebuild Elasticsearch indexes without downtime (`namesdb reindex`)
+
+The public site reads from names* aliases e.g. "namesperson".  A reindex
+builds a new versioned index for each model ("namesperson-20240601t1200")
+with refresh disabled and no replicas, bulk-loads it, force-merges it,
+restores the normal settings, and then moves the alias to it in a single
+update_aliases call.  Searches keep hitting the old index until the swap.
+
+The first time this runs the alias name is still a concrete index created
+by `namesdb create`; it is removed in the same atomic alias update.
+"""
+
+from datetime import datetime
+import logging
+
+from . import fingerprints
+from . import models
+from . import publish
+
+MODELS = [
+    'facility', 'farpage', 'person', 'farrecord', 'wrarecord', 'ireirecord',
+    'personlocation',
+]
+# Settings used while loading
+LOAD_SETTINGS = {'index': {'refresh_interval': '-1', 'number_of_replicas': 0}}
+
+
+def version():
+    return datetime.now().strftime('%Y%m%dt%H%M%S')
+
+def versioned_name(ds, model, version):
+    return f'{ds.index_name(model)}-{version}'
+
+def alias_indices(ds, alias):
+    """Indices the alias points to, or None if alias is a concrete index
+    """
+    if ds.es.indices.exists_alias(name=alias):
+        return list(ds.es.indices.get_alias(name=alias).keys())
+    if ds.es.indices.exists(index=alias):
+        return None
+    return []
+
+def create(ds, model, index):
+    """Create index with model's mappings, set up for loading
+
+    @returns: dict Settings to restore after loading
+    """
+    es_class = models.ELASTICSEARCH_CLASSES_BY_MODEL[model]
+    es_class.init(index=index, using=ds.es)
+    current = ds.es.indices.get_settings(index=index)[index]['settings']['index']
+    restore = {'index': {
+        'refresh_interval': current.get('refresh_interval', '1s'),
+        'number_of_replicas': current.get('number_of_replicas', 1),
+    }}
+    ds.es.indices.put_settings(index=index, body=LOAD_SETTINGS)
+    return restore
+
+def load(ds, model, index, progress=None):
+    """Bulk-post all records of model into index
+
+    @returns: (list of (doc_id, hash) posted, list of failed IDs)
+    """
+    model_class = models.MODEL_CLASSES[model]
+    related = publish.load_related(model)
+    records = model_class.objects.all().iterator(chunk_size=2000)
+    posted,failed,seen,unchanged = publish.bulk_post(
+        records, related, ds, index, progress
+    )
+    return posted, failed
+
+def finish(ds, index, restore):
+    """Merge segments and restore refresh and replicas"""
+    ds.es.indices.refresh(index=index)
+    ds.es.indices.forcemerge(index=index, max_num_segments=1)
+    ds.es.indices.put_settings(index=index, body=restore)
+
+def swap(ds, model, index):
+    """Atomically point model's alias at index
+
+    @returns: list of indices the alias used to point to
+    """
+    alias = ds.index_name(model)
+    old = alias_indices(ds, alias)
+    actions = []
+    if old is None:
+        actions.append({'remove_index': {'index': alias}})
+        old = [alias]
+    else:
+        actions += [{'remove': {'index': i, 'alias': alias}} for i in old]
+    actions.append({'add': {'index': index, 'alias': alias}})
+    ds.es.indices.update_aliases(body={'actions': actions})
+    logging.info(f'{alias} -> {index} (was {old})')
+    return [i for i in old if i != alias]
+
+def reindex(ds, model, progress=None, delete_old=False):
+    """Build a new index for model and swap it in
+
+    The new index is deleted and the alias left alone if any records fail.
+
+    @returns: (str index, int documents, list of failed IDs)
+    """
+    index = versioned_name(ds, model, version())
+    restore = create(ds, model, index)
+    try:
+        posted,failed = load(ds, model, index, progress)
+    except:
+        ds.es.indices.delete(index=index)
+        raise
+    if failed:
+        ds.es.indices.delete(index=index)
+        return index, len(posted), failed
+    finish(ds, index, restore)
+    old = swap(ds, model, index)
+    # the alias now serves exactly these documents
+    fingerprints.replace(fingerprints.key(ds, ds.index_name(model)), posted)
+    if delete_old:
+        for i in old:
+            ds.es.indices.delete(index=i)
+    return index, len(posted), failed
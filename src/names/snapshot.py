@@ -0,0 +1,92 @@
+"""Point-in-time copies of the names database for publishing
+
+`namesdb post --snapshot` copies the database with VACUUM INTO, which
+reads it in a single transaction, so the copy is consistent even while
+editors save records (in WAL mode the copy doesn't block them).  The
+'names' connection is then pointed at the copy, opened read-only and
+immutable, for the rest of the run.  The snapshot generation is written
+to the _meta of each Elasticsearch index that is published.
+
+temporary() does all of this and undoes it however the run ends: the
+copy is removed and the connection, its NAME, and the profile restored.
+"""
+
+from contextlib import contextmanager
+from datetime import datetime
+import logging
+from pathlib import Path
+import sqlite3
+
+from django.conf import settings
+from django.db import connections
+
+from . import database
+
+
+def take(directory=None, using='names'):
+    """Copy the database into directory with VACUUM INTO
+
+    @param directory: str (default settings.SNAPSHOT_DIR)
+    @returns: (Path to copy, str generation)
+    """
+    src = settings.DATABASES[using]['NAME']
+    directory = Path(directory or settings.SNAPSHOT_DIR)
+    directory.mkdir(parents=True, exist_ok=True)
+    generation = datetime.now().strftime('%Y%m%dT%H%M%S')
+    dst = directory / f'{Path(src).stem}-{generation}.db'
+    conn = sqlite3.connect(src, timeout=60)
+    try:
+        conn.execute('VACUUM INTO ?', (str(dst),))
+    finally:
+        conn.close()
+    logging.info(f'snapshot {dst}')
+    return dst, generation
+
+def use(path, using='names'):
+    """Point the connection alias at a snapshot, read-only and immutable
+
+    immutable=1 tells SQLite the file can't change, so it skips locking
+    and change detection entirely.  The path is percent-encoded so that
+    characters like "?", "#", and "%" aren't read as part of the URI.
+    """
+    connection = connections[using]
+    connection.close()
+    connection.settings_dict['NAME'] = f'{Path(path).resolve().as_uri()}?mode=ro&immutable=1'
+    database.use_profile('snapshot', force=True)
+
+@contextmanager
+def temporary(directory=None, using='names'):
+    """Take a snapshot and use it for the block, then remove it
+
+    The NAME in settings.DATABASES and the connection profile are restored
+    even if the block raises or exits.
+
+    @yields: (Path to copy, str generation)
+    """
+    connection = connections[using]
+    name = connection.settings_dict['NAME']
+    profile = database.current_profile()
+    path,generation = take(directory, using)
+    try:
+        use(path, using)
+        yield path, generation
+    finally:
+        connection.close()
+        connection.settings_dict['NAME'] = name
+        database.use_profile(profile, force=True)
+        remove(path)
+
+def remove(path):
+    for p in [Path(path), Path(f'{path}-wal'), Path(f'{path}-shm')]:
+        if p.exists():
+            p.unlink()
+
+def record_generation(ds, model, generation):
+    """Store snapshot generation in the _meta of model's index"""
+    ds.es.indices.put_mapping(
+        index=ds.index_name(model),
+        body={'_meta': {
+            'snapshot_generation': generation,
+            'published': datetime.now().isoformat(timespec='seconds'),
+        }},
+    )
@@ -0,0 +1,133 @@
+"""Record the SQL workload of the admin and the namesdb command
+
+When settings.SQL_LOG is set, statements run against the names database
+are appended to that file as JSON lines:
+
+    {"ts": 1700000000.0, "source": "cli:post", "run": "5f0c1e9a2b7d",
+     "ms": 0.41, "sql": "SELECT ..."}
+
+"run" is the same for every statement of one request or command.
+Parameters are not recorded.  The log is read by `namesdb indexes` to find
+indexes that are never used and statements that scan whole tables, and
+by `namesdb sqlreport`, which groups statements by fingerprint (the SQL
+with literals and IN lists normalized) and flags N+1 patterns: the same
+SELECT run many times by one request or command, as when a loop calls
+objects.get() once per row.
+"""
+
+from contextlib import nullcontext
+import json
+import math
+import re
+import secrets
+import time
+
+from django.conf import settings
+from django.db import connections
+
+
+class Recorder:
+    """Django execute_wrapper that appends each statement to a JSONL file"""
+
+    def __init__(self, path, source):
+        self.path = path
+        self.source = source
+        self.run = secrets.token_hex(6)
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            line = json.dumps({
+                'ts': round(time.time(), 3),
+                'source': self.source,
+                'run': self.run,
+                'ms': round((time.perf_counter() - start) * 1000, 3),
+                'sql': sql,
+            })
+            with open(self.path, 'a') as f:
+                f.write(line + '\n')
+
+
+def capture(source, using='names'):
+    """Context manager that logs statements if settings.SQL_LOG is set
+
+    @param source: str Where the statements come from e.g. "cli:post", "web"
+    """
+    if not settings.SQL_LOG:
+        return nullcontext()
+    return connections[using].execute_wrapper(Recorder(settings.SQL_LOG, source))
+
+def read(path=None):
+    """Iterate over records in the SQL log"""
+    with open(path or settings.SQL_LOG, 'r') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+# Times one run may execute the same SELECT before it is flagged N+1
+N_PLUS_ONE = 10
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_IN_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+_SPACE = re.compile(r'\s+')
+
+def fingerprint(sql):
+    """SQL with literals replaced by ? and IN lists collapsed
+
+    Statements that differ only in their values or in the number of IDs
+    in an IN (...) list have the same fingerprint.
+    """
+    sql = _STRING.sub('?', sql)
+    sql = _NUMBER.sub('?', sql)
+    sql = sql.replace('%s', '?')
+    sql = _IN_LIST.sub('(...)', sql)
+    return _SPACE.sub(' ', sql).strip()
+
+def percentile(values, p):
+    """Nearest-rank percentile of a sorted list"""
+    if not values:
+        return 0.0
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+def aggregate(records):
+    """Statistics of the statements in the log, by fingerprint
+
+    @param records: iterable of dicts from read()
+    @returns: dict fingerprint: {
+        'sql': str first statement seen, 'count': int, 'ms': float total,
+        'p99': float, 'max': float, 'sources': set,
+        'per_run': int most runs of the statement by one run (0 if the
+        log has no run IDs), 'n_plus_one': bool
+    }
+    """
+    statements = {}
+    times = {}
+    per_run = {}
+    for record in records:
+        fp = fingerprint(record['sql'])
+        s = statements.setdefault(fp, {
+            'sql': record['sql'], 'count': 0, 'ms': 0.0, 'sources': set(),
+        })
+        s['count'] += 1
+        s['ms'] += record['ms']
+        s['sources'].add(record['source'])
+        times.setdefault(fp, []).append(record['ms'])
+        if record.get('run'):
+            key = (fp, record['run'])
+            per_run[key] = per_run.get(key, 0) + 1
+    for s in statements.values():
+        s['per_run'] = 0
+    for (fp,run),num in per_run.items():
+        statements[fp]['per_run'] = max(statements[fp]['per_run'], num)
+    for fp,s in statements.items():
+        ms = sorted(times[fp])
+        s['p99'] = percentile(ms, 99)
+        s['max'] = ms[-1]
+        s['n_plus_one'] = (
+            fp.upper().startswith('SELECT') and s['per_run'] >= N_PLUS_ONE
+        )
+    return statements
@@ -0,0 +1,91 @@
+"""Local SQLite database for editor bookkeeping
+
+Holds the background job queue, the publish queue, fingerprints of
+published documents, checkpoints of long CLI runs, admin changelist row
+counts, and other state that
+is not Names Registry data.  It is kept out of the names database so that
+`namesdb exportdb` never publishes it and so that bookkeeping writes don't
+contend with editors.
+Tables are created the first time each process connects.
+"""
+
+import sqlite3
+
+from django.conf import settings
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS jobs (
+        id integer PRIMARY KEY AUTOINCREMENT,
+        action varchar(64) NOT NULL,
+        model varchar(64) NOT NULL,
+        ids text NOT NULL,
+        params text NOT NULL DEFAULT '{}',
+        username varchar(150) NOT NULL,
+        status varchar(16) NOT NULL DEFAULT 'queued',
+        done integer NOT NULL DEFAULT 0,
+        total integer NOT NULL DEFAULT 0,
+        result text NOT NULL DEFAULT '',
+        error text NOT NULL DEFAULT '',
+        created datetime NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        started datetime,
+        finished datetime
+    );""",
+    "CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id);",
+    """CREATE TABLE IF NOT EXISTS publish_queue (
+        model varchar(64) NOT NULL,
+        record_id varchar(255) NOT NULL,
+        action varchar(16) NOT NULL,
+        queued datetime NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (model, record_id)
+    );""",
+    """CREATE TABLE IF NOT EXISTS fingerprints (
+        index_name varchar(255) NOT NULL,
+        doc_id varchar(255) NOT NULL,
+        hash char(40) NOT NULL,
+        published datetime NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (index_name, doc_id)
+    );""",
+    """CREATE TABLE IF NOT EXISTS checkpoints (
+        id integer PRIMARY KEY AUTOINCREMENT,
+        command varchar(64) NOT NULL,
+        params text NOT NULL DEFAULT '{}',
+        position text NOT NULL DEFAULT '',
+        failed text NOT NULL DEFAULT '[]',
+        status varchar(16) NOT NULL DEFAULT 'running',
+        created datetime NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        updated datetime NOT NULL DEFAULT CURRENT_TIMESTAMP
+    );""",
+    """CREATE TABLE IF NOT EXISTS rowcounts (
+        tbl varchar(255) PRIMARY KEY,
+        num integer NOT NULL,
+        updated datetime NOT NULL DEFAULT CURRENT_TIMESTAMP
+    );""",
+]
+
+
+# Databases whose tables this process has already created
+_ready = set()
+
+
+def connect(path=None):
+    """Connection to the state database, creating tables if necessary
+
+    WAL mode is stored in the file and the tables only need creating once,
+    so that is done on the first connect to each path, not on every one.
+    synchronous=NORMAL skips the fsync on each commit; in WAL mode a crash
+    can lose the last commits but can't corrupt the database.
+
+    @param path: str Path to database file (default: settings.STATE_DB)
+    @returns: sqlite3.Connection with sqlite3.Row rows
+    """
+    path = str(path or settings.STATE_DB)
+    conn = sqlite3.connect(path, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA synchronous=NORMAL')
+    if path not in _ready:
+        conn.execute('PRAGMA journal_mode=WAL')
+        for statement in SCHEMA:
+            conn.execute(statement)
+        conn.commit()
+        _ready.add(path)
+    return conn
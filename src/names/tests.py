@@ -1,3 +1,1661 @@
-from django.test import TestCase
+from datetime import date
+import gzip
+import io
+import json
+from pathlib import Path
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import click
+from click.testing import CliRunner
+
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.db import connections, DatabaseError, transaction
+from django.db.backends.sqlite3.base import DatabaseWrapper
+from django.db.models import Q
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from . import checkpoints
+from . import cli
+from . import cmdserver
+from . import database
+from . import dates
+from . import export
+from . import family
+from . import fileio
+from . import fingerprints
+from . import fts
+from . import indexes
+from . import jobs
+from . import lookups
+from . import metrics
+from . import paginators
+from . import profiling
+from . import publicdb
+from . import publish
+from . import publisher
+from .middleware import ProfileMiddleware
+from . import query
+from . import reconcile
+from . import reindex
+from . import snapshot
+from . import sqllog
+from . import writer
+from .models import Facility, FarPage, FarRecord, IreiRecord, Location
+from .models import Person, PersonLocation, WraRecord
+
+# Maximum number of queries on the names database for each admin change view.
+# The number must not grow with the number of inline/related rows.
+QUERY_BUDGETS = {
+    'person': 12,
+    'farrecord': 8,
+    'wrarecord': 6,
+    'ireirecord': 6,
+    'personlocation': 6,
+}
+
+
+class AdminQueryBudgetTests(TestCase):
+    databases = {'default', 'names'}
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_superuser(
+            'admin', 'admin@example.com', 'password'
+        )
+        cls.facility = Facility.objects.create(
+            facility_id='10-manzanar', facility_type='Concentration Camp',
+            title='Manzanar',
+        )
+        cls.location = Location.objects.create(
+            lat=36.728, lng=-118.154, facility=cls.facility,
+            address='Manzanar, CA', address_components='', notes='',
+        )
+        FarPage.objects.create(
+            facility=cls.facility, page=1, file_id='ddr-densho-1-1-mezzanine-1',
+        )
+        cls.person = Person(
+            nr_id='88922/nr000test', family_name='Yasui', given_name='Minoru',
+            preferred_name='Minoru Yasui', citizenship='US Citizen',
+            gender='male', wra_family_no='12345',
+        )
+        cls.person.save(username='test', note='test')
+        cls.add_related(cls.person, 0)
+
+    @classmethod
+    def add_related(cls, person, n):
+        """Add one of each kind of record related to person"""
+        FarRecord(
+            far_record_id=f'manzanar1-{n}', facility=cls.facility.facility_id,
+            far_page=1, family_number='12345', last_name='Yasui',
+            first_name='Minoru', person=person,
+        ).save(username='test', note='test')
+        WraRecord(
+            wra_record_id=f'{n}', wra_filenumber=f'{n}', facility='Manzanar',
+            lastname='Yasui', firstname='Minoru', familyno='12345',
+            assemblycenter='Portland', person=person,
+        ).save(username='test', note='test')
+        IreiRecord(
+            irei_id=f'irei-{n}', person=person, birthday='1916-10-19',
+            birthdate=date(1916,10,19), name='Minoru Yasui',
+        ).save()
+        PersonLocation.objects.create(
+            person=person, location=cls.location, facility=cls.facility,
+            facility_address='', entry_date=date(1942,5,1),
+            exit_date=date(1944,1,1), sort_start=date(1942,5,1),
+            sort_end=date(1944,1,1), notes='',
+        )
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def change_view_queries(self, url):
+        with CaptureQueriesContext(connections['names']) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def assert_budget(self, model, obj):
+        url = reverse(f'admin:names_{model}_change', args=[obj.pk])
+        before = self.change_view_queries(url)
+        for n in range(1,5):
+            self.add_related(self.person, n)
+        after = self.change_view_queries(url)
+        self.assertEqual(before, after)
+        self.assertLessEqual(after, QUERY_BUDGETS[model])
+
+    def test_person_change_view(self):
+        self.assert_budget('person', self.person)
+
+    def test_farrecord_change_view(self):
+        self.assert_budget('farrecord', FarRecord.objects.get(far_record_id='manzanar1-0'))
+
+    def test_wrarecord_change_view(self):
+        self.assert_budget('wrarecord', WraRecord.objects.get(wra_record_id='0'))
+
+    def test_ireirecord_change_view(self):
+        self.assert_budget('ireirecord', IreiRecord.objects.get(irei_id='irei-0'))
+
+    def test_personlocation_change_view(self):
+        self.assert_budget('personlocation', PersonLocation.objects.first())
+
+
+# Admin searches must return within this many seconds
+SEARCH_TARGET = 0.2
+
+
+class FTSSearchTests(TestCase):
+    databases = {'default', 'names'}
+
+    @classmethod
+    def setUpTestData(cls):
+        Person.objects.bulk_create([
+            Person(
+                nr_id=f'88922/nr{n:06}', family_name=f'Family{n}',
+                given_name='Minoru' if n % 2 else 'Mary',
+                preferred_name=f'Person {n}', wra_family_no=f'{n // 4}',
+            )
+            for n in range(5000)
+        ])
+        Person.objects.bulk_create([
+            Person(
+                nr_id='88922/nr-yasui', family_name='Yasui', given_name='Minoru',
+                preferred_name='Minoru Yasui', wra_family_no='12345',
+            ),
+            Person(
+                nr_id='88922/nr-obrien', family_name='O"Brien', given_name='Minoru',
+                preferred_name='Minoru O"Brien', wra_family_no='12345',
+            ),
+        ])
+
+    def setUp(self):
+        fts.clear_cache()
+        self.addCleanup(fts.clear_cache)
+        self.admin = admin.site._registry[Person]
+        self.request = RequestFactory().get('/')
+
+    def create_index(self):
+        # as enable_fts() does, without sqlite-utils
+        with connections['names'].cursor() as cursor:
+            cursor.execute(
+                'CREATE VIRTUAL TABLE names_person_fts USING fts5('
+                'nr_id, family_name, given_name, preferred_name, '
+                'content="names_person")'
+            )
+            cursor.execute(
+                "INSERT INTO names_person_fts (names_person_fts) VALUES ('rebuild')"
+            )
+
+    def search(self, text):
+        queryset,duplicates = self.admin.get_search_results(
+            self.request, Person.objects.all(), text
+        )
+        return sorted(queryset.values_list('nr_id', flat=True))
+
+    def test_match(self):
+        self.create_index()
+        self.assertEqual(self.search('yas'), ['88922/nr-yasui'])
+        self.assertEqual(self.search('family_name:yasui'), ['88922/nr-yasui'])
+        self.assertEqual(self.search('given_name:yasui'), [])
+        self.assertEqual(self.search('o"brien'), ['88922/nr-obrien'])
+        self.assertEqual(
+            self.search('minoru wra_family_no:12345'),
+            ['88922/nr-obrien', '88922/nr-yasui'],
+        )
+        # a bare ID matches the ID fields exactly
+        self.assertEqual(self.search('88922/nr000007'), ['88922/nr000007'])
+
+    def test_fallback_without_index(self):
+        self.assertEqual(fts.fts_columns('names_person'), [])
+        self.assertEqual(self.search('yasui'), ['88922/nr-yasui'])
+        # found as soon as it exists
+        self.create_index()
+        self.assertEqual(
+            fts.fts_columns('names_person'),
+            ['nr_id', 'family_name', 'given_name', 'preferred_name'],
+        )
+
+    def test_columns_cached(self):
+        self.create_index()
+        fts.fts_columns('names_person')
+        with self.assertNumQueries(0, using='names'):
+            fts.fts_columns('names_person')
+        fts.clear_cache()
+        with self.assertNumQueries(2, using='names'):
+            fts.fts_columns('names_person')
+
+    def test_parse_search(self):
+        columns = ['family_name', 'given_name']
+        self.assertEqual(
+            fts.parse_search('family_name:yasui min', columns, ['nr_id']),
+            ('family_name : "yasui"* "min"*', {})
+        )
+        self.assertEqual(
+            fts.parse_search('"san francisco" nr_id:88922/nr1', columns, ['nr_id']),
+            ('"san francisco"*', {'nr_id': '88922/nr1'})
+        )
+        # unknown fields, FTS5 syntax, and quotes are searched as text
+        self.assertEqual(
+            fts.parse_search('nope:x NEAR(a) OR', columns, []),
+            ('"nope:x"* "NEAR(a)"* "OR"*', {})
+        )
+        self.assertEqual(fts.quote('O"Brien'), '"O""Brien"*')
+
+    def test_search_time(self):
+        self.create_index()
+        for text in ['minoru', 'family_name:family12', '88922/nr004999']:
+            start = time.perf_counter()
+            self.search(text)
+            self.assertLess(time.perf_counter() - start, SEARCH_TARGET, text)
+
+
+class FamilyTableTests(TestCase):
+    databases = {'names'}
+
+    def make_person(self, n, wra_family_no):
+        person = Person(
+            nr_id=f'88922/nr00{n}', family_name='Yasui', given_name=f'{n}',
+            preferred_name=f'{n} Yasui', birth_date=date(1916, 10, 19),
+            wra_family_no=wra_family_no,
+        )
+        person.save(username='test', note='test')
+        return person
+
+    def test_saves_refresh_families(self):
+        a = self.make_person(1, '12345')
+        b = self.make_person(2, '12345')
+        families = Person.related_family([a.nr_id])
+        self.assertEqual(
+            [member['nr_id'] for member in families['12345']], [a.nr_id, b.nr_id]
+        )
+        self.assertEqual(families['12345'][0]['birth_year'], 1916)
+        # moving b updates the family it left and the one it joined
+        b.wra_family_no = '67890'
+        b.save(username='test', note='test')
+        families = Person.related_family()
+        self.assertEqual([m['nr_id'] for m in families['12345']], [a.nr_id])
+        self.assertEqual([m['nr_id'] for m in families['67890']], [b.nr_id])
+
+    def test_rebuild_matches_incremental(self):
+        self.make_person(1, '12345')
+        self.make_person(2, '12345')
+        self.make_person(3, '67890')
+        before = Person.related_family()
+        family.rebuild(['person'])
+        self.assertEqual(Person.related_family(), before)
+
+
+class PublisherTests(TestCase):
+    databases = {'names'}
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.settings = override_settings(
+            STATE_DB=str(Path(self.tmp.name) / 'state.db'), PUBLISH_ON_SAVE=True,
+        )
+        self.settings.enable()
+        self.a = self.make_person(1, '12345')
+        self.b = self.make_person(2, '12345')
+        self.c = self.make_person(3, '67890')
+        self.take()
+
+    def tearDown(self):
+        self.settings.disable()
+        self.tmp.cleanup()
+
+    def make_person(self, n, wra_family_no):
+        person = Person(
+            nr_id=f'88922/nr00{n}', family_name='Yasui', given_name=f'{n}',
+            preferred_name=f'{n} Yasui', wra_family_no=wra_family_no,
+        )
+        person.save(username='test', note='test')
+        return person
+
+    def take(self):
+        return sorted(
+            (item['model'], item['record_id']) for item in publisher.take(0)
+        )
+
+    def save(self, obj):
+        # as the admin's save_model() does
+        obj.user = 'test'
+        obj.save(username='test', note='test')
+
+    def test_family_members_queued(self):
+        self.save(self.a)
+        self.assertEqual(self.take(), [
+            ('person', self.a.nr_id), ('person', self.b.nr_id),
+        ])
+        # leaving a family queues the old and the new families
+        self.a.wra_family_no = '67890'
+        self.save(self.a)
+        self.assertEqual(self.take(), [
+            ('person', self.a.nr_id), ('person', self.b.nr_id),
+            ('person', self.c.nr_id),
+        ])
+
+    def test_old_person_queued(self):
+        record = FarRecord(
+            far_record_id='manzanar1-0', facility='10-manzanar', far_page=1,
+            last_name='Yasui', first_name='Minoru', person=self.a,
+        )
+        record.save(username='test', note='test')
+        self.take()
+        record.person = self.c
+        self.save(record)
+        self.assertEqual(self.take(), [
+            ('farrecord', 'manzanar1-0'),
+            ('person', self.a.nr_id), ('person', self.c.nr_id),
+        ])
+
+
+class IndexAdvisorTests(TestCase):
+    databases = {'names'}
+
+    def log(self, sql, ms=1.0):
+        return {'sql': sql, 'ms': ms, 'source': 'test'}
+
+    def test_missing_and_apply(self):
+        # the test database is made from the models, not the migrations
+        self.assertEqual(indexes.missing(), list(indexes.INDEXES))
+        Person.objects.bulk_create([
+            Person(
+                nr_id=f'88922/nr{n:03}', family_name='Yasui', given_name=f'{n}',
+                preferred_name=f'{n} Yasui', wra_family_no=f'{n}',
+            )
+            for n in range(30)
+        ])
+        results = indexes.apply(['names_person_wra_family_no_idx'])
+        self.assertEqual(
+            [name for name,before,after in results], ['names_person_wra_family_no_idx']
+        )
+        name,before,after = results[0]
+        self.assertGreater(before, 0)
+        self.assertGreater(after, 0)
+        self.assertEqual(
+            indexes.existing()['names_person_wra_family_no_idx'], 'names_person'
+        )
+        self.assertNotIn('names_person_wra_family_no_idx', indexes.missing())
+        # no rows to sample, nothing to time
+        self.assertEqual(
+            indexes.apply(['names_wrarecord_facility_idx']),
+            [('names_wrarecord_facility_idx', None, None)]
+        )
+
+    def test_plan(self):
+        sql = 'SELECT "nr_id" FROM "names_person" WHERE "timestamp" > %s'
+        self.assertEqual(
+            database.full_scans(indexes.plan(sql)), ['names_person']
+        )
+        indexes.apply(['names_person_timestamp_idx'])
+        details = [detail for _,_,detail in indexes.plan(sql)]
+        self.assertTrue(
+            any('names_person_timestamp_idx' in detail for detail in details), details
+        )
+        self.assertEqual(database.full_scans(indexes.plan(sql)), [])
+
+    def test_unused(self):
+        indexes.apply(['names_person_timestamp_idx', 'names_farrecord_timestamp_idx'])
+        statements = indexes.workload([
+            self.log('SELECT * FROM "names_person" WHERE "timestamp" > %s', 2.0),
+            self.log('SELECT * FROM "names_person" WHERE "timestamp" > %s', 3.0),
+            self.log('SELECT * FROM "names_wrarecord" WHERE "lastname" = %s', 9.0),
+            self.log('UPDATE "names_person" SET "notes" = %s'),
+            self.log('SELECT * FROM "names_gone" WHERE "x" = %s'),
+        ])
+        self.assertEqual(statements[
+            'SELECT * FROM "names_person" WHERE "timestamp" > %s'
+        ]['count'], 2)
+        self.assertEqual(len(statements), 3)
+        used,scans = indexes.analyze(statements)
+        self.assertEqual(used, {'names_person_timestamp_idx': 2})
+        self.assertEqual(
+            [(sql, tables) for sql,stats,tables in scans],
+            [('SELECT * FROM "names_wrarecord" WHERE "lastname" = %s', ['names_wrarecord'])]
+        )
+        unused = indexes.unused(used)
+        self.assertIn(('names_farrecord_timestamp_idx', 'names_farrecord'), unused)
+        self.assertNotIn(('names_person_timestamp_idx', 'names_person'), unused)
+
+
+class JobsTests(TestCase):
+    databases = {'default', 'names'}
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.settings = override_settings(
+            STATE_DB=str(Path(self.tmp.name) / 'state.db'),
+            EXPORT_ROOT=Path(self.tmp.name) / 'export',
+            PUBLISH_ON_SAVE=False,
+        )
+        self.settings.enable()
+        self.calls = []
+        def action(model, ids, params, progress):
+            if params.get('fail'):
+                raise ValueError('bad job')
+            self.calls.append((model, ids))
+            progress(len(ids), len(ids))
+            return f'{len(ids)} {model}'
+        self.actions = mock.patch.dict(jobs.ACTIONS, {'test': action})
+        self.actions.start()
+
+    def tearDown(self):
+        self.actions.stop()
+        self.settings.disable()
+        self.tmp.cleanup()
+
+    def test_enqueue_and_claim(self):
+        with self.assertRaises(Exception):
+            jobs.enqueue('nope', 'person', ['a'], 'test')
+        first = jobs.enqueue('test', 'person', ['a', 'b'], 'test')
+        second = jobs.enqueue('test', 'farrecord', ['c'], 'test')
+        self.assertEqual(jobs.get(first)['status'], jobs.QUEUED)
+        self.assertEqual(jobs.get(first)['total'], 2)
+        # oldest first, each job claimed once
+        self.assertEqual(jobs.claim()['id'], first)
+        self.assertEqual(jobs.get(first)['status'], jobs.RUNNING)
+        self.assertEqual(jobs.claim()['id'], second)
+        self.assertIsNone(jobs.claim())
+        self.assertEqual([job['id'] for job in jobs.recent()], [second, first])
+
+    def test_run(self):
+        ok = jobs.enqueue('test', 'person', ['a', 'b'], 'test')
+        failing = jobs.enqueue('test', 'person', ['c'], 'test', {'fail': True})
+        self.assertEqual(jobs.run(jobs.claim()), jobs.DONE)
+        self.assertEqual(jobs.run(jobs.claim()), jobs.FAILED)
+        job = jobs.get(ok)
+        self.assertEqual(
+            (job['status'], job['done'], job['result']), (jobs.DONE, 2, '2 person')
+        )
+        self.assertIsNotNone(job['finished'])
+        job = jobs.get(failing)
+        self.assertEqual(job['status'], jobs.FAILED)
+        self.assertIn('bad job', job['error'])
+
+    def test_work_requeues_interrupted(self):
+        interrupted = jobs.enqueue('test', 'person', ['a'], 'test')
+        queued = jobs.enqueue('test', 'farrecord', ['b'], 'test')
+        jobs.claim()  # by a worker that died
+        jobs.work(burst=True)
+        self.assertEqual(self.calls, [('person', ['a']), ('farrecord', ['b'])])
+        for job_id in [interrupted, queued]:
+            self.assertEqual(jobs.get(job_id)['status'], jobs.DONE)
+
+    def export_job(self):
+        FarRecord(
+            far_record_id='manzanar1-0', facility='10-manzanar', far_page=1,
+            last_name='Yasui', first_name='Minoru',
+        ).save(username='test', note='test')
+        job_id = jobs.enqueue('export', 'farrecord', ['manzanar1-0'], 'test')
+        jobs.work(burst=True)
+        return job_id
+
+    def test_export_download(self):
+        job_id = self.export_job()
+        job = jobs.get(job_id)
+        self.assertEqual(job['status'], jobs.DONE)
+        url = reverse('names:job_download', args=[job_id])
+        # staff only
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 302)
+        self.client.force_login(User.objects.create_user('editor'))
+        self.assertEqual(self.client.get(url).status_code, 302)
+        self.client.force_login(User.objects.create_user('staff', is_staff=True))
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        text = b''.join(response.streaming_content).decode('utf-8')
+        self.assertIn('far_record_id', text.splitlines()[0])
+        self.assertIn('manzanar1-0', text)
+
+    def test_download_only_finished_exports(self):
+        self.client.force_login(User.objects.create_user('staff', is_staff=True))
+        done = self.export_job()
+        queued = jobs.enqueue('export', 'farrecord', ['manzanar1-0'], 'test')
+        other = jobs.enqueue('test', 'farrecord', ['manzanar1-0'], 'test')
+        jobs.run(jobs.get(other))
+        for job_id in [queued, other, other + 1]:
+            response = self.client.get(reverse('names:job_download', args=[job_id]))
+            self.assertEqual(response.status_code, 404)
+        # the file was cleaned up
+        (Path(self.tmp.name) / 'export' / jobs.get(done)['result']).unlink()
+        response = self.client.get(reverse('names:job_download', args=[done]))
+        self.assertEqual(response.status_code, 404)
+
+class LookupsTests(TestCase):
+    databases = {'names'}
+
+    def test_saves_invalidate(self):
+        facility = Facility.objects.create(
+            facility_id='10-manzanar', facility_type='Concentration Camp',
+            title='Manzanar',
+        )
+        self.assertEqual(lookups.facility_titles()['10-manzanar'], 'Manzanar')
+        self.assertIsNone(lookups.far_page_file_id('10-manzanar', 1))
+        facility.title = 'Manzanar Relocation Center'
+        facility.save()
+        FarPage.objects.create(
+            facility=facility, page=1, file_id='ddr-densho-1-1-mezzanine-1',
+        )
+        self.assertEqual(
+            lookups.facility_titles()['10-manzanar'], 'Manzanar Relocation Center'
+        )
+        self.assertEqual(
+            lookups.far_page_file_id('10-manzanar', '1'), 'ddr-densho-1-1-mezzanine-1'
+        )
+
+
+class QueryLanguageTests(SimpleTestCase):
+
+    def test_operators(self):
+        self.assertEqual(
+            query.parse(FarRecord, 'last_name=Morita; year_of_birth>=1920\nfacility=A|B'),
+            [
+                ('last_name', 'exact', 'Morita'),
+                ('year_of_birth', 'gte', '1920'),
+                ('facility', 'in', ['A', 'B']),
+            ]
+        )
+
+    def test_range(self):
+        self.assertEqual(
+            query.parse(Person, 'birth_date=1920-01-01..1929-12-31'),
+            [('birth_date', 'range', [date(1920,1,1), date(1929,12,31)])]
+        )
+
+    def test_django_lookup(self):
+        self.assertEqual(
+            query.parse(FarRecord, 'last_name__icontains=mori'),
+            [('last_name', 'icontains', 'mori')]
+        )
+
+    def test_rejects_unknown_fields_and_lookups(self):
+        for text in ['nope=1', 'person__family_name=Yasui', 'last_name__regex=.*']:
+            with self.assertRaises(query.QueryError):
+                query.parse(FarRecord, text)
+
+    def test_rejects_invalid_values(self):
+        for text in [
+            'birth_date>=abc', 'birth_date>=', 'birth_date=1920-01-01..x',
+            'birth_date=1920-01-01|1920-13-01',
+        ]:
+            with self.assertRaises(query.QueryError):
+                query.parse(Person, text)
+
+    def test_to_q(self):
+        self.assertEqual(
+            query.to_q(FarRecord, query.parse(FarRecord, 'last_name~mori; facility=A|B')),
+            Q(last_name__icontains='mori') & Q(facility__in=['A', 'B'])
+        )
+        self.assertEqual(
+            query.to_q(Person, query.parse(Person, 'birth_date>=1920-01-01')),
+            Q(birth_date__gte=date(1920,1,1))
+        )
+
+    def test_empty(self):
+        # character fields match '' or NULL, others only NULL
+        self.assertEqual(
+            query.to_q(FarRecord, query.parse(FarRecord, 'last_name=')),
+            Q(last_name='') | Q(last_name__isnull=True)
+        )
+        self.assertEqual(
+            query.to_q(Person, query.parse(Person, 'birth_date=')),
+            Q(birth_date__isnull=True)
+        )
+
+
+class DatesTests(SimpleTestCase):
+
+    def test_formats(self):
+        for value in ['1920-01-02', '1920-01-02 00:00:00', '01/02/1920', 'Jan 2, 1920']:
+            self.assertEqual(dates.parse(value).date(), date(1920, 1, 2))
+        self.assertEqual(dates.classify('Jan 2 1920')[1], dates.FALLBACK)
+        self.assertIsNone(dates.parse('ca. 1920s'))
+        self.assertIsNone(dates.parse(''))
+
+    def test_parse_columns_report(self):
+        rowds = [
+            {'birth_date': '1920-01-02'}, {'birth_date': '1920-01-02'},
+            {'birth_date': 'unknown'}, {'birth_date': ''},
+        ]
+        parsed,report = dates.parse_columns(rowds, ['birth_date'])
+        self.assertEqual(len(parsed['birth_date']), 2)
+        self.assertEqual(report.formats['birth_date']['%Y-%m-%d'], 2)
+        self.assertEqual(report.unparseable['birth_date'], {'unknown': 1})
+
+
+class MetricsTests(SimpleTestCase):
+
+    def test_stages_and_spans(self):
+        run = metrics.start('post')
+        with metrics.span('post.related') as stage:
+            with metrics.timer('post.document') as inner:
+                inner.rows += 2
+            stage.rows += 3
+        self.assertEqual(list(metrics.iterate('post.sql', 'abc')), ['a', 'b', 'c'])
+        metrics.finish()
+        self.assertEqual(run.stages['post.related'].rows, 3)
+        self.assertEqual(run.stages['post.document'].calls, 1)
+        self.assertEqual(run.stages['post.sql'].rows, 3)
+        self.assertGreater(run.stages['post.related'].rss, 0)
+        # one span for the stage, one for the run
+        related,root = run.spans
+        self.assertEqual(related['parentSpanId'], root['spanId'])
+        self.assertIsNone(root['parentSpanId'])
+        self.assertIn('post.related', '\n'.join(metrics.report(run)))
+        self.assertIn(
+            'namesdb_stage_rows{command="post",stage="post.sql"} 3',
+            metrics.prometheus(run)
+        )
+
+
+class ProfileMiddlewareTests(TestCase):
+    databases = {'names'}
+
+    def test_records_sql_and_profile(self):
+        def view(request):
+            list(Facility.objects.all())
+            return HttpResponse('ok')
+        with tempfile.TemporaryDirectory() as tmp, \
+             override_settings(PROFILE_DIR=tmp, PROFILE_SLOW_MS=0):
+            response = ProfileMiddleware(view)(RequestFactory().get('/admin/'))
+            with (Path(tmp) / 'requests.jsonl').open() as f:
+                record = json.loads(f.readline())
+            self.assertTrue(Path(record['profile']).exists())
+        self.assertEqual(record['queries'], {'names': 1})
+        self.assertIn('desc="1 queries"', response['Server-Timing'])
+
+
+class SQLLogTests(SimpleTestCase):
+
+    def test_fingerprint(self):
+        self.assertEqual(
+            sqllog.fingerprint(
+                'SELECT * FROM "names_person" WHERE "nr_id" IN (%s, %s)  LIMIT 21'
+            ),
+            sqllog.fingerprint(
+                "SELECT * FROM \"names_person\" WHERE \"nr_id\" IN (%s) LIMIT 5"
+            ),
+        )
+        self.assertEqual(
+            sqllog.fingerprint("SELECT a FROM t1 WHERE b = 'x''y' AND c = 2.5"),
+            'SELECT a FROM t1 WHERE b = ? AND c = ?'
+        )
+
+    def test_aggregate_flags_n_plus_one(self):
+        get = 'SELECT * FROM "names_facility" WHERE "facility_id" = %s LIMIT 21'
+        records = [
+            {'source': 'web', 'run': 'a', 'ms': float(n), 'sql': get}
+            for n in range(1, sqllog.N_PLUS_ONE + 1)
+        ] + [
+            {'source': 'web', 'run': 'b', 'ms': 1.0, 'sql': 'SELECT * FROM "names_person"'},
+        ]
+        statements = sqllog.aggregate(records)
+        stats = statements[sqllog.fingerprint(get)]
+        self.assertEqual(stats['count'], sqllog.N_PLUS_ONE)
+        self.assertEqual(stats['p99'], float(sqllog.N_PLUS_ONE))
+        self.assertTrue(stats['n_plus_one'])
+        self.assertFalse(statements['SELECT * FROM "names_person"']['n_plus_one'])
+
+
+class PublicDBTests(SimpleTestCase):
+
+    def test_copy_table_with_rowid_gaps(self):
+        conn = sqlite3.connect(':memory:', isolation_level=None)
+        conn.execute("ATTACH DATABASE ':memory:' AS src")
+        for schema in ['main', 'src']:
+            conn.execute(
+                f'CREATE TABLE {schema}.names_person '
+                '(nr_id varchar(255) PRIMARY KEY, preferred_name text)'
+            )
+        conn.executemany(
+            'INSERT INTO src.names_person VALUES (?, ?)',
+            [(f'nr{n:03}', str(n)) for n in range(20)]
+        )
+        conn.execute(
+            "DELETE FROM src.names_person WHERE nr_id IN ('nr003', 'nr004', 'nr010')"
+        )
+        batches = []
+        publicdb.copy_table(conn, 'names_person', batches.append, batch_size=4)
+        self.assertEqual(batches, [4, 4, 4, 4, 1])
+        self.assertEqual(
+            conn.execute('SELECT nr_id FROM main.names_person ORDER BY rowid').fetchall(),
+            conn.execute('SELECT nr_id FROM src.names_person ORDER BY rowid').fetchall(),
+        )
+
+    def test_export_without_rowid_table(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            src = Path(tmp) / 'src.db'
+            conn = sqlite3.connect(src)
+            conn.execute(
+                'CREATE TABLE names_family (model text, family_key text, '
+                'members text, PRIMARY KEY (model, family_key)) WITHOUT ROWID'
+            )
+            conn.execute("INSERT INTO names_family VALUES ('person', '5', '[]')")
+            conn.commit()
+            conn.close()
+            counts = publicdb.export_db(str(src), str(Path(tmp) / 'dst.db'))
+        self.assertEqual(counts, {'names_family': 1})
+
+
+class FakeIndices:
+    """Just enough of elasticsearch's IndicesClient for fingerprints.key()"""
+
+    def __init__(self, uuid):
+        self.uuid = uuid
+
+    def get_settings(self, index, name):
+        return {f'{index}-1': {'settings': {'index': {'uuid': self.uuid}}}}
+
+
+class FakeDoc:
+
+    def __init__(self, doc_id):
+        self.meta = SimpleNamespace(id=doc_id)
+
+    def to_dict(self, include_meta=False):
+        return {'id': self.meta.id}
+
+
+class FakeRecord:
+
+    def __init__(self, pk, fail=False):
+        self.pk = pk
+        self.fail = fail
+
+    def es_document(self, related):
+        if self.fail:
+            raise ValueError('bad record')
+        return FakeDoc(self.pk)
+
+
+class FingerprintsTests(SimpleTestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.settings = override_settings(STATE_DB=str(Path(self.tmp.name) / 'state.db'))
+        self.settings.enable()
+        self.ds = SimpleNamespace(
+            es=SimpleNamespace(indices=FakeIndices('uuid1')),
+            index_name=lambda model: f'names{model}',
+        )
+
+    def tearDown(self):
+        self.settings.disable()
+        self.tmp.cleanup()
+
+    def test_recreated_index_has_no_fingerprints(self):
+        key = fingerprints.key(self.ds, 'namesperson')
+        fingerprints.save(key, [('a', 'hash-a')])
+        self.assertEqual(fingerprints.load(key), {'a': 'hash-a'})
+        # destroyed and created again, or the same name on another cluster
+        self.ds.es.indices.uuid = 'uuid2'
+        self.assertEqual(fingerprints.load(fingerprints.key(self.ds, 'namesperson')), {})
+        fingerprints.clear('namesperson')
+        self.assertEqual(fingerprints.load(key), {})
+
+    def test_post_changed_counts(self):
+        key = fingerprints.key(self.ds, 'namesperson')
+        fingerprints.save(key, [('a', fingerprints.digest(FakeDoc('a')))])
+        records = [FakeRecord('a'), FakeRecord('b'), FakeRecord('c', fail=True)]
+        def streaming_bulk(es, actions, **kwargs):
+            for action in actions:
+                yield True, {'index': {'_id': action['id']}}
+        with mock.patch.object(publish, 'streaming_bulk', streaming_bulk):
+            posted,unchanged,failed,seen = publish.post_changed(
+                records, {}, self.ds, 'person'
+            )
+        self.assertEqual((posted, unchanged, failed), (1, 1, ['c']))
+        self.assertEqual(sorted(fingerprints.load(key)), ['a', 'b'])
+
+    def test_duplicate_ids_posted_once(self):
+        key = fingerprints.key(self.ds, 'namesperson')
+        sent = []
+        def streaming_bulk(es, actions, **kwargs):
+            for action in actions:
+                sent.append(action['id'])
+                yield True, {'index': {'_id': action['id']}}
+            # Elasticsearch reporting a document twice
+            yield True, {'index': {'_id': 'a'}}
+        records = [FakeRecord('a'), FakeRecord('b'), FakeRecord('a')]
+        with mock.patch.object(publish, 'streaming_bulk', streaming_bulk):
+            posted,unchanged,failed,seen = publish.post_changed(
+                records, {}, self.ds, 'person'
+            )
+        self.assertEqual(sent, ['a', 'b'])
+        self.assertEqual(seen, ['a', 'b'])
+        self.assertEqual((posted, unchanged, failed), (2, 0, []))
+        self.assertEqual(sorted(fingerprints.load(key)), ['a', 'b'])
+
+
+
+class ExportTests(TestCase):
+    databases = {'names'}
+    columns = ['far_record_id', 'far_page', 'last_name', 'first_name']
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        for n,last_name in enumerate(['Yasui', 'O"Brien, Jr.']):
+            record = FarRecord(
+                far_record_id=f'manzanar1-{n}', facility='10-manzanar',
+                far_page=1, last_name=last_name, first_name='Minoru\nM.',
+            )
+            record.save(username='test', note='test')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def dump(self, fmt, compression=None):
+        path = Path(self.tmp.name) / f'dump.{fmt}'
+        n = export.export(
+            FarRecord, self.columns, export.queryset(FarRecord), fmt, str(path),
+            compression,
+        )
+        self.assertEqual(n, 2)
+        data = path.read_bytes()
+        if compression == 'gzip':
+            data = gzip.decompress(data)
+        elif compression == 'zstd':
+            import zstandard
+            data = zstandard.ZstdDecompressor().decompressobj().decompress(data)
+        return data.decode('utf-8')
+
+    def expected(self):
+        return [
+            {'far_record_id': 'manzanar1-0', 'far_page': 1,
+             'last_name': 'Yasui', 'first_name': 'Minoru\nM.'},
+            {'far_record_id': 'manzanar1-1', 'far_page': 1,
+             'last_name': 'O"Brien, Jr.', 'first_name': 'Minoru\nM.'},
+        ]
+
+    def read_csv(self, text):
+        reader = fileio.csv_reader(io.StringIO(text, newline=''))
+        headers = next(reader)
+        return [dict(zip(headers, row)) for row in reader]
+
+    def test_queryset(self):
+        self.assertEqual(
+            [r.pk for r in export.queryset(FarRecord, ids=['manzanar1-1'])],
+            ['manzanar1-1'],
+        )
+        self.assertEqual(
+            [r.pk for r in export.queryset(FarRecord, search=Q(last_name='Yasui'))],
+            ['manzanar1-0'],
+        )
+        self.assertEqual(
+            [r.pk for r in export.queryset(FarRecord, limit=1)], ['manzanar1-0']
+        )
+
+    def test_csv(self):
+        # CSV values are all text
+        expected = [
+            {key: str(value) for key,value in row.items()}
+            for row in self.expected()
+        ]
+        self.assertEqual(self.read_csv(self.dump('csv')), expected)
+        self.assertEqual(self.read_csv(self.dump('csv', 'gzip')), expected)
+
+    def test_jsonl(self):
+        for compression in [None, 'gzip']:
+            text = self.dump('jsonl', compression)
+            self.assertEqual(
+                [json.loads(line) for line in text.splitlines()], self.expected()
+            )
+
+    def test_zstd(self):
+        try:
+            import zstandard
+        except ImportError:
+            self.skipTest('zstandard is not installed')
+        self.assertEqual(
+            [json.loads(line) for line in self.dump('jsonl', 'zstd').splitlines()],
+            self.expected()
+        )
+
+    def test_unknown_format(self):
+        with self.assertRaises(Exception):
+            self.dump('xml')
+
+
+
+class FakeSearchES:
+    """Sorted search with a point in time, enough of Elasticsearch for es_ids()"""
+
+    def __init__(self, ids):
+        self.ids = sorted(ids)
+        self.pits = []
+        self.searches = 0
+
+    def open_point_in_time(self, index, keep_alive):
+        self.pits.append(index)
+        return {'id': f'pit-{index}'}
+
+    def close_point_in_time(self, body):
+        self.pits.remove(body['id'][len('pit-'):])
+
+    def search(self, body):
+        self.searches += 1
+        ids = self.ids
+        if body.get('search_after'):
+            ids = [i for i in ids if i > body['search_after'][0]]
+        return {'hits': {'hits': [
+            {'_id': i, 'sort': [i]} for i in ids[:body['size']]
+        ]}}
+
+
+class ReconcileTests(TestCase):
+    databases = {'names'}
+    # in SQLite's binary order
+    IDS = ['10-manzanar', '10-manzanar-2', 'B', 'a', 'a-1', 'é']
+
+    def test_sql_ids(self):
+        for facility_id in reversed(self.IDS):
+            Facility.objects.create(
+                facility_id=facility_id, facility_type='Concentration Camp',
+                title=facility_id,
+            )
+        for batch_size in [1, 4, 100]:
+            self.assertEqual(
+                list(reconcile.sql_ids(Facility, batch_size=batch_size)), self.IDS
+            )
+
+    def test_es_ids(self):
+        es = FakeSearchES(reversed(self.IDS))
+        ds = SimpleNamespace(es=es, index_name=lambda model: f'names{model}')
+        self.assertEqual(list(reconcile.es_ids(ds, 'facility', batch_size=4)), self.IDS)
+        self.assertEqual(es.searches, 3)
+        self.assertEqual(es.pits, [])
+        # closed when the caller stops early
+        ids = reconcile.es_ids(ds, 'facility', batch_size=4)
+        next(ids)
+        ids.close()
+        self.assertEqual(es.pits, [])
+
+    def test_diff(self):
+        self.assertEqual(list(reconcile.diff(self.IDS, self.IDS)), [])
+        self.assertEqual(
+            list(reconcile.diff(['a', 'c', 'd', 'f'], ['b', 'c', 'e', 'f', 'g'])),
+            [
+                (reconcile.MISSING, 'a'), (reconcile.EXTRA, 'b'),
+                (reconcile.MISSING, 'd'), (reconcile.EXTRA, 'e'),
+                (reconcile.EXTRA, 'g'),
+            ]
+        )
+        # nothing in Elasticsearch, nothing in the database
+        self.assertEqual(
+            list(reconcile.diff(['a', 'b'], [])),
+            [(reconcile.MISSING, 'a'), (reconcile.MISSING, 'b')]
+        )
+        self.assertEqual(
+            list(reconcile.diff([], ['a', 'b'])),
+            [(reconcile.EXTRA, 'a'), (reconcile.EXTRA, 'b')]
+        )
+        # case and non-ASCII IDs compare as SQLite and Elasticsearch sort them
+        self.assertEqual(
+            list(reconcile.diff(['B', 'a', 'é'], ['a', 'b', 'é'])),
+            [(reconcile.MISSING, 'B'), (reconcile.EXTRA, 'b')]
+        )
+
+
+class FakeReindexIndices:
+    """Indices and aliases in memory, enough of IndicesClient for names.reindex"""
+
+    def __init__(self):
+        self.settings = {}  # index: index settings
+        self.aliases = {}  # alias: [indices]
+        self.calls = []
+
+    def create(self, index):
+        self.settings[index] = {
+            'uuid': f'uuid-{index}', 'refresh_interval': '5s',
+            'number_of_replicas': '2',
+        }
+
+    def exists(self, index):
+        return index in self.settings
+
+    def exists_alias(self, name):
+        return bool(self.aliases.get(name))
+
+    def get_alias(self, name):
+        return {index: {'aliases': {name: {}}} for index in self.aliases[name]}
+
+    def get_settings(self, index, name=None):
+        return {
+            i: {'settings': {'index': dict(self.settings[i])}}
+            for i in self.aliases.get(index) or [index]
+        }
+
+    def put_settings(self, index, body):
+        self.settings[index].update(body['index'])
+
+    def refresh(self, index):
+        self.calls.append(('refresh', index))
+
+    def forcemerge(self, index, max_num_segments):
+        self.calls.append(('forcemerge', index))
+
+    def update_aliases(self, body):
+        self.calls.append(('update_aliases', body['actions']))
+        for action in body['actions']:
+            (op,args), = action.items()
+            if op == 'remove_index':
+                del self.settings[args['index']]
+            elif op == 'remove':
+                self.aliases[args['alias']].remove(args['index'])
+            elif op == 'add':
+                self.aliases.setdefault(args['alias'], []).append(args['index'])
+
+    def delete(self, index):
+        self.calls.append(('delete', index))
+        del self.settings[index]
+
+
+class FakeESPerson:
+
+    @classmethod
+    def init(cls, index, using):
+        using.indices.create(index)
+
+
+class ReindexTests(SimpleTestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.settings = override_settings(STATE_DB=str(Path(self.tmp.name) / 'state.db'))
+        self.settings.enable()
+        self.indices = FakeReindexIndices()
+        self.ds = SimpleNamespace(
+            es=SimpleNamespace(indices=self.indices),
+            index_name=lambda model: f'names{model}',
+        )
+        self.classes = mock.patch.dict(
+            reindex.models.ELASTICSEARCH_CLASSES_BY_MODEL, {'person': FakeESPerson}
+        )
+        self.classes.start()
+        # settings of the new index while it was loaded
+        self.loading = None
+        self.failed = []
+
+    def tearDown(self):
+        self.classes.stop()
+        self.settings.disable()
+        self.tmp.cleanup()
+
+    def load(self, ds, model, index, progress=None):
+        self.loading = dict(self.indices.settings[index])
+        return [('a', 'hash-a'), ('b', 'hash-b')], self.failed
+
+    def reindex(self, **kwargs):
+        with mock.patch.object(reindex, 'load', self.load):
+            return reindex.reindex(self.ds, 'person', **kwargs)
+
+    def test_replaces_concrete_index(self):
+        # made by `namesdb create`
+        self.indices.create('namesperson')
+        index,num,failed = self.reindex()
+        self.assertEqual((num, failed), (2, []))
+        self.assertEqual(self.loading['refresh_interval'], '-1')
+        self.assertEqual(self.loading['number_of_replicas'], 0)
+        # settings restored, merged before the swap
+        self.assertEqual(self.indices.settings[index]['refresh_interval'], '5s')
+        self.assertEqual(self.indices.settings[index]['number_of_replicas'], '2')
+        self.assertEqual(self.indices.calls, [
+            ('refresh', index), ('forcemerge', index),
+            ('update_aliases', [
+                {'remove_index': {'index': 'namesperson'}},
+                {'add': {'index': index, 'alias': 'namesperson'}},
+            ]),
+        ])
+        self.assertEqual(self.indices.aliases, {'namesperson': [index]})
+        self.assertNotIn('namesperson', self.indices.settings)
+        key = fingerprints.key(self.ds, 'namesperson')
+        self.assertEqual(key, f'namesperson@uuid-{index}')
+        self.assertEqual(fingerprints.load(key), {'a': 'hash-a', 'b': 'hash-b'})
+
+    def test_moves_alias(self):
+        self.indices.create('namesperson-old')
+        self.indices.aliases['namesperson'] = ['namesperson-old']
+        index,num,failed = self.reindex(delete_old=True)
+        self.assertEqual(self.indices.calls[2:], [
+            ('update_aliases', [
+                {'remove': {'index': 'namesperson-old', 'alias': 'namesperson'}},
+                {'add': {'index': index, 'alias': 'namesperson'}},
+            ]),
+            ('delete', 'namesperson-old'),
+        ])
+        self.assertEqual(self.indices.aliases, {'namesperson': [index]})
+        self.assertEqual(list(self.indices.settings), [index])
+
+    def test_failures_keep_alias(self):
+        self.indices.create('namesperson-old')
+        self.indices.aliases['namesperson'] = ['namesperson-old']
+        self.failed = ['c']
+        index,num,failed = self.reindex(delete_old=True)
+        self.assertEqual(failed, ['c'])
+        self.assertEqual(self.indices.calls, [('delete', index)])
+        self.assertEqual(self.indices.aliases, {'namesperson': ['namesperson-old']})
+        self.assertEqual(list(self.indices.settings), ['namesperson-old'])
+
+
+class DatabaseProfileTests(TestCase):
+    databases = {'names'}
+
+    def tearDown(self):
+        database.use_profile(database.DEFAULT_PROFILE, force=True)
+
+    def test_writable_after_read_only_profile(self):
+        database.use_profile('read-only-publish', force=True)
+        database.use_profile('interactive', force=True)
+        with connections['names'].cursor() as cursor:
+            cursor.execute('PRAGMA query_only')
+            self.assertEqual(cursor.fetchone()[0], 0)
+        Facility.objects.create(
+            facility_id='10-manzanar', facility_type='Concentration Camp',
+            title='Manzanar',
+        )
+
+
+class SnapshotTests(SimpleTestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        # characters that mean something in a URI
+        self.dir = Path(tmp.name) / 'snap shots?#%1'
+        src = Path(tmp.name) / 'names.db'
+        conn = sqlite3.connect(src)
+        conn.execute('CREATE TABLE names_facility (facility_id text, title text)')
+        conn.execute("INSERT INTO names_facility VALUES ('10-manzanar', 'Manzanar')")
+        conn.commit()
+        conn.close()
+        # a names connection to src in place of the test database
+        settings_dict = {**connections['names'].settings_dict, 'NAME': str(src)}
+        self.connection = DatabaseWrapper(settings_dict, alias='names')
+        self.addCleanup(self.connection.close)
+        for patch in [
+            mock.patch.object(snapshot, 'connections', {'names': self.connection}),
+            mock.patch.object(database, 'connections', {'names': self.connection}),
+            mock.patch.dict(settings.DATABASES, names=settings_dict),
+        ]:
+            patch.start()
+            self.addCleanup(patch.stop)
+        profile = database.current_profile()
+        self.addCleanup(database.use_profile, profile, force=True)
+
+    def facilities(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute('SELECT facility_id, title FROM names_facility')
+            return cursor.fetchall()
+
+    def test_take(self):
+        path,generation = snapshot.take(self.dir)
+        self.assertEqual(path, self.dir / f'names-{generation}.db')
+        conn = sqlite3.connect(path)
+        self.assertEqual(
+            conn.execute('SELECT * FROM names_facility').fetchall(),
+            [('10-manzanar', 'Manzanar')]
+        )
+        conn.close()
+
+    def test_use(self):
+        path,generation = snapshot.take(self.dir)
+        snapshot.use(path)
+        self.assertEqual(database.current_profile(), 'snapshot')
+        self.assertTrue(self.connection.settings_dict['NAME'].endswith(
+            '?mode=ro&immutable=1'
+        ))
+        self.assertEqual(self.facilities(), [('10-manzanar', 'Manzanar')])
+        with self.assertRaises(DatabaseError):
+            with self.connection.cursor() as cursor:
+                cursor.execute("DELETE FROM names_facility")
+
+    def test_temporary(self):
+        name = self.connection.settings_dict['NAME']
+        profile = database.current_profile()
+        with snapshot.temporary(self.dir) as (path,generation):
+            self.assertTrue(path.exists())
+            self.assertEqual(database.current_profile(), 'snapshot')
+            self.assertEqual(self.facilities(), [('10-manzanar', 'Manzanar')])
+        self.assertFalse(path.exists())
+        self.assertEqual(self.connection.settings_dict['NAME'], name)
+        self.assertEqual(database.current_profile(), profile)
+        # restored when the block raises too
+        with self.assertRaises(ValueError):
+            with snapshot.temporary(self.dir) as (path,generation):
+                raise ValueError()
+        self.assertFalse(path.exists())
+        self.assertEqual(self.connection.settings_dict['NAME'], name)
+        self.assertEqual(database.current_profile(), profile)
+
+
+class PaginatorsTests(TestCase):
+    databases = {'names'}
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.settings = override_settings(STATE_DB=str(Path(self.tmp.name) / 'state.db'))
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+        self.tmp.cleanup()
+
+    def test_stat1_estimate_skips_partial_index(self):
+        with connections['names'].cursor() as cursor:
+            cursor.execute('CREATE TABLE stat1test (x integer)')
+            cursor.execute('CREATE INDEX stat1test_big ON stat1test (x) WHERE x > 8')
+            cursor.execute('CREATE INDEX stat1test_x ON stat1test (x)')
+            for x in range(10):
+                cursor.execute('INSERT INTO stat1test (x) VALUES (%s)', [x])
+            cursor.execute('ANALYZE stat1test')
+        self.assertEqual(paginators.stat1_estimate('stat1test'), 10)
+
+    def make_facility(self, facility_id='10-manzanar'):
+        return Facility.objects.create(
+            facility_id=facility_id, facility_type='Concentration Camp',
+            title=facility_id,
+        )
+
+    def test_counts_adjusted_on_commit(self):
+        self.assertEqual(paginators.exact_count(Facility), 0)
+        with self.captureOnCommitCallbacks(using='names', execute=True):
+            facility = self.make_facility()
+        self.assertEqual(paginators.table_count(Facility), 1)
+        with self.captureOnCommitCallbacks(using='names', execute=True):
+            facility.delete()
+        self.assertEqual(paginators.table_count(Facility), 0)
+
+    def test_rolled_back_saves_not_counted(self):
+        self.assertEqual(paginators.exact_count(Facility), 0)
+        with self.captureOnCommitCallbacks(using='names', execute=True):
+            with self.assertRaises(ValueError), transaction.atomic(using='names'):
+                self.make_facility()
+                raise ValueError
+        self.assertEqual(paginators.table_count(Facility), 0)
+
+    def test_deferred_recounts_once(self):
+        self.assertEqual(paginators.exact_count(Facility), 0)
+        with self.captureOnCommitCallbacks(using='names') as callbacks:
+            with paginators.deferred():
+                self.make_facility('a')
+                self.make_facility('b')
+        self.assertEqual(callbacks, [])
+        self.assertEqual(paginators.table_count(Facility), 2)
+
+
+class WriterTests(TestCase):
+    databases = {'names'}
+
+    def save(self, item):
+        Facility.objects.create(
+            facility_id=item, facility_type='Concentration Camp', title=item,
+        )
+        if item.startswith('bad'):
+            raise ValueError(item)
+
+    def test_failed_row_rolled_back_and_rest_saved(self):
+        committed = []
+        result = writer.write(
+            ['a', 'b', 'bad-c', 'd', 'e'], self.save, batch_size=3,
+            progress=lambda result: committed.append(result.committed),
+        )
+        self.assertEqual(result.written, 4)
+        self.assertEqual(
+            [(offset, item) for offset,item,err in result.failed], [(2, 'bad-c')]
+        )
+        self.assertEqual(committed, [3, 5])
+        # the failed row's partial save was rolled back, the others kept
+        self.assertEqual(
+            sorted(Facility.objects.values_list('facility_id', flat=True)),
+            ['a', 'b', 'd', 'e'],
+        )
+
+
+class CheckpointRow:
+    """sql_class for cli.load_csv that saves each row as a Facility"""
+    interrupt_at = None  # facility_id whose save stops the run
+    fail = set()         # facility_ids whose saves fail
+
+    @staticmethod
+    def prep_data():
+        return {}
+
+    @classmethod
+    def load_rowd(cls, rowd, prepped_data):
+        return cls.Row(rowd['facility_id']), prepped_data
+
+    class Row:
+        def __init__(self, facility_id):
+            self.facility_id = facility_id
+
+        def save(self, username=None, note=None):
+            if self.facility_id == CheckpointRow.interrupt_at:
+                raise KeyboardInterrupt
+            Facility.objects.create(
+                facility_id=self.facility_id, facility_type='Concentration Camp',
+                title=self.facility_id,
+            )
+            if self.facility_id in CheckpointRow.fail:
+                raise ValueError(self.facility_id)
+
+
+class CheckpointTests(TestCase):
+    databases = {'names'}
+    ROWS = ['f0', 'f1', 'f2', 'f3', 'f4', 'f5', 'f6']
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.settings = override_settings(STATE_DB=str(Path(self.tmp.name) / 'state.db'))
+        self.settings.enable()
+        self.datafile = Path(self.tmp.name) / 'rows.csv'
+        self.datafile.write_text(
+            'facility_id,title\n' + ''.join(f'{row},{row}\n' for row in self.ROWS)
+        )
+        self.addCleanup(setattr, CheckpointRow, 'interrupt_at', None)
+        self.addCleanup(setattr, CheckpointRow, 'fail', set())
+
+    def tearDown(self):
+        self.settings.disable()
+        self.tmp.cleanup()
+
+    def load(self, job, retry=False):
+        cli.load_csv(
+            str(self.datafile), CheckpointRow, 0, 1_000_000, 'test', 'test', 3,
+            job, retry=retry,
+        )
+
+    def saved(self):
+        return sorted(Facility.objects.values_list('facility_id', flat=True))
+
+    def test_resume_after_interrupt(self):
+        job_id = checkpoints.start('load', {})
+        CheckpointRow.interrupt_at = 'f4'
+        with self.assertRaises(KeyboardInterrupt):
+            self.load(checkpoints.get(job_id))
+        # the first batch was committed and checkpointed, the second wasn't
+        job = checkpoints.get(job_id)
+        self.assertEqual(job['position'], '2')
+        self.assertEqual(self.saved(), ['f0', 'f1', 'f2'])
+        CheckpointRow.interrupt_at = None
+        self.load(job)
+        # a row saved twice would fail on the duplicate facility_id
+        job = checkpoints.get(job_id)
+        self.assertEqual(self.saved(), self.ROWS)
+        self.assertEqual(job['failed'], [])
+        self.assertEqual(job['status'], checkpoints.DONE)
+
+    def test_retry_failed(self):
+        job_id = checkpoints.start('load', {})
+        CheckpointRow.fail = {'f1', 'f5'}
+        self.load(checkpoints.get(job_id))
+        job = checkpoints.get(job_id)
+        self.assertEqual(job['position'], '6')
+        self.assertEqual(job['failed'], [1, 5])
+        self.assertEqual(job['status'], checkpoints.ENDED)
+        CheckpointRow.fail = set()
+        self.load(job, retry=True)
+        job = checkpoints.get(job_id)
+        self.assertEqual(self.saved(), self.ROWS)
+        self.assertEqual(job['failed'], [])
+        self.assertEqual(job['status'], checkpoints.DONE)
+
+    def test_retry_before_resume_keeps_run_resumable(self):
+        job_id = checkpoints.start('load', {})
+        CheckpointRow.fail = {'f1'}
+        CheckpointRow.interrupt_at = 'f4'
+        with self.assertRaises(KeyboardInterrupt):
+            self.load(checkpoints.get(job_id))
+        CheckpointRow.fail = set()
+        CheckpointRow.interrupt_at = None
+        self.load(checkpoints.get(job_id), retry=True)
+        job = checkpoints.get(job_id)
+        self.assertEqual(job['failed'], [])
+        self.assertEqual(job['status'], checkpoints.RUNNING)
+        self.assertEqual(self.saved(), ['f0', 'f1', 'f2'])
+        self.load(job)
+        job = checkpoints.get(job_id)
+        self.assertEqual(self.saved(), self.ROWS)
+        self.assertEqual(job['status'], checkpoints.DONE)
+
+
+class PostCheckpointTests(TestCase):
+    """cli._post with a checkpoint, as used by post --resume/--retry-failed"""
+    databases = {'names'}
+    IDS = ['f0', 'f1', 'f2', 'f3', 'f4']
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.settings = override_settings(STATE_DB=str(Path(self.tmp.name) / 'state.db'))
+        self.settings.enable()
+        for facility_id in self.IDS:
+            Facility.objects.create(
+                facility_id=facility_id, facility_type='Concentration Camp',
+                title=facility_id,
+            )
+        self.posted = []
+        self.fail = set()
+        self.interrupt_at = None
+        patches = [
+            mock.patch.object(cli, 'CHECKPOINT_EVERY', 2),
+            mock.patch.object(publish, 'post_changed', self.post_changed),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        self.settings.disable()
+        self.tmp.cleanup()
+
+    def post_changed(self, records, related, ds, model, force=False, progress=None, known=None):
+        failed = []
+        for record in records:
+            if record.pk == self.interrupt_at:
+                raise KeyboardInterrupt
+            if record.pk in self.fail:
+                failed.append(record.pk)
+            else:
+                self.posted.append(record.pk)
+        return len(records) - len(failed), 0, failed, [r.pk for r in records]
+
+    def post(self, job, retry=False):
+        # the records post selects for a checkpointed run
+        if retry:
+            records = Facility.objects.filter(pk__in=job['failed'])
+        else:
+            records = Facility.objects.order_by('pk')
+            if job['position']:
+                records = records.filter(pk__gt=job['position'])
+        return cli._post(records, {}, None, 'facility', True, job, retry=retry)
+
+    def test_resume_after_interrupt(self):
+        job_id = checkpoints.start('post', {})
+        self.interrupt_at = 'f3'
+        with self.assertRaises(KeyboardInterrupt):
+            self.post(checkpoints.get(job_id))
+        self.assertEqual(checkpoints.get(job_id)['position'], 'f1')
+        self.interrupt_at = None
+        self.post(checkpoints.get(job_id))
+        # the chunk that was interrupted is posted again, nothing is skipped
+        self.assertEqual(self.posted, ['f0', 'f1', 'f2', 'f2', 'f3', 'f4'])
+        self.assertEqual(checkpoints.get(job_id)['status'], checkpoints.DONE)
+
+    def test_retry_failed(self):
+        job_id = checkpoints.start('post', {})
+        self.fail = {'f1', 'f4'}
+        posted,unchanged,failed,seen = self.post(checkpoints.get(job_id))
+        self.assertEqual(failed, ['f1', 'f4'])
+        job = checkpoints.get(job_id)
+        self.assertEqual(job['failed'], ['f1', 'f4'])
+        self.assertEqual(job['status'], checkpoints.ENDED)
+        self.fail = set()
+        self.posted = []
+        self.post(job, retry=True)
+        self.assertEqual(sorted(self.posted), ['f1', 'f4'])
+        job = checkpoints.get(job_id)
+        self.assertEqual(job['failed'], [])
+        self.assertEqual(job['status'], checkpoints.DONE)
+
+    def test_retry_of_interrupted_run_stays_resumable(self):
+        job_id = checkpoints.start('post', {})
+        self.fail = {'f0'}
+        self.interrupt_at = 'f3'
+        with self.assertRaises(KeyboardInterrupt):
+            self.post(checkpoints.get(job_id))
+        self.fail = set()
+        self.interrupt_at = None
+        self.post(checkpoints.get(job_id), retry=True)
+        job = checkpoints.get(job_id)
+        self.assertEqual(job['status'], checkpoints.RUNNING)
+        self.post(job)
+        self.assertEqual(checkpoints.get(job_id)['status'], checkpoints.DONE)
+
+
+class FakeMgetES:
+    """Elasticsearch mget, recording the IDs of each request"""
+
+    def __init__(self, missing):
+        self.missing = missing
+        self.requests = []
+
+    def mget(self, index, body):
+        self.requests.append(body['ids'])
+        return {'docs': [
+            {'_index': index, '_id': doc_id, 'found': doc_id not in self.missing}
+            for doc_id in body['ids']
+        ]}
+
+
+class CliBatchTests(SimpleTestCase):
+    """namesdb get/delete send IDs in batches as they are read"""
+
+    def setUp(self):
+        self.ds = SimpleNamespace(
+            es=FakeMgetES(missing=['c']), index_name=lambda model: f'names{model}',
+        )
+        for patch in [
+            mock.patch.object(cli, 'docstore_manager', lambda hosts: self.ds),
+            mock.patch.object(cli, 'models_public', SimpleNamespace(
+                ELASTICSEARCH_CLASSES_BY_MODEL={'person': None}
+            )),
+        ]:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_chunks(self):
+        self.assertEqual(
+            list(publish.chunks((str(n) for n in range(5)), 2)),
+            [['0', '1'], ['2', '3'], ['4']]
+        )
+        self.assertEqual(list(publish.chunks([], 2)), [])
+        self.assertEqual(list(publish.chunks(['a', 'b'], 2)), [['a', 'b']])
+
+    def test_get(self):
+        with mock.patch.object(cli, 'MGET_SIZE', 2):
+            result = CliRunner().invoke(
+                cli.get, ['person', '--json'], input='a\nb\nc\n\nd\ne\n'
+            )
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(self.ds.es.requests, [['a', 'b'], ['c', 'd'], ['e']])
+        self.assertIn('NOT FOUND c', result.output)
+        found = [
+            json.loads(line)['_id'] for line in result.output.splitlines()
+            if line.startswith('{')
+        ]
+        self.assertEqual(found, ['a', 'b', 'd', 'e'])
+
+    def test_delete(self):
+        requests = []
+        def delete_docs(ds, model, doc_ids):
+            requests.append(doc_ids)
+            return [doc_id for doc_id in doc_ids if doc_id == 'b']
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / 'ids.txt'
+            path.write_text('a\nb\nc\n\nd\ne\n')
+            with mock.patch.object(publish, 'BULK_CHUNK_SIZE', 2), \
+                 mock.patch.object(publish, 'delete_docs', delete_docs):
+                result = CliRunner().invoke(cli.delete, ['person', '-f', str(path)])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(requests, [['a', 'b'], ['c', 'd'], ['e']])
+        self.assertEqual(result.output.splitlines(), ['FAIL b', 'Deleted 4 of 5'])
+
+
+@click.group()
+def servertest():
+    pass
+
+@servertest.command('connection')
+def servertest_connection():
+    with connections['names'].cursor() as cursor:
+        cursor.execute('SELECT 1')
+    click.echo(id(connections['names'].connection))
+
+@servertest.command('snapshot')
+def servertest_snapshot():
+    # as `post --snapshot` does, without copying the database
+    connections['names'].settings_dict['NAME'] = 'file:copy.db?mode=ro&immutable=1'
+    database.use_profile('snapshot', force=True)
+
+
+class CmdServerTests(TestCase):
+    databases = {'names'}
+
+    def setUp(self):
+        self.name = connections['names'].settings_dict['NAME']
+        self.profile = database.current_profile()
+
+    def tearDown(self):
+        connections['names'].settings_dict['NAME'] = self.name
+        database.use_profile(self.profile, force=True)
+
+    def test_connection_reused(self):
+        with mock.patch.object(connections['names'], 'close') as close:
+            code1,out1,err1 = cmdserver.run(servertest, ['connection'])
+            code2,out2,err2 = cmdserver.run(servertest, ['connection'])
+        self.assertEqual((code1, code2), (0, 0))
+        self.assertEqual(out1, out2)
+        close.assert_not_called()
+
+    def test_name_and_profile_restored(self):
+        with mock.patch.object(connections['names'], 'close') as close:
+            code,out,err = cmdserver.run(servertest, ['snapshot'])
+        self.assertEqual(code, 0)
+        close.assert_called_once()
+        self.assertEqual(connections['names'].settings_dict['NAME'], self.name)
+        self.assertEqual(database.current_profile(), self.profile)
+        with connections['names'].cursor() as cursor:
+            cursor.execute('PRAGMA query_only')
+            self.assertEqual(cursor.fetchone()[0], 0)
+
+
+class CliStartupTests(SimpleTestCase):
+
+    def test_option_choices_match_modules(self):
+        self.assertEqual(cli.PROFILERS, profiling.PROFILERS)
+        self.assertEqual(cli.EXPORT_FORMATS, export.FORMATS)
+        self.assertEqual(cli.EXPORT_COMPRESSIONS, export.COMPRESSIONS)
+
+    def test_light_commands_skip_django(self):
+        # `namesdb help` and `namesdb url` must not import Django settings
+        # or elasticsearch-dsl (see bench-startup in the Makefile)
+        code = (
+            'import sys; from names.cli import namesdb\n'
+            'for args in [["help"], ["url", "-H", "h:9200", "person", "x"]]:\n'
+            '    namesdb.main(args, standalone_mode=False)\n'
+            'print(sorted(m for m in ["django.conf", "elasticsearch_dsl"] if m in sys.modules))'
+        )
+        result = subprocess.run(
+            [sys.executable, '-c', code], capture_output=True, text=True,
+            cwd=Path(__file__).parent.parent, check=True,
+        )
+        self.assertEqual(result.stdout.splitlines()[-1], '[]')
@@ -0,0 +1,11 @@
+from django.urls import path
+
+from . import views
+
+app_name = 'names'
+
+urlpatterns = [
+    path('jobs/<int:job_id>/download/', views.job_download, name='job_download'),
+    path('jobs/<int:job_id>/', views.job_detail, name='job'),
+    path('jobs/', views.job_list, name='jobs'),
+]
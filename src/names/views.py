@@ -1,3 +1,42 @@
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import FileResponse, Http404
 from django.shortcuts import render
 
-# Create your views here.
+from . import jobs
+
+
+@staff_member_required
+def job_list(request):
+    """Recent background jobs"""
+    return render(request, 'names/jobs.html', {
+        **admin.site.each_context(request),
+        'title': 'Background jobs',
+        'jobs': jobs.recent(),
+    })
+
+@staff_member_required
+def job_detail(request, job_id):
+    """Progress and result of a background job"""
+    job = jobs.get(job_id)
+    if not job:
+        raise Http404
+    return render(request, 'names/job.html', {
+        **admin.site.each_context(request),
+        'title': f'Job {job_id}',
+        'job': job,
+        'running': job['status'] in [jobs.QUEUED, jobs.RUNNING],
+        'download': job['action'] == 'export' and job['status'] == jobs.DONE,
+    })
+
+@staff_member_required
+def job_download(request, job_id):
+    """Download file written by an export job"""
+    job = jobs.get(job_id)
+    if not (job and job['action'] == 'export' and job['status'] == jobs.DONE):
+        raise Http404
+    path = settings.EXPORT_ROOT / job['result']
+    if not path.exists():
+        raise Http404
+    return FileResponse(path.open('rb'), as_attachment=True, filename=path.name)
@@ -0,0 +1,90 @@
+"""Batched writes for the namesdb loaders
+
+Saving each record in its own transaction means a commit, and an fsync,
+for every row.  write() saves batch_size rows per transaction instead.
+If any row in a batch fails the batch is rolled back and saved again one
+row per transaction, so only the rows that fail are skipped and
+everything before them stays committed.
+
+    result = writer.write(rowds, save)
+    click.echo(result.summary())
+"""
+
+import logging
+import time
+
+from django.conf import settings
+from django.db import transaction
+
+
+class Result():
+    """Rows written and failed, and how long it took"""
+
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self.written = 0
+        self.committed = 0  # offset after the last committed batch
+        self.failed = []    # (offset, item, exception)
+        self.start = time.perf_counter()
+        self.elapsed = 0.0
+
+    def rate(self):
+        if not self.elapsed:
+            return 0
+        return self.written / self.elapsed
+
+    def summary(self):
+        return (
+            f'{self.written} written, {len(self.failed)} failed '
+            f'in {self.elapsed:.1f}s ({self.rate():.0f} rows/s, '
+            f'batch size {self.batch_size})'
+        )
+
+
+def _save_batch(items, save, offset, result, using):
+    try:
+        with transaction.atomic(using=using):
+            for item in items:
+                save(item)
+        result.written += len(items)
+        return
+    except Exception as err:
+        logging.info(f'batch at {offset} rolled back ({err}), retrying row by row')
+    for n,item in enumerate(items):
+        try:
+            with transaction.atomic(using=using):
+                save(item)
+            result.written += 1
+        except Exception as err:
+            result.failed.append((offset + n, item, err))
+
+def write(items, save, batch_size=None, progress=None, using='names'):
+    """Call save(item) for each item, batch_size items per transaction
+
+    @param items: iterable
+    @param save: function(item) that saves one item
+    @param batch_size: int (default settings.LOAD_BATCH_SIZE)
+    @param progress: function(Result) called after each commit (optional)
+    @returns: Result
+    """
+    batch_size = batch_size or settings.LOAD_BATCH_SIZE
+    result = Result(batch_size)
+    batch = []
+    offset = 0
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            _save_batch(batch, save, offset, result, using)
+            offset += len(batch)
+            result.committed = offset
+            batch = []
+            if progress:
+                progress(result)
+    if batch:
+        _save_batch(batch, save, offset, result, using)
+        offset += len(batch)
+        result.committed = offset
+        if progress:
+            progress(result)
+    result.elapsed = time.perf_counter() - result.start
+    return result